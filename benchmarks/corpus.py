@@ -0,0 +1,137 @@
+import copy
+import json
+import random
+import uuid
+from os import path
+
+import jwt
+
+from database.route_registry import InMemoryRouteRegistry
+from message_queue.codec import encode_body
+
+APP_ROOT = path.join(path.dirname(__file__), '..')
+SAMPLE_MESSAGE = path.join(APP_ROOT, 'sample_results.json', 'queue_msg_sample.json')
+EXAMPLE_SPEC = path.join(APP_ROOT, 'marketing_automation', 'upshot', 'example_spec.json')
+
+ROUTES = [
+    ("/api/v2/users/login", "user_login", "User Login"),
+    ("/api/v2/users/register/user", "user_registration", "User Registration"),
+    ("/api/v2/users/profile/update", "profile_update", "Profile Update"),
+    ("/api/v2/users/verify/email", "email_verification", "Email Verification"),
+    ("/api/v2/orders/create", "order_created", "Order Created"),
+]
+
+UNREGISTERED_ROUTES = [
+    "/api/v2/health",
+    "/api/v2/products/list",
+]
+
+
+def _load_json(file_path):
+    # the sample file has trailing notes after the JSON document
+    with open(file_path) as f:
+        return json.JSONDecoder().raw_decode(f.read().lstrip())[0]
+
+
+def _zoho_spec(upshot_spec):
+    """Derive a zoho data mapping from the upshot example so both sinks do a
+    comparable amount of transformation work."""
+    spec = copy.deepcopy(upshot_spec["upshot_integration"])
+    spec["name"] = "zoho integration"
+    spec["mapping"]["properties"]["data"] = {
+        "properties": {
+            "Account_ID": {"ref": "parameters/response/data/account_id"},
+            "Email": {"ref": "parameters/request/payload/data/email"},
+            "User_ID": {"ref": "parameters/response/data/user_id"},
+            "Role": {"ref": "parameters/response/data/role_id"},
+            "Last_Activity": {"operation": {"type": "utc_time_stamp"}}
+        },
+        "type": "object"
+    }
+    return {"zoho_integration": spec}
+
+
+def build_route_registry(zoho=True):
+    """Build an InMemoryRouteRegistry holding the example spec under every benchmark route."""
+    example = _load_json(EXAMPLE_SPEC)
+    registry = InMemoryRouteRegistry()
+    for url_path, event_key, event_name in ROUTES:
+        upshot_spec = copy.deepcopy(example["event_log_data"]["upshot"])
+        properties = upshot_spec["upshot_integration"]["mapping"]["properties"]["data"]["properties"]
+        properties["eventId"]["default_value"] = event_key
+        properties["eventName"]["default_value"] = event_name
+        event_log_data = {"upshot": upshot_spec, "zoho": _zoho_spec(upshot_spec) if zoho else {}}
+        registry.add_route(url_path, event_log_data, {"in_upshot": True, "in_zoho": zoho}, "Users_Data")
+    return registry
+
+
+def _uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def _token(rng, secret, production=True):
+    claims = {
+        "user_id": _uuid(rng),
+        "account_id": _uuid(rng),
+        "vdezi_server": "vdeziproduction" if production else "vdezistaging"
+    }
+    token = jwt.encode(claims, secret, algorithm="HS256")
+    if isinstance(token, bytes):
+        token = token.decode("utf8")
+    return token
+
+
+def _api_message(sample, rng, secret):
+    message = copy.deepcopy(sample)
+    roll = rng.random()
+    if roll < 0.1:
+        message["request"]["url"] = rng.choice(UNREGISTERED_ROUTES)
+    else:
+        message["request"]["url"] = rng.choice(ROUTES)[0]
+
+    roll = rng.random()
+    if roll < 0.35:
+        message["request"]["headers"]["authorization"] = "Bearer " + _token(rng, secret, production=rng.random() > 0.2)
+    elif roll < 0.5:
+        message["request"]["headers"]["Authorization"] = "Bearer " + _token(rng, secret)
+    elif roll < 0.65:
+        message["response"]["data"]["token"] = _token(rng, secret)
+
+    message["response"]["data"]["account_id"] = _uuid(rng)
+    message["response"]["data"]["user_id"] = _uuid(rng)
+    message["request"]["payload"]["data"]["email"] = "user{}@example.com".format(rng.randint(0, 10 ** 6))
+    return message
+
+
+def _segment_message(rng, segment_users):
+    return {
+        "type": "etl_segment",
+        "segment_name": "segment_{}".format(rng.randint(0, 100)),
+        "registered_users": [_uuid(rng) for _ in range(segment_users)]
+    }
+
+
+def build_corpus(size=10000, seed=7, segment_ratio=0.02, segment_users=5000, secret="benchmark"):
+    """Build a list of encoded message bodies modelled on queue_msg_sample.json.
+
+    The corpus mixes registered and unregistered routes, messages with and
+    without a JWT (nodejs and python header casing, or a token in the
+    response) and a share of large etl_segment messages.
+
+    :param int size: Number of messages
+    :param int seed: Seed making the corpus reproducible
+    :param float segment_ratio: Share of etl_segment messages
+    :param int segment_users: Registered users carried by each etl_segment message
+    :param str secret: Key used to sign the generated tokens
+
+    """
+    rng = random.Random(seed)
+    sample = _load_json(SAMPLE_MESSAGE)
+    corpus = []
+    for _ in range(size):
+        if rng.random() < segment_ratio:
+            message = _segment_message(rng, segment_users)
+        else:
+            message = _api_message(sample, rng, secret)
+        corpus.append(encode_body(message))
+    return corpus
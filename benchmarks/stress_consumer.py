@@ -0,0 +1,302 @@
+"""Concurrency stress test of the consumer, its acknowledgements and the sinks.
+
+Runs QueueHandler against the in-memory broker and the stub sinks while
+faults are injected: channels and connections closed by the broker with
+messages in flight, slow and failing sink calls, Zoho upserts refused with
+INVALID_TOKEN so the shared ZohoCRM refreshes its token under load, and a
+SIGTERM delivered mid-flight at the end of every round. Each round starts a
+new QueueHandler on the same broker, until every message is settled or the
+drain timeout expires. The script then checks, per message, that nothing was
+lost, that no delivery was acknowledged twice and that no message was
+acknowledged without its sinks accepting it, and reports the throughput
+under failure. It exits with status 1 when a check fails:
+
+    python -m benchmarks.stress_consumer --messages 20000 --workers 64 --prefetch 128 --channels 4
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+from benchmarks.corpus import ROUTES, build_corpus, build_route_registry
+from benchmarks.stub_sinks import StubSinkServer
+
+QUEUE = "stress"
+
+# the transform processes of the process mode are spawned, without the in-memory route registry installed here
+STRESS_MODES = ("thread", "pool", "asyncio", "partitioned", "priority")
+
+
+def _configure(options, sink_url):
+    logging.disable(logging.CRITICAL)
+    if not hasattr(logging.Logger, "event_debug"):
+        logging.Logger.event_debug = logging.Logger.debug
+    from config import Config
+    Config.UPSHOT_API_URL = sink_url
+    Config.ZOHO_API_URL = sink_url
+    Config.ZOHO_ACCOUNTS_URL = sink_url
+    Config.JWT_TOKEN = "benchmark"
+    Config.DRAIN_TIMEOUT_SECONDS = str(options["drain_timeout"])
+
+    from marketing_automation import marketing_auto_router
+    marketing_auto_router.set_route_registry(build_route_registry())
+
+
+class Chaos(object):
+    """Injects broker faults during a round and ends it with a SIGTERM.
+
+    Channels or connections are closed at exponentially distributed intervals
+    of mean fault_interval seconds. The round ends at ends_at, or once every
+    message is settled, with a SIGTERM delivered while messages are still
+    being processed. When draining, no fault is injected but the channels
+    are closed when nothing was settled for stall_seconds, which redelivers
+    the messages held after a failed sink call.
+    """
+
+    def __init__(self, broker, options, seed, is_settled, ends_at, draining=False):
+        self.broker = broker
+        self.options = options
+        self.ends_at = ends_at
+        self.is_settled = is_settled
+        self.draining = draining
+        self.faults = Counter()
+        self._rng = random.Random(seed)
+        self._done = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name="stress-chaos", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._done.set()
+
+    def _settled_count(self):
+        settlements = self.broker.settlements
+        return len(settlements["acked"]) + len(settlements["rejected"])
+
+    def _run(self):
+        next_fault_at = time.monotonic() + self._rng.expovariate(1.0 / self.options["fault_interval"])
+        settled, progressed_at = self._settled_count(), time.monotonic()
+        while not self._done.wait(0.05):
+            now = time.monotonic()
+            if self.is_settled() or now >= self.ends_at:
+                self.faults["sigterm"] += 1
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            if self.draining:
+                if self._settled_count() != settled:
+                    settled, progressed_at = self._settled_count(), now
+                elif now - progressed_at >= self.options["stall_seconds"]:
+                    self.broker.close_channels(reply_text="CONNECTION_FORCED - redelivering held messages")
+                    self.faults["drain_channel_close"] += 1
+                    progressed_at = now
+            elif now >= next_fault_at:
+                if self._rng.random() < self.options["connection_fault_share"]:
+                    self.broker.close_connections()
+                    self.faults["connection_close"] += 1
+                else:
+                    self.broker.close_channels()
+                    self.faults["channel_close"] += 1
+                next_fault_at = now + self._rng.expovariate(1.0 / self.options["fault_interval"])
+
+
+def _sink_key(body):
+    """The account id the sinks receive for a message, None when its route is
+    not registered and it is acknowledged without calling them."""
+    from message_queue.codec import decode_body
+
+    message = decode_body(body)
+    if "type" in message or message["request"]["url"] not in [route[0] for route in ROUTES]:
+        return None
+    return message["response"]["data"]["account_id"]
+
+
+def _publish(broker, corpus, rate, published, sink_keys):
+    from config import Config
+    from message_queue.codec import encode_body
+    import pika
+
+    started = time.monotonic()
+    for index, message in enumerate(corpus):
+        if rate:
+            delay = started + index / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        body = message if isinstance(message, bytes) else encode_body(message)
+        sink_keys[str(index)] = _sink_key(body)
+        broker.publish(Config.EVENT_LOG_EXCHANGE_NAME, QUEUE, body, pika.BasicProperties(message_id=str(index)))
+        published.append(str(index))
+
+
+def check(broker, published, sink_keys, accepted):
+    """Per message checks of a finished run, returns the list of violations.
+
+    A message is accepted once both stub sinks answered a success for its
+    account id, as counted by StubSinkServer.accepted.
+    """
+    settlements = broker.settlements
+    violations = []
+    lost = [message_id for message_id in published
+            if not settlements["acked"][message_id] and not settlements["rejected"][message_id]]
+    if lost:
+        violations.append("{} messages lost, e.g. {}".format(len(lost), lost[:10]))
+    if broker.stats["unknown_ack"]:
+        violations.append("{} acknowledgements of unknown or already settled delivery tags".format(broker.stats["unknown_ack"]))
+    over_settled = [message_id for message_id in published
+                    if settlements["acked"][message_id] + settlements["rejected"][message_id] > settlements["delivered"][message_id]]
+    if over_settled:
+        violations.append("{} messages settled more often than delivered, e.g. {}".format(len(over_settled), over_settled[:10]))
+    unaccepted = [message_id for message_id in published
+                  if settlements["acked"][message_id] and sink_keys[message_id]
+                  and not all(accepted[sink][sink_keys[message_id]] for sink in accepted)]
+    if unaccepted:
+        violations.append("{} messages acknowledged without the sinks accepting them, e.g. {}".format(len(unaccepted), unaccepted[:10]))
+    if broker.message_count(QUEUE) or broker.unacked_count():
+        violations.append("{} messages still queued and {} unacknowledged".format(broker.message_count(QUEUE), broker.unacked_count()))
+    return violations
+
+
+def run_stress(options):
+    stub = StubSinkServer(latency_ms=options["latency_ms"], jitter_ms=options["jitter_ms"],
+                          error_rate=options["error_rate"], invalid_token_rate=options["invalid_token_rate"],
+                          seed=options["seed"]).start()
+    _configure(options, stub.url)
+
+    from config import Config
+    from message_queue.memory_broker import InMemoryBroker, InMemoryTransport
+
+    from run import QueueHandler
+    broker = InMemoryBroker(track_messages=True)
+    broker.declare_exchange(Config.EVENT_LOG_EXCHANGE_NAME)
+    # declared ahead of the consumer, the messages published before it connects are kept
+    broker.declare_queue(QUEUE)
+    broker.bind(QUEUE, Config.EVENT_LOG_EXCHANGE_NAME, QUEUE)
+    corpus = build_corpus(size=options["messages"], seed=options["seed"],
+                          segment_ratio=options["segment_ratio"], segment_users=options["segment_users"])
+
+    published = []
+    sink_keys = {}
+    publisher = threading.Thread(target=_publish, args=(broker, corpus, options["publish_rate"], published, sink_keys),
+                                 name="stress-publisher", daemon=True)
+
+    def is_settled():
+        settlements = broker.settlements
+        return (not publisher.is_alive() and len(published) == len(corpus)
+                and all(settlements["acked"][message_id] or settlements["rejected"][message_id] for message_id in published))
+
+    faults = Counter()
+    rounds = []
+    started = time.perf_counter()
+    drain_deadline = None
+    while True:
+        draining = len(rounds) >= options["rounds"]
+        if draining:
+            if drain_deadline is None:
+                # the sinks recover, the messages left must now get through
+                stub.error_rate = stub.invalid_token_rate = 0.0
+                drain_deadline = time.monotonic() + options["drain_seconds"]
+            elif time.monotonic() >= drain_deadline:
+                break
+        round_started = time.perf_counter()
+        acked_before = broker.stats["acked"]
+        handler = QueueHandler(QUEUE, execution_mode=options["mode"], workers=options["workers"],
+                                prefetch_count=options["prefetch"], transport=InMemoryTransport(broker),
+                                channels=options["channels"], batch_size=options["batch_size"])
+        ends_at = drain_deadline if draining else time.monotonic() + options["round_seconds"]
+        chaos = Chaos(broker, options, options["seed"] + len(rounds), is_settled, ends_at, draining=draining).start()
+        if not publisher.is_alive() and not published:
+            publisher.start()
+        # the workers of a round still running finish during the next one, their late acks are dropped
+        handler.start(exit_with_stragglers=False)
+        chaos.stop()
+        faults.update(chaos.faults)
+        seconds = time.perf_counter() - round_started
+        rounds.append({
+            "round": len(rounds) + 1,
+            "draining": draining,
+            "seconds": round(seconds, 3),
+            "acked": broker.stats["acked"] - acked_before,
+            "acked_per_second": round((broker.stats["acked"] - acked_before) / seconds, 1),
+            "faults": dict(chaos.faults)
+        })
+        if is_settled():
+            break
+    duration = time.perf_counter() - started
+    stub.stop()
+
+    violations = check(broker, published, sink_keys, stub.accepted)
+    return {
+        "options": options,
+        "published": len(published),
+        "seconds": round(duration, 3),
+        "settled_per_second": round(sum(1 for message_id in published if broker.settlements["acked"][message_id]
+                                        or broker.settlements["rejected"][message_id]) / duration, 1),
+        "sent_more_than_once": sum(1 for count in stub.accepted["upshot"].values() if count > 1),
+        "broker": dict(broker.stats),
+        "sink_requests": dict(stub.requests),
+        "sink_errors": stub.errors,
+        "faults": dict(faults),
+        "rounds": rounds,
+        "violations": violations
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Event collector consumer stress test")
+    parser.add_argument("--mode", default="pool", choices=STRESS_MODES)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=32, help="Pool size of the pool, asyncio, partitioned and priority modes")
+    parser.add_argument("--prefetch", type=int, default=64, help="Prefetch count of every channel")
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=0)
+    parser.add_argument("--publish_rate", type=float, default=0, help="Messages published per second, 0 publishes them all at once")
+    parser.add_argument("--rounds", type=int, default=5, help="Rounds with faults, each ended by a SIGTERM, before the drain")
+    parser.add_argument("--round_seconds", type=float, default=4.0)
+    parser.add_argument("--fault_interval", type=float, default=2.0, help="Mean seconds between two broker faults")
+    parser.add_argument("--connection_fault_share", type=float, default=0.3, help="Share of the faults closing the connection instead of the channels")
+    parser.add_argument("--drain_timeout", type=float, default=2.0, help="DRAIN_TIMEOUT_SECONDS of the consumer")
+    parser.add_argument("--drain_seconds", type=float, default=60.0, help="Seconds the fault free drain may take to settle every message")
+    parser.add_argument("--stall_seconds", type=float, default=10.0, help="Seconds without a settlement before the drain closes the channels")
+    parser.add_argument("--latency_ms", type=float, default=5)
+    parser.add_argument("--jitter_ms", type=float, default=50, help="Up to this much latency is added to a sink call, the slow calls")
+    parser.add_argument("--error_rate", type=float, default=0.02, help="Share of sink calls answered with a 500")
+    parser.add_argument("--invalid_token_rate", type=float, default=0.01, help="Share of Zoho upserts answered with INVALID_TOKEN")
+    parser.add_argument("--segment_ratio", type=float, default=0.0)
+    parser.add_argument("--segment_users", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", dest="json_path", default=None, help="Also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = dict(vars(args))
+    json_path = options.pop("json_path")
+    report = run_stress(options)
+
+    print("{published} messages in {seconds}s, {settled_per_second} settled/s, {sent_more_than_once} sent more than once".format(**report))
+    print("broker: {}".format(json.dumps(report["broker"])))
+    print("sinks: {} errors injected: {}".format(json.dumps(report["sink_requests"]), report["sink_errors"]))
+    print("faults: {}".format(json.dumps(report["faults"])))
+    for each in report["rounds"]:
+        print("round {round}{drain}: {seconds}s, {acked} acked, {acked_per_second}/s".format(
+            drain=" (drain)" if each["draining"] else "", **each))
+    for violation in report["violations"]:
+        print("FAILED: {}".format(violation))
+    if not report["violations"]:
+        print("OK: nothing lost, no delivery acknowledged twice, every acknowledged message accepted by the sinks")
+
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main()["violations"] else 0)
@@ -0,0 +1,154 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+class StubSinkServer(object):
+    """Local HTTP server answering like the Upshot and Zoho APIs.
+
+    Every request waits latency_ms (plus up to jitter_ms) before answering and
+    fails with a 500 for a share of error_rate of the requests, and a share of
+    invalid_token_rate of the Zoho upserts is refused with INVALID_TOKEN, which
+    makes the sink fetch a new access token and retry. Point
+    Config.UPSHOT_API_URL, Config.ZOHO_API_URL and Config.ZOHO_ACCOUNTS_URL at
+    url to route the sinks here.
+
+    accepted counts, per sink and account id, the events answered with a
+    success: the appuid of an Upshot event and the Account_ID of every Zoho
+    record, both mapped from the account_id of the message.
+
+    :param float latency_ms: Base latency injected in every response
+    :param float jitter_ms: Random extra latency added on top of latency_ms
+    :param float error_rate: Share of requests answered with an error
+    :param float invalid_token_rate: Share of Zoho upserts answered with INVALID_TOKEN
+    :param int seed: Seed of the error and jitter draws
+
+    """
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, seed=11, host="127.0.0.1", port=0, invalid_token_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.invalid_token_rate = invalid_token_rate
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.requests = {"upshot": 0, "zoho_upsert": 0, "zoho_search": 0, "zoho_token": 0, "unknown": 0}
+        self.errors = 0
+        self.accepted = {"upshot": Counter(), "zoho_upsert": Counter()}
+        self._counter_lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-sinks", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _draw(self):
+        with self._rng_lock:
+            delay = (self.latency_ms + self._rng.random() * self.jitter_ms) / 1000.0
+            failed = self._rng.random() < self.error_rate
+            invalid_token = self._rng.random() < self.invalid_token_rate
+        return delay, failed, invalid_token
+
+    def _count(self, kind, failed):
+        with self._counter_lock:
+            self.requests[kind] += 1
+            if failed:
+                self.errors += 1
+
+    def _accept(self, kind, payload):
+        if kind == "upshot":
+            keys = [(payload.get("data") or {}).get("appuid")]
+        else:
+            keys = [record.get("Account_ID") for record in payload.get("data") or []]
+        with self._counter_lock:
+            self.accepted[kind].update(key for key in keys if key)
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode("utf8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                route = self.path.split("?")[0]
+                if route.endswith("/v1/events/add"):
+                    kind = "upshot"
+                elif route.endswith("/upsert"):
+                    kind = "zoho_upsert"
+                elif "/search" in route:
+                    kind = "zoho_search"
+                elif route.endswith("/oauth/v2/token"):
+                    kind = "zoho_token"
+                else:
+                    kind = "unknown"
+
+                delay, failed, invalid_token = stub._draw()
+                if kind == "zoho_token":
+                    failed = False
+                stub._count(kind, failed)
+                if delay:
+                    time.sleep(delay)
+
+                if kind == "unknown":
+                    self._reply(404, {"code": "NOT_FOUND"})
+                elif failed:
+                    self._reply(500, {"code": "INTERNAL_ERROR", "message": "injected failure"})
+                elif kind == "zoho_upsert" and invalid_token:
+                    self._reply(401, {"code": "INVALID_TOKEN", "message": "invalid oauth token", "status": "error"})
+                elif kind in ("upshot", "zoho_upsert"):
+                    try:
+                        payload = json.loads(body.decode("utf8"))
+                    except ValueError:
+                        payload = {}
+                    # counted before the reply, the sink took the event even when the client gave up on it
+                    stub._accept(kind, payload)
+                    if kind == "upshot":
+                        self._reply(200, {"status": "success"})
+                    else:
+                        records = len(payload.get("data") or [None])
+                        self._reply(200, {"data": [{"code": "SUCCESS", "status": "success", "details": {"id": "1"}}] * records})
+                elif kind == "zoho_search":
+                    self._reply(200, {"data": [{"id": "1"}]})
+                else:
+                    self._reply(200, {"access_token": "stub-token", "expires_in": 3600})
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,189 @@
+"""Offline throughput benchmark of the decode, router and sink pipeline.
+
+Runs a generated corpus through every execution mode against local stub
+Upshot and Zoho servers and an in-memory route registry, one fresh process
+per mode so peak RSS is comparable:
+
+    python -m benchmarks.throughput --messages 5000 --latency_ms 20 --error_rate 0.01
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import sys
+import threading
+import time
+
+from benchmarks.corpus import build_corpus, build_route_registry
+from benchmarks.stub_sinks import StubSinkServer
+from message_queue.executors import EXECUTION_MODES
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if sys.platform == "darwin":
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def _configure_sinks(sink_url):
+    from config import Config
+    Config.UPSHOT_API_URL = sink_url
+    Config.ZOHO_API_URL = sink_url
+    Config.ZOHO_ACCOUNTS_URL = sink_url
+    Config.JWT_TOKEN = "benchmark"
+
+
+def _setup_process(options, sink_url):
+    """Point a benchmark process, or one of its transform processes, to the
+    stub sinks and the in-memory route registry."""
+    logging.disable(logging.CRITICAL)
+    if not hasattr(logging.Logger, "event_debug"):
+        logging.Logger.event_debug = logging.Logger.debug
+    _configure_sinks(sink_url)
+
+    from marketing_automation import marketing_auto_router
+    marketing_auto_router.set_route_registry(build_route_registry(zoho=not options["no_zoho"]))
+
+
+def run_mode(mode, options, sink_url):
+    """Process the corpus with one execution mode and return its measurements."""
+    _setup_process(options, sink_url)
+
+    import umsgpack
+    from functools import partial
+    from marketing_automation import marketing_auto_router
+    from marketing_automation.offload import prepare_message
+    from message_queue.codec import decode_body
+    from message_queue.executors import create_executor
+
+    corpus = build_corpus(size=options["messages"], seed=options["seed"],
+                          segment_ratio=options["segment_ratio"], segment_users=options["segment_users"])
+
+    latencies = []
+    failures = []
+    remaining = [len(corpus)]
+    lock = threading.Lock()
+    done = threading.Event()
+    # plays the role of the broker prefetch window
+    window = threading.BoundedSemaphore(options["prefetch"])
+
+    def process(body, submitted_at):
+        processed = False
+        try:
+            event_data = decode_body(body)
+            processed = bool(event_data) and marketing_auto_router.router(event_data)
+        finally:
+            record(submitted_at, processed)
+
+    def process_offloaded(body, submitted_at):
+        processed = False
+        try:
+            prepared = executor.offload(prepare_message, body).result()
+            records = umsgpack.unpackb(prepared)["records"] if prepared else None
+            processed = records is not None and marketing_auto_router.send_sink_records(records)
+        finally:
+            record(submitted_at, processed)
+
+    def record(submitted_at, processed):
+        elapsed = time.perf_counter() - submitted_at
+        with lock:
+            latencies.append(elapsed)
+            if not processed:
+                failures.append(1)
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                done.set()
+        window.release()
+
+    executor = create_executor(mode, options["workers"], initializer=partial(_setup_process, options, sink_url))
+    target = process_offloaded if hasattr(executor, "offload") else process
+    started = time.perf_counter()
+    for body in corpus:
+        window.acquire()
+        executor.submit(target, body, time.perf_counter())
+    done.wait()
+    duration = time.perf_counter() - started
+    executor.shutdown(wait=True)
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "messages": len(corpus),
+        "failed": len(failures),
+        "seconds": round(duration, 3),
+        "messages_per_second": round(len(corpus) / duration, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "peak_rss_mb": round(_peak_rss_mb(), 1)
+    }
+
+
+def _run_mode_in_child(mode, options, sink_url, results):
+    results.put(run_mode(mode, options, sink_url))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Event collector throughput benchmark")
+    parser.add_argument("--modes", nargs="+", default=list(EXECUTION_MODES), choices=EXECUTION_MODES)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=32, help="Pool size of the pool and asyncio modes")
+    parser.add_argument("--prefetch", type=int, default=200, help="Messages in flight at once, like the consumer prefetch")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--segment_ratio", type=float, default=0.02, help="Share of etl_segment messages")
+    parser.add_argument("--segment_users", type=int, default=5000, help="Users carried by an etl_segment message")
+    parser.add_argument("--latency_ms", type=float, default=20, help="Latency injected by the stub sinks")
+    parser.add_argument("--jitter_ms", type=float, default=10)
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Share of sink calls answered with a 500")
+    parser.add_argument("--no_zoho", action="store_true", help="Only route events to the upshot stub")
+    parser.add_argument("--json", dest="json_path", default=None, help="Also write the results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {
+        "messages": args.messages,
+        "workers": args.workers,
+        "prefetch": args.prefetch,
+        "seed": args.seed,
+        "segment_ratio": args.segment_ratio,
+        "segment_users": args.segment_users,
+        "no_zoho": args.no_zoho
+    }
+    stub = StubSinkServer(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate).start()
+    context = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        for mode in args.modes:
+            queue = context.Queue()
+            child = context.Process(target=_run_mode_in_child, args=(mode, options, stub.url, queue))
+            child.start()
+            results.append(queue.get())
+            child.join()
+    finally:
+        stub.stop()
+
+    columns = ("mode", "messages", "failed", "seconds", "messages_per_second", "p50_ms", "p99_ms", "peak_rss_mb")
+    print(" ".join("{:>20}".format(column) for column in columns))
+    for result in results:
+        print(" ".join("{:>20}".format(result[column]) for column in columns))
+    print("stub sink requests: {} errors injected: {}".format(json.dumps(stub.requests), stub.errors))
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"options": vars(args), "results": results}, f, indent=4)
+    return results
+
+
+if __name__ == "__main__":
+    main()
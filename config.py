@@ -144,6 +144,10 @@ class Config(object):
     
     SQLALCHEMY_DATABASE_URI = getenv('SQLALCHEMY_DATABASE_URI')
 
+    MONGO_DB_URI = getenv('MONGO_DB_URI')
+
+    MONGO_DB_DATABASE = getenv('MONGO_DB_DATABASE', 'vdezi_events_management')
+
     QUEUE_NAME =  getenv('QUEUE_TO_LISTEN')
     
     EVENT_LOG_EXCHANGE_NAME = getenv("EVENT_LOG_EXCHANGE_NAME")
@@ -164,6 +168,8 @@ class Config(object):
 
     INVOICE_BUCKET = getenv('INVOICE_BUCKET')
     
+    UPSHOT_API_URL = getenv('UPSHOT_API_URL', 'https://eapi.goupshot.com')
+
     UPSHOT_API_KEY = getenv('UPSHOT_API_KEY')
 
     UPSHOT_APP_ID = getenv('UPSHOT_APP_ID')
@@ -178,8 +184,122 @@ class Config(object):
 
     JWT_TOKEN = getenv('JWT_TOKEN')
 
+    ZOHO_API_URL = getenv('ZOHO_API_URL', 'https://www.zohoapis.com')
+
+    ZOHO_ACCOUNTS_URL = getenv('ZOHO_ACCOUNTS_URL', 'https://accounts.zoho.com')
+
     ZOHO_CLIENT_ID = getenv('ZOHO_CLIENT_ID')
 
     ZOHO_CLIENT_SECRET = getenv('ZOHO_CLIENT_SECRET')
 
     ZOHO_REFRESH_TOKEN = getenv('ZOHO_REFRESH_TOKEN')
+
+    PROFILE_MODE = getenv('PROFILE_MODE', 'off')
+
+    PROFILE_SLOW_THRESHOLD_MS = getenv('PROFILE_SLOW_THRESHOLD_MS', '1000')
+
+    PROFILE_SAMPLE_INTERVAL_MS = getenv('PROFILE_SAMPLE_INTERVAL_MS', '10')
+
+    PROFILE_PERIODIC_SECONDS = getenv('PROFILE_PERIODIC_SECONDS', '0')
+
+    PROFILE_OUTPUT_DIR = getenv('PROFILE_OUTPUT_DIR', '/tmp/event_collector_profiles')
+
+    DRAIN_TIMEOUT_SECONDS = getenv('DRAIN_TIMEOUT_SECONDS', '25')
+
+    HTTP_POOL_SIZE = getenv('HTTP_POOL_SIZE', '64')
+
+    ROUTE_CACHE_TTL_SECONDS = getenv('ROUTE_CACHE_TTL_SECONDS', '300')
+
+    STARTUP_WARM_UP = getenv('STARTUP_WARM_UP', 'true')
+
+    DEDUP_MODE = getenv('DEDUP_MODE', 'off')
+
+    DEDUP_CACHE_SIZE = getenv('DEDUP_CACHE_SIZE', '100000')
+
+    DEDUP_TTL_SECONDS = getenv('DEDUP_TTL_SECONDS', '86400')
+
+    PARTITION_KEY = getenv('PARTITION_KEY', 'account_id')
+
+    ZOHO_COALESCE_WINDOW_MS = getenv('ZOHO_COALESCE_WINDOW_MS', '0')
+
+    ZOHO_COALESCE_MAX_RECORDS = getenv('ZOHO_COALESCE_MAX_RECORDS', '100')
+
+    ZOHO_DUPLICATE_CHECK_FIELDS = getenv('ZOHO_DUPLICATE_CHECK_FIELDS', 'Account_ID')
+
+    PAYLOAD_PROJECTION = getenv('PAYLOAD_PROJECTION', 'false')
+
+    FLOW_HIGH_IN_FLIGHT = getenv('FLOW_HIGH_IN_FLIGHT', '0')
+
+    FLOW_LOW_IN_FLIGHT = getenv('FLOW_LOW_IN_FLIGHT')
+
+    FLOW_HIGH_IN_FLIGHT_MB = getenv('FLOW_HIGH_IN_FLIGHT_MB', '0')
+
+    FLOW_LOW_IN_FLIGHT_MB = getenv('FLOW_LOW_IN_FLIGHT_MB')
+
+    FLOW_HIGH_RSS_MB = getenv('FLOW_HIGH_RSS_MB', '0')
+
+    FLOW_LOW_RSS_MB = getenv('FLOW_LOW_RSS_MB')
+
+    OUTBOX_DIR = getenv('OUTBOX_DIR', '')
+
+    OUTBOX_SEGMENT_MB = getenv('OUTBOX_SEGMENT_MB', '64')
+
+    OUTBOX_SYNC_INTERVAL_MS = getenv('OUTBOX_SYNC_INTERVAL_MS', '2')
+
+    OUTBOX_SENDERS = getenv('OUTBOX_SENDERS', '4')
+
+    OUTBOX_BATCH_SIZE = getenv('OUTBOX_BATCH_SIZE', '100')
+
+    OUTBOX_MAX_ATTEMPTS = getenv('OUTBOX_MAX_ATTEMPTS', '10')
+
+    OUTBOX_RETRY_BACKOFF_MS = getenv('OUTBOX_RETRY_BACKOFF_MS', '500')
+
+    OUTBOX_ORPHAN_SCAN_SECONDS = getenv('OUTBOX_ORPHAN_SCAN_SECONDS', '30')
+
+    TRANSFORM_PROCESSES = getenv('TRANSFORM_PROCESSES', '0')
+
+    AUTOSCALE_INTERVAL_SECONDS = getenv('AUTOSCALE_INTERVAL_SECONDS', '5')
+
+    AUTOSCALE_TARGET_DRAIN_SECONDS = getenv('AUTOSCALE_TARGET_DRAIN_SECONDS', '30')
+
+    HTTP_CONNECT_TIMEOUT_SECONDS = getenv('HTTP_CONNECT_TIMEOUT_SECONDS', '3')
+
+    HTTP_READ_TIMEOUT_SECONDS = getenv('HTTP_READ_TIMEOUT_SECONDS', '10')
+
+    EVENT_DEADLINE_SECONDS = getenv('EVENT_DEADLINE_SECONDS', '0')
+
+    HTTP_HEDGING = getenv('HTTP_HEDGING', 'false')
+
+    HTTP_HEDGE_QUANTILE = getenv('HTTP_HEDGE_QUANTILE', '0.95')
+
+    HTTP_HEDGE_MIN_DELAY_MS = getenv('HTTP_HEDGE_MIN_DELAY_MS', '20')
+
+    HTTP_HEDGE_BUDGET_PERCENT = getenv('HTTP_HEDGE_BUDGET_PERCENT', '10')
+
+    BROKER_SOCKET_TIMEOUT_SECONDS = getenv('BROKER_SOCKET_TIMEOUT_SECONDS', '10')
+
+    BROKER_HEARTBEAT_SECONDS = getenv('BROKER_HEARTBEAT_SECONDS', '15')
+
+    BROKER_RECONNECT_BACKOFF_MS = getenv('BROKER_RECONNECT_BACKOFF_MS', '250')
+
+    BROKER_MAX_RECONNECT_BACKOFF_SECONDS = getenv('BROKER_MAX_RECONNECT_BACKOFF_SECONDS', '30')
+
+    PRIORITY_WEIGHTS = getenv('PRIORITY_WEIGHTS', 'realtime:8,default:3,bulk:1')
+
+    PRIORITY_RESERVED_WORKERS = getenv('PRIORITY_RESERVED_WORKERS', '2')
+
+    PRIORITY_JOB_CLASS = getenv('PRIORITY_JOB_CLASS', 'bulk')
+
+    MEMORY_DIAGNOSTICS_SECONDS = getenv('MEMORY_DIAGNOSTICS_SECONDS', '0')
+
+    MEMORY_DIAGNOSTICS_DIR = getenv('MEMORY_DIAGNOSTICS_DIR', '/tmp/event_collector_memory')
+
+    MEMORY_DIAGNOSTICS_TOP = getenv('MEMORY_DIAGNOSTICS_TOP', '20')
+
+    MEMORY_DIAGNOSTICS_FRAMES = getenv('MEMORY_DIAGNOSTICS_FRAMES', '1')
+
+    JSON_BACKEND = getenv('JSON_BACKEND', 'auto')
+
+    ROUTE_SNAPSHOT_PATH = getenv('ROUTE_SNAPSHOT_PATH', '')
+
+    ROUTE_SNAPSHOT_REFRESH_SECONDS = getenv('ROUTE_SNAPSHOT_REFRESH_SECONDS', '60')
@@ -7,6 +7,8 @@ class EventLogRoutesRegistry(DynamicDocument):
     path = StringField(required=True, unique=True)
     event_log = DictField(required=True)
     event_log_data = DictField(required=True)
+    # priority class of the route in the priority execution mode, e.g. realtime or bulk
+    priority = StringField()
     meta = {
         "collection": "event_log_routes_registry",
         }
\ No newline at end of file
@@ -0,0 +1,86 @@
+import time
+import threading
+from .models import EventLogRoutesRegistry
+
+
+class MongoRouteRegistry(object):
+    """Looks up the event spec of a request path in the event_log_routes_registry collection.
+
+    Specs found are cached for cache_ttl seconds, and preload fills the cache
+    with every registered route at startup so the first messages do not wait
+    on Mongo. A cache_ttl of 0 queries Mongo on every lookup. The priority
+    class of every route read is kept for cached_priority.
+
+    :param float cache_ttl: Seconds a cached spec is used before it is read again
+
+    """
+
+    def __init__(self, cache_ttl=0):
+        self.cache_ttl = cache_ttl
+        self._cache = {}
+        self._priorities = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, event):
+        return (event.event_log_data, event.event_log, event.zoho_module_name), time.monotonic() + self.cache_ttl
+
+    def preload(self):
+        """Cache every registered route, returns the number of routes loaded."""
+        if not self.cache_ttl:
+            return 0
+        events = list(EventLogRoutesRegistry.objects)
+        entries = dict((event.path, self._entry(event)) for event in events)
+        with self._lock:
+            self._cache.update(entries)
+            self._priorities.update((event.path, event.priority) for event in events)
+        return len(entries)
+
+    def lookup(self, url_path):
+        cached = self._cache.get(url_path)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        event = EventLogRoutesRegistry.objects.filter(path = url_path).first()
+        if event:
+            self._priorities[url_path] = event.priority
+            if self.cache_ttl:
+                with self._lock:
+                    self._cache[url_path] = self._entry(event)
+            return event.event_log_data, event.event_log, event.zoho_module_name
+        return {}, {}, {}
+
+    def cached_priority(self, url_path):
+        """Priority class of a route already read from Mongo, without querying it,
+        None for routes not read yet or without one."""
+        return self._priorities.get(url_path)
+
+
+class InMemoryRouteRegistry(object):
+    """Route registry backed by a plain dict, used by benchmarks and offline tools.
+
+    :param dict routes: Maps a request path to a dict with the event_log_data,
+            event_log and zoho_module_name keys of an EventLogRoutesRegistry document
+
+    """
+
+    def __init__(self, routes=None):
+        self._routes = dict(routes or {})
+
+    def add_route(self, url_path, event_log_data, event_log, zoho_module_name="Users_Data", priority=None):
+        self._routes[url_path] = {
+            "event_log_data": event_log_data,
+            "event_log": event_log,
+            "zoho_module_name": zoho_module_name,
+            "priority": priority
+        }
+
+    def preload(self):
+        return len(self._routes)
+
+    def lookup(self, url_path):
+        route = self._routes.get(url_path)
+        if route:
+            return route["event_log_data"], route["event_log"], route.get("zoho_module_name", "Users_Data")
+        return {}, {}, {}
+
+    def cached_priority(self, url_path):
+        return (self._routes.get(url_path) or {}).get("priority")
@@ -0,0 +1,287 @@
+import os
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import logging
+import tempfile
+import threading
+
+import umsgpack
+
+from .models import EventLogRoutesRegistry
+
+logger = logging.getLogger("marketing_auto_router")
+
+MAGIC = b"ECRS"
+FORMAT_VERSION = 1
+# magic, format version, flags, generation, created at, index offset, index length
+HEADER = struct.Struct("<4sHHQdQQ")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def export_routes(compile_projection=None):
+    """Read every registered route from Mongo as the entries of a snapshot.
+
+    :param callable compile_projection: Compiles the projection tree of an
+            event_log_data, stored with the route so the workers do not compile it
+    :return: dict mapping a request path to its route
+
+    """
+    routes = {}
+    for event in EventLogRoutesRegistry.objects:
+        route = {
+            "event_log_data": event.event_log_data,
+            "event_log": event.event_log,
+            "zoho_module_name": event.zoho_module_name,
+            "priority": event.priority,
+        }
+        if compile_projection is not None:
+            route["projection"] = compile_projection(event.event_log_data)
+        routes[event.path] = route
+    return routes
+
+
+def pack_snapshot(routes, generation, created_at=None):
+    """Lay out routes as a snapshot file: a fixed header, one msgpack blob per
+    route and an index of the path, offset, length and priority of every blob,
+    so a reader decodes the index alone and a route when it is looked up."""
+    blobs = []
+    index = {}
+    offset = HEADER.size
+    for path in sorted(routes):
+        blob = umsgpack.packb(routes[path])
+        index[path] = [offset, len(blob), routes[path].get("priority")]
+        blobs.append(blob)
+        offset += len(blob)
+    index_blob = umsgpack.packb(index)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, generation,
+                         time.time() if created_at is None else created_at, offset, len(index_blob))
+    return header + b"".join(blobs) + index_blob
+
+
+def read_header(data, size=None):
+    """Header fields of a snapshot, raises SnapshotError when it is not one this
+    version can read. size is the size of the file when data is its header alone."""
+    size = len(data) if size is None else size
+    if len(data) < HEADER.size:
+        raise SnapshotError("Truncated route snapshot header")
+    magic, version, _flags, generation, created_at, index_offset, index_length = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise SnapshotError("Not a route snapshot")
+    if version != FORMAT_VERSION:
+        raise SnapshotError("Route snapshot format {} is not supported, expected {}".format(version, FORMAT_VERSION))
+    if index_offset + index_length > size:
+        raise SnapshotError("Truncated route snapshot")
+    return generation, created_at, index_offset, index_length
+
+
+def write_snapshot(path, routes, generation):
+    """Write a snapshot next to path and move it in place, readers see either the
+    previous file or the new one whole."""
+    data = pack_snapshot(routes, generation)
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=".routes-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return len(data)
+
+
+class _MappedSnapshot(object):
+
+    def __init__(self, path):
+        with open(path, "rb") as snapshot_file:
+            stat = os.fstat(snapshot_file.fileno())
+            self.map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.generation, self.created_at, index_offset, index_length = read_header(self.map)
+        self.index = umsgpack.unpackb(self.map[index_offset:index_offset + index_length])
+        self.decoded = {}
+
+    def route(self, url_path):
+        route = self.decoded.get(url_path)
+        if route is None:
+            entry = self.index.get(url_path)
+            if entry is None:
+                return None
+            offset, length = entry[0], entry[1]
+            route = self.decoded[url_path] = umsgpack.unpackb(self.map[offset:offset + length])
+        return route
+
+
+class SnapshotRouteRegistry(object):
+    """Route registry read from a snapshot file shared by every process of a host.
+
+    The file is memory mapped read only, so its pages are shared through the
+    page cache, and only its index is decoded when it is loaded: a route is
+    decoded the first time it is looked up. The file is checked for a new
+    version at most every check_interval seconds and remapped when it was
+    replaced. Routing does not touch Mongo while a snapshot is available, so
+    it keeps working through Mongo outages, with the routes of the last
+    snapshot. Until a first snapshot is written, or when it can not be read,
+    lookups go to the fallback registry.
+
+    :param str path: The snapshot file, written by RouteSnapshotWatcher
+    :param fallback: Registry used without a snapshot, e.g. a MongoRouteRegistry
+    :param callable on_decode: Called with the path and the route dict of every
+            route decoded, e.g. to seed its compiled projection
+    :param float check_interval: Seconds between two checks of the file
+
+    """
+
+    def __init__(self, path, fallback=None, on_decode=None, check_interval=1.0):
+        self.path = path
+        self.fallback = fallback
+        self.on_decode = on_decode
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._failed = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _current(self):
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval and self._lock.acquire(blocking=False):
+            try:
+                self._checked_at = now
+                self._reload()
+            finally:
+                self._lock.release()
+        return self._snapshot
+
+    def _reload(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if identity == self._failed or (self._snapshot is not None and self._snapshot.identity == identity):
+            return
+        try:
+            snapshot = _MappedSnapshot(self.path)
+        except (OSError, ValueError, SnapshotError, umsgpack.UnpackException) as e:
+            self._failed = identity
+            logger.error("Could not load the route snapshot %s, keeping the previous routes: %s", self.path, e)
+            return
+        # lookups holding the previous mapping finish with it, it is closed once unreferenced
+        self._snapshot = snapshot
+        logger.info("Loaded route snapshot %s generation %s with %s routes, written %.0fs ago",
+                    self.path, snapshot.generation, len(snapshot.index), time.time() - snapshot.created_at)
+
+    def preload(self):
+        self._checked_at = 0.0
+        snapshot = self._current()
+        if snapshot is None:
+            return self.fallback.preload() if self.fallback is not None else 0
+        return len(snapshot.index)
+
+    def lookup(self, url_path):
+        snapshot = self._current()
+        if snapshot is None:
+            return self.fallback.lookup(url_path) if self.fallback is not None else ({}, {}, {})
+        cached = url_path in snapshot.decoded
+        route = snapshot.route(url_path)
+        if route is None:
+            return {}, {}, {}
+        if not cached and self.on_decode is not None:
+            self.on_decode(url_path, route)
+        return route["event_log_data"], route["event_log"], route["zoho_module_name"]
+
+    def cached_priority(self, url_path):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.fallback.cached_priority(url_path) if self.fallback is not None else None
+        entry = snapshot.index.get(url_path)
+        return entry[2] if entry else None
+
+
+class RouteSnapshotWatcher(object):
+    """Refreshes the route snapshot of a host from Mongo.
+
+    Every process may run a watcher, the one holding an exclusive lock on
+    path + ".lock" does the work and the others wait for the lock, so a host
+    reads the registry once per interval whatever its process count, and
+    another process takes over when the holder exits. The file is rewritten,
+    with the next generation, only when the routes changed. A failed refresh,
+    e.g. during a Mongo outage, leaves the last snapshot in place.
+
+    :param str path: The snapshot file
+    :param float interval: Seconds between two refreshes
+    :param callable compile_projection: Passed to export_routes
+
+    """
+
+    def __init__(self, path, interval=60.0, compile_projection=None):
+        self.path = path
+        self.interval = interval
+        self.compile_projection = compile_projection
+        self._lock_file = None
+        self._digest = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name="route-snapshot-watcher", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _acquire(self):
+        if self._lock_file is not None:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        logger.info("Refreshing the route snapshot %s every %ss", self.path, self.interval)
+        return True
+
+    def _run(self):
+        wait = 0
+        while not self._stopped.wait(wait):
+            wait = self.interval
+            try:
+                if self._acquire():
+                    self.refresh()
+            except Exception as e:
+                logger.error("Could not refresh the route snapshot %s: %s", self.path, e)
+
+    def _generation(self):
+        try:
+            with open(self.path, "rb") as snapshot_file:
+                return read_header(snapshot_file.read(HEADER.size), os.fstat(snapshot_file.fileno()).st_size)[0]
+        except (OSError, SnapshotError):
+            return 0
+
+    def refresh(self):
+        """Export the routes and write them when they changed, returns the
+        generation written or None."""
+        routes = export_routes(self.compile_projection)
+        digest = hashlib.sha1(umsgpack.packb([[path, routes[path]] for path in sorted(routes)])).digest()
+        if digest == self._digest and os.path.exists(self.path):
+            return None
+        generation = self._generation() + 1
+        size = write_snapshot(self.path, routes, generation)
+        self._digest = digest
+        logger.info("Wrote route snapshot %s generation %s: %s routes, %s bytes", self.path, generation, len(routes), size)
+        return generation
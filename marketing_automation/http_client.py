@@ -0,0 +1,290 @@
+import os
+import time
+import logging
+import threading
+import collections
+import requests
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from config import Config
+from monitoring.metrics import SINK_HEDGES
+
+logger = logging.getLogger("marketing_auto_router")
+
+# latencies kept per sink for the hedge delay, and needed before hedging
+LATENCY_WINDOW = 256
+MIN_LATENCY_SAMPLES = 32
+
+_session = None
+_session_lock = threading.Lock()
+_local = threading.local()
+_latencies = {}
+_hedge_pool = None
+_hedge_budget = None
+
+
+def get_session():
+    """Process wide requests.Session shared by the Upshot and Zoho sinks.
+
+    The session keeps connections alive in a pool sized by HTTP_POOL_SIZE, so
+    a message does not pay for a new TCP and TLS handshake per sink call. It is
+    created on first use and dropped in forked children, which build their own.
+
+    :rtype: requests.Session
+
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                pool_size = int(Config.HTTP_POOL_SIZE)
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+class DeadlineExceeded(requests.Timeout):
+    """The budget of an event ran out before one of its sink calls."""
+
+
+class Deadline(object):
+    """Time budget of an event, shared by the sink calls it makes.
+
+    Each call may take the time left divided by the calls left, so a slow
+    first sink does not leave nothing for the next one.
+
+    :param float seconds: The budget
+    :param int calls: Sink calls the budget is split across
+
+    """
+
+    def __init__(self, seconds, calls=1):
+        self.expires_at = time.monotonic() + seconds
+        self.calls = max(1, calls)
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def next_call(self):
+        """Seconds the next call may take, raises DeadlineExceeded when none are left."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("Event deadline exceeded")
+        share = remaining / self.calls
+        self.calls = max(1, self.calls - 1)
+        return share
+
+
+@contextmanager
+def event_deadline(seconds=None, calls=1):
+    """Run the sink calls made by the current thread within a Deadline.
+
+    A deadline already running on the thread is kept, an inner one can not
+    extend it.
+
+    :param float seconds: The budget, EVENT_DEADLINE_SECONDS by default, 0 has none
+    :param int calls: Sink calls the budget is split across
+
+    """
+    seconds = float(Config.EVENT_DEADLINE_SECONDS) if seconds is None else seconds
+    outer = getattr(_local, "deadline", None)
+    if outer is not None or not seconds:
+        yield outer
+        return
+    _local.deadline = Deadline(seconds, calls)
+    try:
+        yield _local.deadline
+    finally:
+        _local.deadline = None
+
+
+class LatencyWindow(object):
+    """The last LATENCY_WINDOW latencies of a sink, for its hedge delay."""
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self._samples = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q):
+        """The q quantile of the window, None until it holds MIN_LATENCY_SAMPLES."""
+        with self._lock:
+            if len(self._samples) < MIN_LATENCY_SAMPLES:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def _latency_window(sink):
+    window = _latencies.get(sink)
+    if window is None:
+        window = _latencies.setdefault(sink, LatencyWindow())
+    return window
+
+
+class HedgeBudget(object):
+    """Caps hedges at a share of the calls, so a slow sink does not get its load
+    doubled when it is already struggling.
+
+    Every call earns percent / 100 of a hedge, up to burst unspent ones, and
+    a hedge spends one.
+
+    :param float percent: Hedges allowed per 100 calls
+    :param float burst: Hedges that may be saved up while calls are fast
+
+    """
+
+    def __init__(self, percent=10.0, burst=10.0):
+        self.rate = percent / 100.0
+        self.burst = burst
+        self._tokens = burst
+        self._lock = threading.Lock()
+
+    def earn(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.rate)
+
+    def available(self):
+        return self._tokens >= 1.0
+
+    def spend(self):
+        with self._lock:
+            if self._tokens < 1.0:
+                return False
+            self._tokens -= 1.0
+            return True
+
+
+def _get_hedge_pool():
+    global _hedge_pool, _hedge_budget
+    if _hedge_pool is None:
+        with _session_lock:
+            if _hedge_pool is None:
+                _hedge_budget = HedgeBudget(float(Config.HTTP_HEDGE_BUDGET_PERCENT))
+                _hedge_pool = ThreadPoolExecutor(max_workers=int(Config.HTTP_POOL_SIZE), thread_name_prefix="sink-hedge")
+    return _hedge_pool
+
+
+def _timed_request(method, url, sink, timeout, kwargs):
+    started_at = time.perf_counter()
+    response = get_session().request(method, url, timeout=timeout, **kwargs)
+    _latency_window(sink).add(time.perf_counter() - started_at)
+    return response
+
+
+def _send_hedge(primary_done, send_at, expires_at, method, url, sink, timeout, kwargs):
+    # the wait counts from the start of the first call, whatever time this spent queued
+    if primary_done.wait(max(0.0, send_at - time.monotonic())):
+        return None
+    if expires_at is not None:
+        left = expires_at - time.monotonic()
+        if left <= 0:
+            return None
+        timeout = (min(timeout[0], left), min(timeout[1], left))
+    if not _hedge_budget.spend():
+        SINK_HEDGES.inc(sink=sink, outcome="over_budget")
+        return None
+    SINK_HEDGES.inc(sink=sink, outcome="sent")
+    return _timed_request(method, url, sink, timeout, kwargs)
+
+
+def send(method, url, sink, idempotent=False, **kwargs):
+    """Make a sink call with connect and read timeouts, hedged when allowed.
+
+    The timeouts are HTTP_CONNECT_TIMEOUT_SECONDS and HTTP_READ_TIMEOUT_SECONDS,
+    cut to the share of the event deadline of the current thread, if any, that
+    is left for this call. With HTTP_HEDGING on, an idempotent call that has not
+    answered within the HTTP_HEDGE_QUANTILE latency of its sink is sent a second
+    time from the hedge pool, within HTTP_HEDGE_BUDGET_PERCENT of the calls and
+    with what is left of the share of the first call. The first call runs on
+    the calling thread and its response is used when it succeeds, the hedge is
+    left to finish. When it fails, the response of the hedge is used instead.
+
+    :param str method: HTTP method
+    :param str url: Request url
+    :param str sink: Name the latencies of the call are kept under
+    :param bool idempotent: Whether sending the call twice is harmless
+    :return: The requests.Response
+    :raises DeadlineExceeded: When the deadline of the event already passed
+
+    """
+    connect_timeout, read_timeout = float(Config.HTTP_CONNECT_TIMEOUT_SECONDS), float(Config.HTTP_READ_TIMEOUT_SECONDS)
+    deadline = getattr(_local, "deadline", None)
+    if deadline is not None:
+        share = deadline.next_call()
+        connect_timeout, read_timeout = min(connect_timeout, share), min(read_timeout, share)
+    timeout = (connect_timeout, read_timeout)
+    started_at = time.monotonic()
+
+    delay = None
+    if idempotent and Config.HTTP_HEDGING.lower() == "true":
+        delay = _latency_window(sink).quantile(float(Config.HTTP_HEDGE_QUANTILE))
+    if delay is None:
+        return _timed_request(method, url, sink, timeout, kwargs)
+
+    pool = _get_hedge_pool()
+    _hedge_budget.earn()
+    if not _hedge_budget.available():
+        return _timed_request(method, url, sink, timeout, kwargs)
+    primary_done = threading.Event()
+    send_at = started_at + max(delay, float(Config.HTTP_HEDGE_MIN_DELAY_MS) / 1000.0)
+    expires_at = started_at + read_timeout if deadline is not None else None
+    hedge = pool.submit(_send_hedge, primary_done, send_at, expires_at, method, url, sink, timeout, kwargs)
+    try:
+        return _timed_request(method, url, sink, timeout, kwargs)
+    except Exception:
+        primary_done.set()
+        if hedge.cancel():
+            raise
+        try:
+            response = hedge.result()
+        except Exception:
+            response = None
+        if response is None:
+            raise
+        SINK_HEDGES.inc(sink=sink, outcome="won")
+        return response
+    finally:
+        primary_done.set()
+
+
+def open_pools(urls, timeout=5):
+    """Open a pooled connection to every url ahead of the first message.
+
+    Any response, even an error status, leaves a warm connection in the pool,
+    so only connection failures are logged.
+
+    :param list urls: Base urls of the sinks
+    :param float timeout: Seconds to wait for each host
+    :return: Number of hosts that could be reached
+
+    """
+    session = get_session()
+    reached = 0
+    for url in urls:
+        try:
+            session.head(url, timeout=timeout)
+            reached += 1
+        except requests.RequestException as e:
+            logger.warning("Could not open a connection to %s: %s", url, e)
+    return reached
+
+
+def _reset_after_fork():
+    global _session, _session_lock, _local, _hedge_pool, _hedge_budget
+    _session = None
+    _session_lock = threading.Lock()
+    _local = threading.local()
+    _hedge_pool = None
+    _hedge_budget = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,22 +1,47 @@
 import jwt
-import json
 import logging
 import datetime
-from .utils import catch_exceptions
+from concurrent.futures import Future
+from .utils import catch_exceptions, all_of
 from .zoho.zoho_crm import ZohoCRM
 from .upshot.upshot_events import Upshot 
+from .outbox import get_outbox, deliver_record
+from .http_client import event_deadline
+from .serializer import LazyJSON
 from config import Config, logging_config
-from database.models import EventLogRoutesRegistry
+from database.route_registry import MongoRouteRegistry
+from database.route_snapshot import SnapshotRouteRegistry
+from .projection import seed_projection
+from monitoring.metrics import STAGE_SECONDS
 
 logger = logging.getLogger("marketing_auto_router")
 
+PARTITION_KEYS = ("account_id", "user")
+
+def _default_route_registry():
+    registry = MongoRouteRegistry(cache_ttl=float(Config.ROUTE_CACHE_TTL_SECONDS))
+    if Config.ROUTE_SNAPSHOT_PATH:
+        # Mongo is only read until the first snapshot of the host is written
+        registry = SnapshotRouteRegistry(Config.ROUTE_SNAPSHOT_PATH, fallback=registry, on_decode=seed_projection)
+    return registry
+
+_route_registry = _default_route_registry()
+
+
+def set_route_registry(registry):
+    """Replace the registry used to find the spec of a request path, e.g. with an
+    InMemoryRouteRegistry when running without Mongo."""
+    global _route_registry
+    _route_registry = registry
+
+def preload_routes():
+    """Load the route specs ahead of the first message, returns how many were loaded."""
+    return _route_registry.preload()
+
 @catch_exceptions
 def get_spec_from_db(url_path):
-    event = EventLogRoutesRegistry.objects.filter(path = url_path)
-    if event:
-        return event[0].event_log_data, event[0].event_log, event[0].zoho_module_name
-    else:
-        return {}, {}, {}
+    with STAGE_SECONDS.time(stage="spec_lookup"):
+        return _route_registry.lookup(url_path)
 
 @catch_exceptions
 def decode_jwt_token(token):
@@ -27,58 +52,208 @@ def decode_jwt_token(token):
         'verify_iat': False,
         'verify_aud': False
     }
-    decoded_jwt = jwt.decode(token,Config.JWT_TOKEN,algorithms=['HS256'],options=jwt_options)    
+    with STAGE_SECONDS.time(stage="jwt_decode"):
+        decoded_jwt = jwt.decode(token,Config.JWT_TOKEN,algorithms=['HS256'],options=jwt_options)    
     return decoded_jwt
 
+def _token_of(queue_message):
+    headers = (queue_message.get("request") or {}).get("headers") or {}
+    token = headers.get("authorization") or headers.get("Authorization")
+    if token:
+        return token.replace("Bearer ", "")
+    response_data = (queue_message.get("response") or {}).get("data") or {}
+    return response_data.get("token") if isinstance(response_data, dict) else None
+
 @catch_exceptions
-def router(queue_message):
+def partition_key(queue_message, key="account_id"):
+    """Value the events of a message are ordered by in the partitioned execution mode.
+
+    account_id is response.data.account_id, or else the account_id claim of
+    the JWT of the message. user is the user_id claim of the JWT, or else
+    response.data.user_id. Messages without one, like etl_segment ones,
+    return None and are not ordered.
+
+    :param dict queue_message: The decoded message
+    :param str key: One of PARTITION_KEYS
+
+    """
+    if not isinstance(queue_message, dict) or "type" in queue_message:
+        return None
+    response_data = (queue_message.get("response") or {}).get("data") or {}
+    if not isinstance(response_data, dict):
+        response_data = {}
+    if key == "account_id" and response_data.get("account_id"):
+        return response_data["account_id"]
+    token = _token_of(queue_message)
+    claims = decode_jwt_token(token) if token else None
+    if claims:
+        value = claims.get("account_id") if key == "account_id" else claims.get("user_id")
+        if value:
+            return value
+    return response_data.get("user_id") if key == "user" else None
+
+def priority_class(queue_message):
+    """Priority class of a message in the priority execution mode.
+
+    Typed jobs like etl_segment are in PRIORITY_JOB_CLASS, events in the class
+    their route has in the registry. The registry is not queried, a route it
+    did not read yet has no class and runs in the default one.
+
+    """
+    if not isinstance(queue_message, dict):
+        return None
+    if "type" in queue_message:
+        return Config.PRIORITY_JOB_CLASS
+    url = (queue_message.get("request") or {}).get("url")
+    return _route_registry.cached_priority(url) if url is not None else None
+
+def _prepare_event(queue_message, route_spec=None):
+    """Decode the JWT of an event and find its spec, the steps router takes
+    before calling the sinks. Returns None when the route is not registered,
+    otherwise a tuple of whether the event comes from a test server and the spec.
+    """
     testing = False
+    if "authorization" in queue_message["request"].get("headers", {}): #for nodejs
+        queue_message["request"]["headers"]["jwt"] = decode_jwt_token(queue_message["request"]["headers"]["authorization"].replace("Bearer ",""))
+        logger.event_debug("got jwt token ---------------- %s ", LazyJSON(queue_message["request"]["headers"]["jwt"]) )
+        if queue_message["request"]["headers"]["jwt"] and "vdezi_server" in queue_message["request"]["headers"]["jwt"] and queue_message["request"]["headers"]["jwt"]["vdezi_server"]!="vdeziproduction":
+            testing = True
+
+    elif "Authorization" in queue_message["request"].get("headers", {}): #for python 
+        queue_message["request"]["headers"]["jwt"] = decode_jwt_token(queue_message["request"]["headers"]["Authorization"].replace("Bearer ",""))
+        logger.event_debug("got jwt token ----------------- %s ", LazyJSON(queue_message["request"]["headers"]["jwt"]) )
+        if queue_message["request"]["headers"]["jwt"] and "vdezi_server" in queue_message["request"]["headers"]["jwt"] and queue_message["request"]["headers"]["jwt"]["vdezi_server"]!="vdeziproduction":
+            testing = True
+
+
+    elif queue_message.get("response",{}).get("data",{}):
+        if "token" in queue_message["response"]["data"]:
+            queue_message["request"]["headers"]["jwt"] = decode_jwt_token(queue_message["response"]["data"]["token"])
+
+    event_log_data, available_event_log, zoho_module = route_spec or get_spec_from_db(queue_message["request"]["url"])
+
+    if not event_log_data:
+        logger.event_debug("No event log data found")
+        return None
+
+    current_date = datetime.date.today()
+    if "response" in queue_message:
+        queue_message["response"]["current_date_and_time"]= current_date.isoformat()
+    if "response" in queue_message and queue_message["response"].get("status",""):
+        queue_message["response"]["status"]=str(queue_message["response"]["status"]) 
+    if "error" in queue_message and "status" in queue_message["error"]:
+        queue_message["error"]["status"]=str(queue_message["error"]["status"]) 
+
+    return testing, (event_log_data, available_event_log, zoho_module)
+
+@catch_exceptions
+def router(queue_message, route_spec=None, dry_run=False):
+    """Send an event to the sinks its route is registered for.
+
+    :param dict queue_message: The decoded message
+    :param tuple route_spec: The result of get_spec_from_db for the url of the
+            message, when the caller already looked it up for a batch
+    :param bool dry_run: Only build the sink payloads, returns whether all of
+            them could be built
+    :return: True, or a Future resolved with whether the sinks took the message
+            when its Zoho update was handed to the upsert coalescer or its
+            payloads to the outbox
+
+    """
+    pending = []
     if "type" in queue_message:
+        if dry_run:
+            return True
         logger.event_debug("queue message --> %s",queue_message )
         if queue_message["type"] == "etl_segment":
             crm = ZohoCRM() 
             logger.event_debug("Done with etl_segment " )
 
     else:
-        if "authorization" in queue_message["request"].get("headers", {}): #for nodejs
-            queue_message["request"]["headers"]["jwt"] = decode_jwt_token(queue_message["request"]["headers"]["authorization"].replace("Bearer ",""))
-            logger.event_debug("got jwt token ---------------- %s ", json.dumps(queue_message["request"]["headers"]["jwt"]) )
-            if queue_message["request"]["headers"]["jwt"] and "vdezi_server" in queue_message["request"]["headers"]["jwt"] and queue_message["request"]["headers"]["jwt"]["vdezi_server"]!="vdeziproduction":
-                testing = True
+        prepared = _prepare_event(queue_message, route_spec)
+        if prepared is None:
+            return True
+        testing, (event_log_data, available_event_log, zoho_module) = prepared
 
-        elif "Authorization" in queue_message["request"].get("headers", {}): #for python 
-            queue_message["request"]["headers"]["jwt"] = decode_jwt_token(queue_message["request"]["headers"]["Authorization"].replace("Bearer ",""))
-            logger.event_debug("got jwt token ----------------- %s ", json.dumps(queue_message["request"]["headers"]["jwt"]) )
-            if queue_message["request"]["headers"]["jwt"] and "vdezi_server" in queue_message["request"]["headers"]["jwt"] and queue_message["request"]["headers"]["jwt"]["vdezi_server"]!="vdeziproduction":
-                testing = True
+        if dry_run:
+            built = True
+            if available_event_log and available_event_log["in_upshot"]:
+                built = Upshot().create_payload_upshot(queue_message, event_log_data["upshot"]) is not None
+            if available_event_log and available_event_log["in_zoho"]:
+                built = built and ZohoCRM().create_payload_for_zoho(queue_message, event_log_data.get("zoho",{})) is not None
+            return built
 
+        sinks = [sink for sink in ("in_upshot", "in_zoho") if available_event_log and available_event_log[sink]]
+        with event_deadline(calls=len(sinks)):
+            if "in_upshot" in sinks:
+                upshot = Upshot()
+                response_upshot = upshot.upshot_add_event(queue_message, event_log_data["upshot"],testing = testing)
+                logger.event_debug("Done with upshot" )
+                if isinstance(response_upshot, Future):
+                    pending.append(response_upshot)
 
-        elif queue_message.get("response",{}).get("data",{}):
-            if "token" in queue_message["response"]["data"]:
-                queue_message["request"]["headers"]["jwt"] = decode_jwt_token(queue_message["response"]["data"]["token"])
+            if "in_zoho" in sinks:
+                crm = ZohoCRM() 
+                response_zoho = crm.zoho_add_event(queue_message, event_log_data.get("zoho",{}), zoho_module)
+                logger.event_debug("disabled zoho")
+                if isinstance(response_zoho, Future):
+                    pending.append(response_zoho)
 
-        event_log_data, available_event_log, zoho_module = get_spec_from_db(queue_message["request"]["url"])
+        if pending:
+            return all_of(pending)
 
-        if not event_log_data:
-            logger.event_debug("No event log data found")
-            return True
-            
-        current_date = datetime.date.today()
-        if "response" in queue_message:
-            queue_message["response"]["current_date_and_time"]= current_date.isoformat()
-        if "response" in queue_message and queue_message["response"].get("status",""):
-            queue_message["response"]["status"]=str(queue_message["response"]["status"]) 
-        if "error" in queue_message and "status" in queue_message["error"]:
-            queue_message["error"]["status"]=str(queue_message["error"]["status"]) 
-
-        if  available_event_log and available_event_log["in_upshot"]:
-            upshot = Upshot()
-            response_upshot = upshot.upshot_add_event(queue_message, event_log_data["upshot"],testing = testing)
-            logger.event_debug("Done with upshot" )
-
-        if available_event_log and available_event_log["in_zoho"]:
-            crm = ZohoCRM() 
-            response_zoho = crm.zoho_add_event(queue_message, event_log_data.get("zoho",{}), zoho_module)
-            logger.event_debug("disabled zoho")
+    return True
+
+@catch_exceptions
+def build_sink_records(queue_message, route_spec=None):
+    """The CPU bound half of router: decode the JWT and run the transforms of
+    the sinks, without calling them.
+
+    :param dict queue_message: The decoded message
+    :param tuple route_spec: The result of get_spec_from_db for the url of the message
+    :return: The sink calls of the message as outbox records, see send_sink_records
+
+    """
+    if "type" in queue_message:
+        return []
+    prepared = _prepare_event(queue_message, route_spec)
+    if prepared is None:
+        return []
+    testing, (event_log_data, available_event_log, zoho_module) = prepared
+    route = queue_message["request"].get("url", "")
+
+    records = []
+    if available_event_log and available_event_log["in_upshot"]:
+        payload = Upshot().create_payload_upshot(queue_message, event_log_data["upshot"])
+        if payload is not None:
+            records.append({"sink": "upshot", "payload": payload, "testing": testing, "route": route})
+    if available_event_log and available_event_log["in_zoho"]:
+        payload = ZohoCRM().create_payload_for_zoho(queue_message, event_log_data.get("zoho",{}))
+        if payload and payload['data']!=[{}]:
+            records.append({"sink": "zoho", "module": zoho_module, "payload": payload, "route": route})
+    return records
+
+def send_sink_records(records):
+    """The I/O bound half of router: send the records of build_sink_records,
+    through the outbox or the Zoho upsert coalescer when they are on.
+
+    :return: True, or a Future like router
 
+    """
+    outbox = get_outbox()
+    crm = ZohoCRM()
+    pending = []
+    with event_deadline(calls=len(records)):
+        for record in records:
+            if outbox:
+                pending.append(outbox.append(record))
+            elif record["sink"] == "zoho" and crm.coalescer:
+                pending.append(crm.coalescer.add(record["module"], record["payload"]["data"]))
+            else:
+                try:
+                    deliver_record(record)
+                except Exception as e:
+                    logger.error("Could not send to %s for %s: %s", record["sink"], record["route"], e, exc_info=True)
+    if pending:
+        return all_of(pending)
     return True
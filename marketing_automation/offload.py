@@ -0,0 +1,51 @@
+import time
+import umsgpack
+from types import SimpleNamespace
+from message_queue.codec import decode_body
+from message_queue.dedup import fingerprint
+from . import marketing_auto_router
+from .projection import project
+
+
+def prepare_message(body, projection=False, dedup=False, message_id=None, timestamp=None):
+    """Run the CPU bound stages of a message, in a transform process.
+
+    The message is decoded, projected when PAYLOAD_PROJECTION is on, and
+    turned into its sink records by build_sink_records. Only bytes cross the
+    process boundary: the raw body in, the packed result out.
+
+    :param bytes body: The raw message body
+    :param bool projection: Project the message on its route spec first
+    :param bool dedup: Also compute the fingerprint of the message
+    :param message_id: The AMQP message_id property, for the fingerprint
+    :param timestamp: The AMQP timestamp property, for the fingerprint
+    :return: msgpack of a dict with the fingerprint, the records (None when
+            the transforms failed) and the seconds spent decoding and routing,
+            which the metrics of the transform process would not export.
+            None when the body can not be decoded
+
+    """
+    started_at = time.perf_counter()
+    event_data = decode_body(body)
+    if not event_data:
+        return None
+    decoded_at = time.perf_counter()
+
+    key = None
+    if dedup:
+        key = fingerprint(event_data, SimpleNamespace(message_id=message_id, timestamp=timestamp), body)
+
+    route_spec = None
+    if isinstance(event_data, dict) and "type" not in event_data:
+        url = (event_data.get("request") or {}).get("url")
+        route_spec = marketing_auto_router.get_spec_from_db(url) if url is not None else None
+        if projection and route_spec and route_spec[0]:
+            event_data = project(event_data, url, route_spec[0])
+
+    records = marketing_auto_router.build_sink_records(event_data, route_spec)
+    return umsgpack.packb({
+        "fingerprint": key,
+        "records": records,
+        "decode_seconds": decoded_at - started_at,
+        "route_seconds": time.perf_counter() - decoded_at
+    })
@@ -0,0 +1,295 @@
+import os
+import fcntl
+import random
+import logging
+import threading
+import umsgpack
+from concurrent.futures import ThreadPoolExecutor, wait
+from config import Config
+from message_queue.spool import SegmentedLog
+from monitoring.metrics import OUTBOX_BACKLOG_BYTES, OUTBOX_RETRIES, OUTBOX_DEAD_LETTERS
+
+logger = logging.getLogger("marketing_auto_router")
+
+MAX_RETRY_BACKOFF = 60.0
+
+SPOOL_PREFIX = "spool-"
+# under each spool, a log of the records that ran out of attempts
+DEAD_LETTER_DIR = "dead-letter"
+
+# Zoho answers with these codes when the same upsert may succeed later
+ZOHO_RETRY_CODES = ("INVALID_TOKEN", "TOO_MANY_REQUESTS", "INTERNAL_ERROR")
+
+_outbox = None
+_outbox_lock = threading.Lock()
+# the spool directory locks, held for the life of the process
+_directory_locks = []
+
+
+def deliver_record(record):
+    """Send one spooled sink payload.
+
+    :param dict record: The record appended by Outbox.append
+    :return: True once the sink took the payload or rejected it for good,
+            False when the call should be retried
+
+    """
+    from .upshot.upshot_events import Upshot
+    from .zoho.zoho_crm import ZohoCRM
+
+    if record["sink"] == "upshot":
+        response = Upshot().post_add_events(record["payload"], record.get("testing", False), route=record.get("route", ""))
+        if response.status_code == 429 or response.status_code >= 500:
+            return False
+        if not response.ok:
+            logger.error("Upshot rejected a spooled event of %s: %s", record.get("route", ""), response.content)
+        return True
+
+    if record["sink"] == "zoho":
+        response = ZohoCRM().upsert_payload(record["module"], record["payload"], route=record.get("route", ""))
+        if response.get("code", "") in ZOHO_RETRY_CODES:
+            return False
+        response_data = response.get("data")
+        if not (isinstance(response_data, list) and response_data and response_data[0].get("code") == "SUCCESS"):
+            logger.error("Zoho rejected a spooled upsert to %s: %s", record["module"], response)
+        return True
+
+    logger.error("Dropping a spooled record of unknown sink %s", record["sink"])
+    return True
+
+
+class Outbox(object):
+    """Spools sink payloads so the message they came from can be acknowledged
+    as soon as they are on disk, and sends them in the background.
+
+    A reader thread takes up to batch_size records after the checkpoint of the
+    log, hands them to sender threads and moves the checkpoint past the batch
+    once every record of it is sent. A record that fails is retried with an
+    exponential backoff, so while a sink is down the backlog grows in the log
+    instead of holding messages unacknowledged in the broker. Records sent
+    before a crash but not yet checkpointed are sent again on restart. A
+    record that still fails after max_attempts is moved to the dead-letter
+    log of its spool, so it does not hold back the records after it.
+
+    With root set, the spools under it that no live process holds, e.g. left
+    by workers that are gone since the process count was lowered, are sent
+    too, every orphan_interval seconds.
+
+    :param SegmentedLog log: Where the records are kept
+    :param callable deliver: deliver(record) returns True once a record is done, see deliver_record
+    :param int senders: Records of a batch sent concurrently
+    :param int batch_size: Records read from the log at once
+    :param int max_attempts: Attempts before a record is dead lettered, 0 retries forever
+    :param float retry_backoff: Seconds before the first retry
+    :param str root: The directory of the spools of every worker, see _claim_directory
+    :param float orphan_interval: Seconds between two looks for spools left by other processes
+
+    """
+
+    def __init__(self, log, deliver=deliver_record, senders=4, batch_size=100, max_attempts=10, retry_backoff=0.5,
+                 root=None, orphan_interval=30.0):
+        self.log = log
+        self.deliver = deliver
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.root = root
+        self.orphan_interval = orphan_interval
+        self._dead_letter_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._senders = ThreadPoolExecutor(max_workers=senders, thread_name_prefix="outbox-sender")
+        self._reader = threading.Thread(target=self._run, name="outbox-reader", daemon=True)
+
+    @classmethod
+    def from_config(cls, config):
+        """Open the spool of this process under OUTBOX_DIR, None when the outbox is off."""
+        if not config.OUTBOX_DIR:
+            return None
+        log = SegmentedLog(_claim_directory(config.OUTBOX_DIR),
+                           segment_bytes=int(float(config.OUTBOX_SEGMENT_MB) * 1024 * 1024),
+                           sync_interval=float(config.OUTBOX_SYNC_INTERVAL_MS) / 1000.0)
+        return cls(log, senders=int(config.OUTBOX_SENDERS), batch_size=int(config.OUTBOX_BATCH_SIZE),
+                   max_attempts=int(config.OUTBOX_MAX_ATTEMPTS), retry_backoff=float(config.OUTBOX_RETRY_BACKOFF_MS) / 1000.0,
+                   root=config.OUTBOX_DIR, orphan_interval=float(config.OUTBOX_ORPHAN_SCAN_SECONDS))
+
+    def start(self):
+        self._reader.start()
+        if self.root and self.orphan_interval:
+            threading.Thread(target=self._adopt_orphans, name="outbox-orphans", daemon=True).start()
+        return self
+
+    def append(self, record):
+        """Spool a sink payload, returns a Future resolved with True once it is durable.
+
+        :param dict record: sink (upshot or zoho), payload, route and the
+                sink specific testing or module
+
+        """
+        return self.log.append(umsgpack.packb(record))
+
+    def _run(self):
+        position = self.log.checkpoint()
+        logger.info("Sending the outbox in %s from %s", self.log.directory, position)
+        while not self._stopping.is_set():
+            OUTBOX_BACKLOG_BYTES.set(self.log.backlog_bytes(position))
+            batch = self.log.read(position, self.batch_size)
+            if not batch:
+                self.log.wait(position, timeout=1.0)
+                continue
+            position = self._send_batch(self.log, batch)
+            if position is None:
+                break
+
+    def _send_batch(self, log, batch):
+        """Send the records of a batch and checkpoint log past them, returns the
+        new position, or None when stop interrupted the batch."""
+        futures = [self._senders.submit(self._send, log, record) for record, _ in batch]
+        wait(futures)
+        if any(future.result() is None for future in futures):
+            # the batch is sent again after a restart
+            return None
+        position = batch[-1][1]
+        try:
+            log.commit(position)
+        except Exception as e:
+            logger.error("Could not checkpoint the outbox in %s at %s: %s", log.directory, position, e)
+        return position
+
+    def _adopt_orphans(self):
+        while not self._stopping.wait(self.orphan_interval):
+            for directory in _spool_directories(self.root):
+                if directory == self.log.directory or self._stopping.is_set():
+                    continue
+                lock_file = _lock_directory(directory)
+                if lock_file is None:
+                    continue
+                try:
+                    self._drain(directory)
+                except Exception as e:
+                    logger.error("Could not send the outbox left in %s: %s", directory, e)
+                finally:
+                    # released, a worker started later may take the slot
+                    lock_file.close()
+
+    def _drain(self, directory):
+        log = SegmentedLog(directory, sync_interval=0)
+        try:
+            position = log.checkpoint()
+            if not log.backlog_bytes(position):
+                return
+            logger.info("Sending the outbox left in %s from %s", directory, position)
+            while position is not None:
+                batch = log.read(position, self.batch_size)
+                if not batch:
+                    logger.info("Sent the outbox left in %s", directory)
+                    return
+                position = self._send_batch(log, batch)
+        finally:
+            log.close()
+
+    def _dead_letter(self, log, data):
+        with self._dead_letter_lock:
+            dead_letters = SegmentedLog(os.path.join(log.directory, DEAD_LETTER_DIR), sync_interval=0)
+            try:
+                dead_letters.append(data).result()
+            finally:
+                dead_letters.close()
+
+    def _send(self, log, data):
+        record = umsgpack.unpackb(data)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if self.deliver(record):
+                    return True
+                error = "not accepted"
+            except Exception as e:
+                error = e
+            if self.max_attempts and attempt >= self.max_attempts:
+                logger.error("Dead lettering a spooled %s record of %s after %s attempts: %s",
+                             record.get("sink"), record.get("route", ""), attempt, error)
+                OUTBOX_DEAD_LETTERS.inc(sink=record.get("sink", ""))
+                try:
+                    self._dead_letter(log, data)
+                except Exception as e:
+                    logger.error("Could not dead letter the record, dropping it: %s", e)
+                return False
+            OUTBOX_RETRIES.inc(sink=record.get("sink", ""))
+            backoff = min(MAX_RETRY_BACKOFF, self.retry_backoff * 2 ** (attempt - 1))
+            logger.warning("Spooled %s record of %s failed (%s), retrying in %.1fs",
+                           record.get("sink"), record.get("route", ""), error, backoff)
+            if self._stopping.wait(backoff * random.uniform(0.5, 1.0)):
+                return None
+
+    def stop(self, timeout=None):
+        """Stop sending after the batch in progress, appends keep working."""
+        self._stopping.set()
+        if self._reader.is_alive():
+            self._reader.join(timeout)
+
+
+def _lock_directory(directory):
+    """The locked lock file of a spool directory, None when another process holds it."""
+    lock_file = open(os.path.join(directory, "lock"), "a")
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def _spool_directories(root):
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return []
+    return [os.path.join(root, name) for name in sorted(names)
+            if name.startswith(SPOOL_PREFIX) and os.path.isdir(os.path.join(root, name))]
+
+
+def _claim_directory(root):
+    """Lock the first free spool directory under root.
+
+    Every worker process needs a log of its own. The lock is released when
+    the process dies, so a restarted worker takes over, and resumes, the
+    spool its predecessor left. The spools of slots no worker takes any more
+    are sent by the orphan scan of Outbox.
+
+    """
+    os.makedirs(root, exist_ok=True)
+    slot = 0
+    while True:
+        directory = os.path.join(root, "{}{}".format(SPOOL_PREFIX, slot))
+        os.makedirs(directory, exist_ok=True)
+        lock_file = _lock_directory(directory)
+        if lock_file is None:
+            slot += 1
+            continue
+        _directory_locks.append(lock_file)
+        return directory
+
+
+def get_outbox():
+    """Process wide Outbox the sinks spool to, None unless OUTBOX_DIR is set.
+
+    It is opened, and starts sending what an earlier process left, on first use.
+
+    """
+    global _outbox
+    if _outbox is None and Config.OUTBOX_DIR:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = Outbox.from_config(Config).start()
+    return _outbox
+
+
+def _reset_after_fork():
+    global _outbox, _outbox_lock
+    _outbox = None
+    _outbox_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,153 @@
+import threading
+from monitoring.metrics import STAGE_SECONDS
+
+# fields the router, the dedup fingerprint and the partition key read
+ROUTER_FIELDS = (
+    "type",
+    "timestamp",
+    "request/url",
+    "request/headers/authorization",
+    "request/headers/Authorization",
+    "response/status",
+    "response/data/token",
+    "response/data/account_id",
+    "response/data/user_id",
+    "error/status",
+)
+
+KEEP = True
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+
+def _refs(node):
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == "ref" and isinstance(value, str):
+                yield value
+            else:
+                for ref in _refs(value):
+                    yield ref
+    elif isinstance(node, list):
+        for value in node:
+            for ref in _refs(value):
+                yield ref
+
+
+def _add_path(tree, segments):
+    for segment in segments[:-1]:
+        child = tree.get(segment)
+        if child is KEEP:
+            return
+        if child is None:
+            child = tree[segment] = {}
+        tree = child
+    tree[segments[-1]] = KEEP
+
+
+def _integration_paths(integration):
+    """Message paths referenced by one integration of a spec, None when one of
+    its references can not be followed."""
+    parameters = {}
+    definitions = ((integration.get("parameters") or {}).get("properties") or {})
+    for name, definition in definitions.items():
+        ref = definition.get("ref") if isinstance(definition, dict) else None
+        if ref is None:
+            continue
+        if not ref.startswith("outputs/"):
+            return None
+        parameters[name] = [segment for segment in ref.split("/")[1:] if segment]
+        if not parameters[name]:
+            return None
+
+    paths = []
+    for key, value in integration.items():
+        # the outputs of an integration refer to its own results, not to the message
+        if key in ("parameters", "outputs"):
+            continue
+        for ref in _refs(value):
+            segments = ref.split("/")
+            if segments[0] == "outputs":
+                paths.append(segments[1:])
+            elif segments[0] == "parameters" and len(segments) > 1 and segments[1] in parameters:
+                paths.append(parameters[segments[1]] + segments[2:])
+            else:
+                return None
+    return paths
+
+
+def compile_projection(event_log_data):
+    """Build the tree of message fields a route's spec references.
+
+    The refs of every upshot and zoho mapping are resolved through the
+    parameters of their integration to paths in the message, and the fields
+    in ROUTER_FIELDS are added. A leaf set to KEEP keeps the whole value.
+
+    :param dict event_log_data: The event_log_data of the route
+    :return: The tree, or None when the spec references the message in a way
+            that can not be followed, then the message must be kept whole
+
+    """
+    tree = {}
+    for path in ROUTER_FIELDS:
+        _add_path(tree, path.split("/"))
+    for sink_spec in (event_log_data or {}).values():
+        if not isinstance(sink_spec, dict):
+            continue
+        for integration in sink_spec.values():
+            if not isinstance(integration, dict):
+                continue
+            paths = _integration_paths(integration)
+            if paths is None:
+                return None
+            for segments in paths:
+                segments = [segment for segment in segments if segment]
+                if not segments:
+                    return None
+                _add_path(tree, segments)
+    return tree
+
+
+def seed_projection(url_path, route):
+    """Use the projection compiled ahead of time for a route, e.g. the one stored
+    in a route snapshot, on_decode of SnapshotRouteRegistry."""
+    if "projection" in route:
+        with _compiled_lock:
+            _compiled[url_path] = (route["event_log_data"], route["projection"])
+
+
+def _project(value, tree):
+    if tree is KEEP or not isinstance(value, dict):
+        # lists are kept whole, refs into them are not followed
+        return value
+    projected = {}
+    for key, subtree in tree.items():
+        if key in value:
+            projected[key] = _project(value[key], subtree)
+    return projected
+
+
+def project(queue_message, url_path, event_log_data):
+    """Drop the fields of a message that neither the route's mappings nor the
+    router read. The projection of a route is compiled once per spec.
+
+    :param dict queue_message: The decoded message
+    :param str url_path: The route of the message
+    :param dict event_log_data: The spec of the route
+    :rtype: dict
+
+    """
+    if not event_log_data:
+        # unregistered route, the router drops the message anyway
+        return queue_message
+    compiled = _compiled.get(url_path)
+    if compiled is None or compiled[0] is not event_log_data:
+        compiled = (event_log_data, compile_projection(event_log_data))
+        with _compiled_lock:
+            _compiled[url_path] = compiled
+    tree = compiled[1]
+    if tree is None:
+        return queue_message
+    with STAGE_SECONDS.time(stage="projection"):
+        return _project(queue_message, tree)
@@ -0,0 +1,68 @@
+import json
+import logging
+from config import Config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger("marketing_auto_router")
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf8")
+
+
+def _stdlib_loads(data):
+    return json.loads(data)
+
+
+def _orjson_dumps(obj):
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        # integers past 64 bits and subclasses orjson refuses, the stdlib takes them
+        return _stdlib_dumps(obj)
+
+
+def _select_backend(name):
+    if name == "orjson" and orjson is None:
+        logger.warning("JSON_BACKEND is orjson but it is not installed, using the json module")
+    if name in ("auto", "orjson") and orjson is not None:
+        return "orjson", _orjson_dumps, orjson.loads
+    return "json", _stdlib_dumps, _stdlib_loads
+
+
+BACKEND, _dumps, _loads = _select_backend(Config.JSON_BACKEND)
+
+
+def dumps(obj):
+    """Serialize obj to UTF-8 JSON bytes, ready to be sent as a request body.
+
+    orjson is used when it is installed, unless JSON_BACKEND is "json", and
+    the json module otherwise. Both write compact JSON without escaping non
+    ASCII characters, so a body is the same whichever backend encoded it.
+
+    :rtype: bytes
+
+    """
+    return _dumps(obj)
+
+
+def loads(data):
+    """Deserialize JSON from bytes or a str, a response.content as it is."""
+    return _loads(data)
+
+
+class LazyJSON(object):
+    """Serializes obj only when formatted, for log arguments that are
+    dropped most of the time, like those of event_debug."""
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return dumps(self.obj).decode("utf8")
@@ -2,10 +2,12 @@ from database.models import EventLogRoutesRegistry
 from event_handler.request_handler import RequestHandler
 from config import Config, logging_config
 import uuid
-import requests
-import json
 from collections import OrderedDict
 from ..utils import catch_exceptions
+from ..http_client import send
+from ..serializer import dumps
+from ..outbox import get_outbox
+from monitoring.metrics import STAGE_SECONDS, SINK_SECONDS, SINK_ERRORS
 
 import logging
 
@@ -54,12 +56,22 @@ class Upshot:
 
         request_handler_obj = RequestHandler(config_object=Config)
 
-        request_handler_response = request_handler_obj.proccess_request(event_message)
+        with STAGE_SECONDS.time(stage="transform"):
+            request_handler_response = request_handler_obj.proccess_request(event_message)
 
         return request_handler_response["data"]
 
     @catch_exceptions
-    def send_add_events(self, payload, testing):
+    def send_add_events(self, payload, testing, route=""):
+
+        response = self.post_add_events(payload, testing, route)
+        
+        logger.event_debug("Done with upshot %s",response.content)
+
+        return response.content
+
+    def post_add_events(self, payload, testing, route=""):
+        """Send a payload to Upshot, returns the response."""
 
         myobj = payload
         if not testing:
@@ -75,14 +87,24 @@ class Upshot:
                 "accountId": Config.UPSHOT_ACCOUNT_ID_TEST
             }
 
-        response = requests.post("https://eapi.goupshot.com/v1/events/add",data=json.dumps(myobj))
-        
-        logger.event_debug("Done with upshot %s",response.content)
+        try:
+            with SINK_SECONDS.time(sink="upshot", route=route, module=""):
+                # not idempotent, a second add would record the event twice
+                response = send("POST", Config.UPSHOT_API_URL + "/v1/events/add", "upshot", data=dumps(myobj))
+        except Exception:
+            SINK_ERRORS.inc(sink="upshot", route=route, module="")
+            raise
+        if not response.ok:
+            SINK_ERRORS.inc(sink="upshot", route=route, module="")
 
-        return response.content
+        return response
         
     @catch_exceptions    
     def upshot_add_event(self, msg, event_spec, testing = False):
         payload = self.create_payload_upshot(msg, event_spec)
-        response = self.send_add_events(payload, testing)
+        outbox = get_outbox()
+        if outbox and payload is not None:
+            # sent by the outbox senders, the returned Future resolves once it is spooled
+            return outbox.append({"sink": "upshot", "payload": payload, "testing": testing, "route": msg.get("request", {}).get("url", "")})
+        response = self.send_add_events(payload, testing, route=msg.get("request", {}).get("url", ""))
         return response
@@ -1,4 +1,6 @@
 import logging
+import threading
+from concurrent.futures import Future
 
 def catch_exceptions(func, event_id={ "request_id":"", "event_id":""}):
     
@@ -9,4 +11,29 @@ def catch_exceptions(func, event_id={ "request_id":"", "event_id":""}):
             l = logging.getLogger(func.__name__)
             l.error(e,extra=event_id, exc_info=True)
             return None                
-    return wrapped_function
\ No newline at end of file
+    return wrapped_function
+
+
+def all_of(futures):
+    """Future resolved with True once every one of futures resolved with a
+    true value, False as soon as all are done and one failed or was false."""
+    if len(futures) == 1:
+        return futures[0]
+    combined = Future()
+    remaining = [len(futures)]
+    results = []
+    lock = threading.Lock()
+
+    def on_done(future):
+        with lock:
+            results.append(not future.exception() and future.result())
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            combined.set_result(all(results))
+
+    for future in futures:
+        future.add_done_callback(on_done)
+    if not futures:
+        combined.set_result(True)
+    return combined
\ No newline at end of file
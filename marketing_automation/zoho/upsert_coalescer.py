@@ -0,0 +1,134 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from ..utils import all_of
+
+logger = logging.getLogger("marketing_auto_router")
+
+
+def parse_duplicate_check_fields(value):
+    """Parse ZOHO_DUPLICATE_CHECK_FIELDS, a comma separated list of Module:Field
+    entries. A Field without a module is the default of every other module.
+
+    :rtype: dict mapping a module name, or None for the default, to a field name
+
+    """
+    fields = {}
+    for entry in (value or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        module_name, _, field = entry.rpartition(":")
+        fields[module_name or None] = field
+    return fields
+
+
+class _PendingRecord(object):
+
+    def __init__(self):
+        self.record = {}
+        self.futures = []
+
+
+class _ModuleBuffer(object):
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.records = OrderedDict()
+
+
+class ZohoUpsertCoalescer(object):
+    """Merges the Zoho upserts sent for the same record within a short window.
+
+    Records are buffered per module and keyed by the duplicate check field of
+    the module. A record added while one with the same key is buffered is
+    merged into it field by field, the last write wins. When the window of a
+    module expires, or max_records distinct records are buffered, all of them
+    are sent in a single upsert and the future of every contributing record is
+    resolved with whether Zoho accepted the merged record.
+
+    :param callable send: send(module_name, records, duplicate_check_field) performs
+            the upsert and returns a list with a bool per record
+    :param float window: Seconds a record waits for later updates of the same key
+    :param int max_records: Records per upsert, Zoho accepts at most 100
+    :param dict duplicate_check_fields: Output of parse_duplicate_check_fields
+    :param int senders: Upserts sent concurrently
+
+    """
+
+    def __init__(self, send, window=1.0, max_records=100, duplicate_check_fields=None, senders=4):
+        self.send = send
+        self.window = window
+        self.max_records = max_records
+        self.duplicate_check_fields = duplicate_check_fields or {}
+        self._buffers = {}
+        self._condition = threading.Condition()
+        self._senders = ThreadPoolExecutor(max_workers=senders, thread_name_prefix="zoho-upsert")
+        self._thread = threading.Thread(target=self._run, name="zoho-coalescer", daemon=True)
+        self._thread.start()
+
+    def duplicate_check_field(self, module_name):
+        return self.duplicate_check_fields.get(module_name, self.duplicate_check_fields.get(None))
+
+    def add(self, module_name, records):
+        """Buffer the records of one message, returns a Future resolved with True
+        once every one of them was upserted, False if any was not."""
+        field = self.duplicate_check_field(module_name)
+        futures = []
+        with self._condition:
+            buffer = self._buffers.get(module_name)
+            if buffer is None:
+                buffer = self._buffers[module_name] = _ModuleBuffer(time.monotonic() + self.window)
+                self._condition.notify()
+            for record in records:
+                key = record.get(field) if field else None
+                if key is None:
+                    # nothing to merge on, the record is sent on its own
+                    key = object()
+                pending = buffer.records.get(key)
+                if pending is None:
+                    pending = buffer.records[key] = _PendingRecord()
+                pending.record.update(record)
+                future = Future()
+                pending.futures.append(future)
+                futures.append(future)
+            if len(buffer.records) >= self.max_records:
+                self._send_buffer(module_name)
+        return all_of(futures)
+
+    def _send_buffer(self, module_name):
+        # called with the condition held
+        buffer = self._buffers.pop(module_name, None)
+        if buffer and buffer.records:
+            self._senders.submit(self._send, module_name, list(buffer.records.values()))
+
+    def _send(self, module_name, pending_records):
+        records = [pending.record for pending in pending_records]
+        try:
+            results = self.send(module_name, records, self.duplicate_check_field(module_name)) or []
+        except Exception as e:
+            logger.error("Coalesced upsert of %s records to %s failed: %s", len(records), module_name, e, exc_info=True)
+            results = []
+        merged = sum(len(pending.futures) for pending in pending_records)
+        logger.event_debug("Upserted %s records for %s messages to %s", len(records), merged, module_name)
+        for index, pending in enumerate(pending_records):
+            accepted = bool(results[index]) if index < len(results) else False
+            for future in pending.futures:
+                future.set_result(accepted)
+
+    def _run(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                for module_name in [name for name, buffer in self._buffers.items() if buffer.deadline <= now]:
+                    self._send_buffer(module_name)
+                deadlines = [buffer.deadline for buffer in self._buffers.values()]
+                self._condition.wait(min(deadlines) - now if deadlines else None)
+
+    def flush(self):
+        """Send everything buffered now, used when the worker drains."""
+        with self._condition:
+            for module_name in list(self._buffers):
+                self._send_buffer(module_name)
@@ -1,18 +1,22 @@
 import uuid
-import json
 import logging
-import requests
 from datetime import datetime
 from collections import OrderedDict
 from ..utils import catch_exceptions
+from ..http_client import send
+from ..serializer import dumps, loads, LazyJSON
+from ..outbox import get_outbox
+from .upsert_coalescer import ZohoUpsertCoalescer, parse_duplicate_check_fields
 from config import  Config, logging_config
 from event_handler.request_handler import RequestHandler
+from monitoring.metrics import STAGE_SECONDS, SINK_SECONDS, SINK_ERRORS
 
 logger = logging.getLogger("marketing_auto_router")
 
 
-ZOHO_ACCESS_TOKEN_URL = 'https://accounts.zoho.com/oauth/v2/token?refresh_token={refresh_token}&client_id={client_id}&client_secret={client_secret}&grant_type=refresh_token'
-ZOHO_APP_MODULE_URL = "https://www.zohoapis.com/crm/v2/{}/upsert"
+ZOHO_ACCESS_TOKEN_URL = '{accounts_url}/oauth/v2/token?refresh_token={refresh_token}&client_id={client_id}&client_secret={client_secret}&grant_type=refresh_token'
+ZOHO_APP_MODULE_URL = "{api_url}/crm/v2/{module}/upsert"
+ZOHO_SEARCH_URL = "{api_url}/crm/v2/{module}/search?criteria=({query})"
 
 class Singleton(type):
     _instances = {}
@@ -26,16 +30,26 @@ class ZohoCRM(metaclass = Singleton):
 
     def __init__(self):
         self.access_token = ""
+        self.coalescer = None
+        if float(Config.ZOHO_COALESCE_WINDOW_MS) > 0:
+            self.coalescer = ZohoUpsertCoalescer(
+                self.send_coalesced_upsert,
+                window=float(Config.ZOHO_COALESCE_WINDOW_MS) / 1000.0,
+                max_records=int(Config.ZOHO_COALESCE_MAX_RECORDS),
+                duplicate_check_fields=parse_duplicate_check_fields(Config.ZOHO_DUPLICATE_CHECK_FIELDS)
+            )
     
     @catch_exceptions
     def get_outhtoken(self):
 
         zoho_keys = {
+            "accounts_url": Config.ZOHO_ACCOUNTS_URL,
             "client_id": Config.ZOHO_CLIENT_ID,
+            "client_secret": Config.ZOHO_CLIENT_SECRET,
             "refresh_token": Config.ZOHO_REFRESH_TOKEN
         }
         request_url = ZOHO_ACCESS_TOKEN_URL.format(**zoho_keys)
-        access_key_response = requests.post(request_url).json()
+        access_key_response = loads(send("POST", request_url, "zoho_token").content)
 
         access_key = access_key_response.get('access_token')
         logger.event_debug("Zoho response for upsert %s", access_key )
@@ -84,29 +98,75 @@ class ZohoCRM(metaclass = Singleton):
 
         request_handler_obj = RequestHandler(config_object=Config)
 
-        request_handler_response = request_handler_obj.proccess_request(event_message)
+        with STAGE_SECONDS.time(stage="transform"):
+            request_handler_response = request_handler_obj.proccess_request(event_message)
 
         if not isinstance(request_handler_response["data"]["data"],list):
             request_handler_response["data"]["data"] = [request_handler_response["data"]["data"]] 
         
         return request_handler_response["data"]
 
-    @catch_exceptions
-    def zoho_upsert(self, module_name, msg, event_spec):
+    def post_upsert(self, module_name, payload, route=""):
+        """Send an upsert payload to a module, returns the decoded response."""
         headers = {
             'Authorization': 'Zoho-oauthtoken {}'.format(self.access_token),
         }
-        request_url = "https://www.zohoapis.com/crm/v2/{}/upsert".format(module_name)
+        request_url = ZOHO_APP_MODULE_URL.format(api_url=Config.ZOHO_API_URL, module=module_name)
+
+        try:
+            with SINK_SECONDS.time(sink="zoho", route=route, module=module_name):
+                # an upsert matches the record by its duplicate check fields, sending it twice is harmless
+                response = send("POST", request_url, "zoho", idempotent=True, headers=headers, data = dumps(payload))
+        except Exception:
+            SINK_ERRORS.inc(sink="zoho", route=route, module=module_name)
+            raise
+
+        response = loads(response.content)
+        logger.event_debug("Zoho response for upsert %s", LazyJSON(response) )
+        response_data = response.get("data")
+        if not (isinstance(response_data, list) and response_data and all(item.get("code") == "SUCCESS" for item in response_data)):
+            SINK_ERRORS.inc(sink="zoho", route=route, module=module_name)
+        return response
+
+    def send_coalesced_upsert(self, module_name, records, duplicate_check_field=None):
+        """Upsert the records merged by the coalescer in one call, returns
+        whether Zoho accepted each of them."""
+        payload = {"data": records}
+        if duplicate_check_field:
+            payload["duplicate_check_fields"] = [duplicate_check_field]
+        self.ensure_access_token()
+        response = self.post_upsert(module_name, payload)
+        if response.get("code","")=="INVALID_TOKEN":
+            self.access_token = self.get_outhtoken()
+            response = self.post_upsert(module_name, payload)
+        response_data = response.get("data")
+        if not isinstance(response_data, list):
+            return [False] * len(records)
+        return [item.get("code") == "SUCCESS" for item in response_data]
+
+    def upsert_payload(self, module_name, payload, route=""):
+        """Upsert a payload built by create_payload_for_zoho, refreshing the
+        access token once if it expired. Returns the decoded response."""
+        self.ensure_access_token()
+        response = self.post_upsert(module_name, payload, route=route)
+        if response.get("code","")=="INVALID_TOKEN":
+            self.access_token = self.get_outhtoken()
+            response = self.post_upsert(module_name, payload, route=route)
+        return response
+
+    def flush_upserts(self):
+        if self.coalescer:
+            self.coalescer.flush()
+
+    @catch_exceptions
+    def zoho_upsert(self, module_name, msg, event_spec):
 
         payload = self.create_payload_for_zoho(msg, event_spec)
 
         if payload['data']!=[{}]:
-            print('[]]]]]]]]]]]---',payload)
+            logger.event_debug("Zoho payload for upsert %s", payload)
 
-            response = requests.request("Post", request_url, headers=headers, data = json.dumps(payload))
-            
-            response = json.loads(response.text.encode('utf8'))
-            logger.event_debug("Zoho response for upsert %s", json.dumps(response) )
+            response = self.post_upsert(module_name, payload, route=msg.get("request", {}).get("url", ""))
 
             if response.get("code","")=="INVALID_TOKEN":
                 
@@ -141,17 +201,45 @@ class ZohoCRM(metaclass = Singleton):
                 "code":"NOT_INTEGRATED"
             }
 
-    @catch_exceptions    
-    def zoho_add_event(self, msg, event_spec, zoho_module = "Users_Data"):
+    @catch_exceptions
+    def ensure_access_token(self):
         if self.access_token == "":
             self.access_token = self.get_outhtoken()
+        return self.access_token
+
+    @catch_exceptions    
+    def zoho_add_event(self, msg, event_spec, zoho_module = "Users_Data"):
+        outbox = get_outbox()
+        if outbox:
+            # sent by the outbox senders, the returned Future resolves once it is spooled
+            payload = self.create_payload_for_zoho(msg, event_spec)
+            if not payload or payload['data']==[{}]:
+                return {
+                    "status":False,
+                    "code":"NOT_INTEGRATED"
+                }
+            return outbox.append({"sink": "zoho", "module": zoho_module, "payload": payload, "route": msg.get("request", {}).get("url", "")})
+
+        if self.coalescer:
+            # merged with the other updates of the record, the returned Future
+            # resolves once the upsert carrying them is done
+            payload = self.create_payload_for_zoho(msg, event_spec)
+            if not payload or payload['data']==[{}]:
+                return {
+                    "status":False,
+                    "code":"NOT_INTEGRATED"
+                }
+            logger.event_debug("Zoho record buffered for upsert %s", payload)
+            return self.coalescer.add(zoho_module, payload['data'])
+
+        self.ensure_access_token()
 
         response = self.zoho_upsert(zoho_module, msg, event_spec)
         
         if response.get("code","")=="INVALID_TOKEN":
             self.access_token = self.get_outhtoken()
             response = self.zoho_upsert(zoho_module, msg, event_spec)
-        logger.event_debug("Zoho response for upsert %s", json.dumps(response) )
+        logger.event_debug("Zoho response for upsert %s", LazyJSON(response) )
         
         return response
 
@@ -174,7 +262,7 @@ class ZohoCRM(metaclass = Singleton):
 
     @catch_exceptions
     def batch_upsert(self, data, module_name):
-        request_url = ZOHO_APP_MODULE_URL.format(module_name)
+        request_url = ZOHO_APP_MODULE_URL.format(api_url=Config.ZOHO_API_URL, module=module_name)
         headers = {
             'Authorization': 'Zoho-oauthtoken {}'.format(self.access_token),
         }
@@ -183,18 +271,17 @@ class ZohoCRM(metaclass = Singleton):
                 "data":[]
             }
 
-            logger.event_debug("sent %s to %s indices %s ", index, index+100, json.dumps(payload))
+            logger.event_debug("sent %s to %s indices %s ", index, index+100, LazyJSON(payload))
 
 
     @catch_exceptions    
     def get_record_id(self, module_name, query):
-        request_url = "https://www.zohoapis.com/crm/v2/{0}/search?criteria=({1})".format(module_name,query)
+        request_url = ZOHO_SEARCH_URL.format(api_url=Config.ZOHO_API_URL, module=module_name, query=query)
         headers = {
             'Authorization': 'Zoho-oauthtoken {}'.format(self.access_token),
         }
-        response = requests.request("GET", request_url, headers=headers)
-        response = response.text.encode('utf8')
-        response = json.loads(response)
+        response = send("GET", request_url, "zoho_search", idempotent=True, headers=headers)
+        response = loads(response.content)
         if response.get("code","")=="AUTHENTICATION_FAILURE":
             self.access_token = self.get_outhtoken()
             return self.get_record_id(module_name,query)
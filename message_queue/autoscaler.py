@@ -0,0 +1,80 @@
+import math
+import time
+import logging
+from monitoring.metrics import QUEUE_DEPTH, WORKER_POOL_SIZE
+
+logger = logging.getLogger("consumer")
+
+
+class PoolAutoscaler(object):
+    """Sizes an ElasticPoolExecutor from the depth of the queues it consumes.
+
+    At every poll the messages the pool has to get through per second are the
+    rate it completed messages at since the last poll, plus the ready messages
+    of the queues spread over target_drain seconds. By Little's law the pool
+    needs that rate times the seconds a thread spends on a message, sink calls
+    included. The pool grows to that size at once, and shrinks only after
+    scale_down_polls polls in a row asked for less, by half the difference, so
+    a burst that is over for a moment does not make it flap.
+
+    :param ElasticPoolExecutor executor: The pool to resize
+    :param float target_drain: Seconds a backlog should take to be worked off
+    :param int scale_down_polls: Polls asking for fewer threads before the pool shrinks
+
+    """
+
+    def __init__(self, executor, target_drain=30.0, scale_down_polls=3):
+        self.executor = executor
+        self.target_drain = target_drain
+        self.scale_down_polls = scale_down_polls
+        self._completed = executor.completed
+        self._busy_seconds = executor.busy_seconds
+        self._polled_at = time.monotonic()
+        self._service_time = None
+        self._below = 0
+        WORKER_POOL_SIZE.set(executor.size)
+
+    def desired_size(self, depth, rate, service_time):
+        """Threads needed to keep up with rate messages per second and work off
+        depth ready messages, when a message keeps a thread service_time seconds."""
+        if not service_time:
+            # nothing completed yet to measure, a backlog needs every thread
+            return self.executor.max_workers if depth else self.executor.min_workers
+        demand = rate + depth / self.target_drain
+        return int(math.ceil(demand * service_time))
+
+    def on_queue_depth(self, depths):
+        """Queue depth callback of the Consumer, runs on its ioloop."""
+        now = time.monotonic()
+        completed, busy_seconds = self.executor.completed, self.executor.busy_seconds
+        elapsed = now - self._polled_at
+        done = completed - self._completed
+        rate = done / elapsed if elapsed > 0 else 0.0
+        if done:
+            service_time = (busy_seconds - self._busy_seconds) / done
+            # smoothed, one slow poll should not double the pool
+            self._service_time = service_time if self._service_time is None else 0.5 * (self._service_time + service_time)
+        self._completed, self._busy_seconds, self._polled_at = completed, busy_seconds, now
+
+        for queue, depth in depths.items():
+            QUEUE_DEPTH.set(depth, queue=queue)
+        depth = sum(depths.values()) + self.executor.backlog()
+        desired = max(self.executor.min_workers, min(self.executor.max_workers,
+                                                     self.desired_size(depth, rate, self._service_time)))
+        size = self.executor.size
+        if desired > size:
+            self._below = 0
+        elif desired < size:
+            self._below += 1
+            if self._below < self.scale_down_polls:
+                return
+            self._below = 0
+            desired = size - max(1, (size - desired) // 2)
+        else:
+            self._below = 0
+            return
+
+        self.executor.resize(desired)
+        WORKER_POOL_SIZE.set(self.executor.size)
+        logger.info("Worker pool resized from %s to %s threads: %s ready messages, %.1f messages/s, %.0fms per message",
+                    size, self.executor.size, depth, rate, (self._service_time or 0) * 1000)
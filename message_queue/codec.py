@@ -0,0 +1,33 @@
+import base64
+import binascii
+import logging
+
+import umsgpack
+
+logger = logging.getLogger("consumer")
+
+
+def encode_body(payload):
+    """Serialize a message the way the publishers of the event queue do."""
+    return umsgpack.packb(payload)
+
+
+def decode_body(data, check_flag=False):
+    """Decode a msgpack message body, falling back to base64 wrapped msgpack.
+
+    Returns False when the body can not be decoded.
+    """
+    try:
+        return umsgpack.unpackb(data)
+    except Exception as e:
+        logger.debug("Could not unpack message body: %s", e)
+
+        if check_flag:
+            return False
+        try:
+            decoded_string = base64.decodebytes(data)
+        except (binascii.Error, TypeError):
+            return False
+        if not decoded_string:
+            return False
+        return decode_body(decoded_string, check_flag=True)
@@ -1,9 +1,43 @@
 import sys
-import pika
+import time
 import signal
 import logging
+import threading
 from random import randint
 from functools import partial
+from collections import namedtuple
+from monitoring.metrics import STAGE_SECONDS, FLOW_PAUSES, BROKER_RECONNECTS
+from .transport import PikaTransport
+from .flow_control import current_rss
+from .endpoints import BrokerEndpoints, parse_urls
+
+# outcomes a batch consumer callback returns for each delivery
+ACK = "ack"
+REJECT = "reject"
+REQUEUE = "requeue"
+HOLD = "hold"
+
+Delivery = namedtuple("Delivery", ("channel", "method", "properties", "body"))
+
+
+class ConsumerChannel(object):
+    """State of one channel of the Consumer: the queue it consumes from, its
+    prefetch window, the consumer tag returned by Basic.Consume and whether
+    its consumer is cancelled because delivery is paused."""
+
+    def __init__(self, queue, binding_keys, index, prefetch_count):
+        self.queue = queue
+        self.binding_keys = binding_keys
+        self.index = index
+        self.prefetch_count = prefetch_count
+        self.channel = None
+        self.consumer_tag = None
+        self.keys_bound_to_queue = 0
+        self.paused = False
+
+    def __repr__(self):
+        return '<ConsumerChannel queue={} index={}>'.format(self.queue, self.index)
+
 
 class Consumer(object):
     """
@@ -12,16 +46,36 @@ class Consumer(object):
 
     If RabbitMQ closes the connection, it will reopen it. 
 
-    If the channel is closed, it will indicate a problem with one of the
+    If a channel is closed, it will indicate a problem with one of the
     commands that were issued and that should surface in the output as well.
+    The channel is opened again, its unacknowledged messages are redelivered
+    by the broker.
+
+    The consumer can open several channels on its connection, each with its
+    own prefetch window and consumer tag, and consume from several queues.
+    Every delivery is handed to the same consumer_callback together with the
+    channel it arrived on, and must be acknowledged on that same channel.
+    With add_batch_consumer_callback the deliveries are handed over in
+    batches instead and acknowledged by the consumer.
+
+    amqp_url may list several broker nodes. A lost connection is opened again
+    on the first node out of its reconnect backoff, see BrokerEndpoints. The
+    workers keep processing what they hold, their acknowledgements for the
+    channels of the lost connection are dropped and the broker redelivers
+    those messages.
     """
 
+    DRAIN_POLL_INTERVAL = 0.1
+    FLOW_CHECK_INTERVAL = 0.5
+
     def __init__(self, consumer_callback=None, amqp_url=None, exchange=None, **kwargs):
         """Create a new instance of the Receiver class, passing in the various
         parameters used to connect to RabbitMQ.
 
         Other than consumer_callback, amqp_url, exchange the optional arguments are: 
-        exchange_type, queue, binding_keys, queue_exclusive, queue_durable, no_ack
+        exchange_type, queue, binding_keys, queue_exclusive, queue_durable, no_ack,
+        safe_stop, prefetch_count, transport, channels, queues, drain_timeout,
+        watermarks, reconnect_backoff, max_reconnect_backoff
 
         :param method consumer_callback: The method to callback when consuming (messages)
             with the signature consumer_callback(channel, method, properties, body), where
@@ -29,7 +83,8 @@ class Consumer(object):
                                 method: pika.spec.Basic.Deliver
                                 properties: pika.spec.BasicProperties
                                 body: str, unicode, or bytes (python 3.x)
-        :param str amqp_url: The AMQP url to connect with
+        :param amqp_url: The AMQP url to connect with, or a list or comma separated
+                string of the urls of several broker nodes, in order of preference
         :param str exchange: Name of exchange
         :param str exchange_type: The exchange type to use. If no vaue is given for exchange 
                 type, it will assume that the exchange already exists and will use the existing 
@@ -51,18 +106,54 @@ class Consumer(object):
                 default value is False
         :param bool safe_stop: If this option is True, system will try to gracefully stop the 
                 connection if the process is killed (with SIGTERM signal). Its default value is True
+        :param int prefetch_count: Unacknowledged messages the broker may deliver on each
+                channel. Its default value is 1
+        :param transport: Opens the broker connections, message_queue.transport.PikaTransport
+                by default or message_queue.memory_broker.InMemoryTransport for an in-process broker
+        :param int channels: Channels opened per queue, each with its own consumer. Its default
+                value is 1
+        :param list queues: Additional queue names to consume from, each bound to the exchange
+                with its own name as binding key. Its default value is []
+        :param float drain_timeout: Seconds a drain waits for in-flight messages before closing
+                the connection anyway. Its default value is 25
+        :param float reconnect_backoff: Seconds before a failed broker node is tried again,
+                doubled with every failure in a row. Its default value is 0.25
+        :param float max_reconnect_backoff: Longest wait before a failed node is tried again.
+                Its default value is 30
 
         """
-        self._prefetch_count = 1
         self._connection = None
-        self._channel = None
+        self._channels = []
         self._closing = False
-        self._consumer_tag = None
+        self._draining = False
+        self._in_flight = {}
+        self._in_flight_bytes = 0
+        # unacknowledged on purpose until their channel closes, e.g. after a failed sink call
+        self._held = {}
+        self._paused = False
+        self._rss = None
+        self._flow_timer = None
+        self._depth_callbacks = []
+        self._depth_interval = None
+        self._depth_timer = None
+        self._on_drain_callbacks = []
+        self._batches = {}
+        self._batch_timers = {}
+        self._batch_executor = None
         self._LOGGER = logging.getLogger("consumer")
-        self.consumer_callback = None
-        self._url = amqp_url
+        self.consumer_callback = consumer_callback
+        self.batch_consumer_callback = None
+        self.batch_max_size = 1
+        self.batch_max_linger = 0
+        self._url = None
+        self._endpoint = None
+        self._reconnecting = False
+        self._drain_requested = False
+        self._wake = threading.Event()
         self.exchange = exchange
         self.parse_input_args(kwargs)
+        self._endpoints = BrokerEndpoints(parse_urls(amqp_url), backoff=kwargs.get('reconnect_backoff', 0.25),
+                                          max_backoff=kwargs.get('max_reconnect_backoff', 30.0))
 
     def parse_input_args(self, kwargs):
         """Parse and set connection parameters from a dictionary.
@@ -76,20 +167,120 @@ class Consumer(object):
         self.queue_durable = kwargs.get('queue_durable', True)
         self.no_ack = kwargs.get('no_ack', False)
         self.safe_stop = kwargs.get('safe_stop', True)
+        self._prefetch_count = kwargs.get('prefetch_count', 1)
+        self._transport = kwargs.get('transport') or PikaTransport()
+        self.channels_per_queue = max(1, kwargs.get('channels', 1))
+        self.extra_queues = [queue for queue in kwargs.get('queues', []) if queue != self.queue]
+        self.drain_timeout = kwargs.get('drain_timeout', 25)
+        self.watermarks = kwargs.get('watermarks')
 
         # if queue name is empty string server will choose a random queue name
         # and we want this queue to be deleted when connection closes, hence
         # setting queue_exclusive True
         if not self.queue:
             self.queue_exclusive = True
+            self.channels_per_queue = 1
+
+    @property
+    def _channel(self):
+        """The first open channel, used when a caller does not say which channel a
+        delivery came from."""
+        for state in self._channels:
+            if state.channel is not None and state.channel.is_open:
+                return state.channel
+        return None
 
-    
     def add_consumer_callback(self, call_back):
          self.consumer_callback = call_back
 
-    def add_callback_safe_thread(self, delivery_tag):
-        call_back = partial(self.acknowledge_message,delivery_tag)
-        self._connection._adapter_add_callback_threadsafe(call_back)
+    def add_batch_consumer_callback(self, call_back, max_size=100, max_linger_ms=50, executor=None):
+        """Hand the deliveries over in batches instead of one at a time.
+
+        Deliveries are collected per channel until max_size of them are
+        pending or the first one waited max_linger_ms, then
+        call_back(deliveries) runs on the executor, or on a thread of its own
+        when executor is None. deliveries is a list of Delivery tuples and
+        call_back returns one outcome per delivery, in the same order: ACK,
+        REJECT, REQUEUE or HOLD to leave the message unacknowledged (True and
+        False stand for ACK and REJECT). The consumer then acknowledges the
+        batch, with a single multiple ack when the acked messages are the
+        oldest unacknowledged ones of the channel. If call_back raises, the
+        whole batch is requeued.
+
+        A batch can not grow beyond the prefetch window of a channel, so
+        prefetch_count should be a multiple of max_size.
+
+        :param callable call_back: Called with a list of Delivery, returns a list of outcomes
+        :param int max_size: Deliveries per batch at most
+        :param float max_linger_ms: Milliseconds a delivery waits for its batch to fill
+        :param executor: Object with a submit(fn, *args) method running the batches
+
+        """
+        self.batch_consumer_callback = call_back
+        self.batch_max_size = max(1, max_size)
+        self.batch_max_linger = max_linger_ms / 1000.0
+        self._batch_executor = executor
+
+    def add_on_drain_callback(self, call_back):
+        """Register a callable run on its own thread when draining starts, used to
+        flush buffered work so the messages it holds can be acknowledged before
+        the connection closes."""
+        self._on_drain_callbacks.append(call_back)
+
+    def add_on_queue_depth_callback(self, call_back, interval=5.0):
+        """Register a callable polled with the depth of the queues.
+
+        Every interval seconds a passive Queue.Declare is sent for every queue
+        consumed from, and once all have answered call_back is invoked on the
+        ioloop with a dict mapping each queue to its count of ready messages.
+
+        """
+        self._depth_callbacks.append(call_back)
+        self._depth_interval = min(interval, self._depth_interval or interval)
+
+    def in_flight_count(self):
+        """Messages delivered on an open channel and not yet acknowledged or held."""
+        return sum(len(tags) for tags in self._in_flight.values())
+
+    def held_count(self):
+        """Messages held unacknowledged by hold_message until their channel closes."""
+        return sum(len(tags) for tags in self._held.values())
+
+    def in_flight_bytes(self):
+        """Body bytes of the messages counted by in_flight_count."""
+        return self._in_flight_bytes
+
+    @property
+    def paused(self):
+        return self._paused
+
+    def add_callback_safe_thread(self, delivery_tag, channel=None):
+        """Acknowledge a message from a worker thread.
+
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param pika.channel.Channel channel: The channel the message was delivered on
+
+        """
+        call_back = partial(self.acknowledge_message, delivery_tag, time.perf_counter(), channel)
+        self._call_threadsafe(call_back, 'ack', delivery_tag)
+
+    def reject_safe_thread(self, delivery_tag, requeue=False, channel=None):
+        """Negatively acknowledge a message from a worker thread. Rejected messages
+        that are not requeued go to the dead letter exchange of the queue, if any."""
+        call_back = partial(self.reject_message, delivery_tag, requeue, channel)
+        self._call_threadsafe(call_back, 'nack', delivery_tag)
+
+    def hold_safe_thread(self, delivery_tag, channel=None):
+        """Hold a message unacknowledged from a worker thread, see hold_message."""
+        call_back = partial(self.hold_message, delivery_tag, channel)
+        self._call_threadsafe(call_back, 'hold', delivery_tag)
+
+    def _call_threadsafe(self, call_back, action, delivery_tag):
+        try:
+            self._transport.add_callback_threadsafe(self._connection, call_back)
+        except Exception as e:
+            # the connection, and the channel of the message, are gone
+            self._LOGGER.warning('Dropping %s of message %s, its connection is closed: %s', action, delivery_tag, e)
 
     def connect(self):
         """Connect to RabbitMQ, returning the connection handle.
@@ -97,14 +288,14 @@ class Consumer(object):
         When the connection is established, the on_connection_open method
         will be invoked by pika.
 
-        :rtype: pika.SelectConnection
+        :rtype: pika.SelectConnection or the connection type of the transport
 
         """
-        self._LOGGER.info('Connecting to %s with queue %s and exchange %s', self._url, self.queue, self.exchange)
-        return pika.SelectConnection(pika.URLParameters(self._url),
-                                     self.on_connection_open,
-                                     self.on_connection_error
-                                     )
+        self._LOGGER.info('Connecting to %s with queue %s and exchange %s', self._endpoint.name, self.queue, self.exchange)
+        return self._transport.connect(self._url,
+                                       self.on_connection_open,
+                                       self.on_connection_error
+                                       )
 
     def on_connection_open(self, unused_connection):
         """Invoked by pika once the connection to RabbitMQ has
@@ -116,9 +307,19 @@ class Consumer(object):
         :type unused_connection: pika.SelectConnection
 
         """
-        self._LOGGER.info('Connection opened for queue %s', self.queue)
+        self._LOGGER.info('Connection opened to %s for queue %s', self._endpoint.name, self.queue)
+        self._endpoints.succeeded(self._url)
         self.add_on_connection_close_callback()
-        self.open_channel()
+        if self.watermarks and self._flow_timer is None:
+            self._flow_timer = self._connection.ioloop.call_later(self.FLOW_CHECK_INTERVAL, self._check_flow)
+        if self._depth_callbacks and self._depth_timer is None:
+            self._depth_timer = self._connection.ioloop.call_later(self._depth_interval, self._poll_queue_depth)
+        self._channels = []
+        for queue, binding_keys in [(self.queue, self.binding_keys)] + [(queue, [queue]) for queue in self.extra_queues]:
+            for index in range(self.channels_per_queue):
+                state = ConsumerChannel(queue, binding_keys, index, self._prefetch_count)
+                self._channels.append(state)
+                self.open_channel(state)
 
     def add_on_connection_close_callback(self):
         """Add a callback that will be invoked if RabbitMQ closes the connection
@@ -129,11 +330,11 @@ class Consumer(object):
         self._LOGGER.info('Adding connection close callback')
         self._connection.add_on_close_callback(self.on_connection_closed)
 
-   
+
 
 
     def on_connection_error(self, connection, error):
-        self._LOGGER.warning("Connection failed.Retrying in next 5 seconds for queue %s", self.queue)
+        self._LOGGER.warning("Could not connect to %s for queue %s: %s", self._endpoint.name, self.queue, error)
         self.reconnect()
 
     def on_connection_closed(self, _connection, reason):
@@ -146,60 +347,78 @@ class Consumer(object):
             connection.
 
         """
-        self._channel = None
-        if self._closing:
+        self._reset_connection_state()
+        if self._closing or self._draining:
             self._connection.ioloop.stop()
         else:
-            self._LOGGER.warning('Connection closed, reconnect necessary: %s', reason)
+            self._LOGGER.warning('Connection to %s closed, reconnect necessary: %s', self._endpoint.name, reason)
             self.reconnect()
 
+    def _reset_connection_state(self):
+        """Forget the channels and deliveries of a lost connection, the broker
+        requeued whatever was unacknowledged on it."""
+        for state in self._channels:
+            state.channel = None
+        self._in_flight.clear()
+        self._in_flight_bytes = 0
+        self._held.clear()
+        self._flow_timer = None
+        self._depth_timer = None
+        self._batches.clear()
+        self._batch_timers.clear()
+
     def reconnect(self):
-        """Invoked by the IOLoop timer if the connection is
-        closed.
+        """Invoked when the connection could not be opened or was lost.
 
-        See the on_connection_closed method.
+        The endpoint of the connection is put in backoff and the ioloop of the
+        connection is stopped, run() then opens a new connection to the
+        endpoint picked by BrokerEndpoints.select. Its channels and the
+        connection itself may all report the loss, only the first report counts.
 
         """
-        # This is the old connection IOLoop instance, stop its ioloop
+        if self._reconnecting:
+            return
+        self._reconnecting = True
+        backoff = self._endpoints.failed(self._url)
+        BROKER_RECONNECTS.inc(endpoint=self._endpoint.name)
+        self._LOGGER.info('%s is in backoff for %.2fs', self._endpoint.name, backoff)
         self._connection.ioloop.stop()
 
-        if not self._closing:
-            # Create a new connection
-            self._connection = self.connect()
-            # There is now a new connection, needs a new ioloop to run
-            self._connection.ioloop.start()
-
-    def open_channel(self):
+    def open_channel(self, state):
         """Open a new channel with RabbitMQ by issuing the Channel.Open RPC
         command.
 
         When RabbitMQ responds that the channel is open, the
         on_channel_open callback will be invoked by pika.
 
+        :param ConsumerChannel state: The channel to open
+
         """
-        self._LOGGER.info('Creating a new channel')
-        self._connection.channel(on_open_callback=self.on_channel_open)
+        self._LOGGER.info('Creating a new channel for %r', state)
+        self._connection.channel(on_open_callback=partial(self.on_channel_open, state))
 
-    def on_channel_open(self, channel):
+    def on_channel_open(self, state, channel):
         """Invoked by pika when the channel has been opened.
         The channel object is passed in so we can make use of it.
 
         Since the channel is now open, we'll declare the exchange to use.
 
+        :param ConsumerChannel state: The channel being set up
         :param pika.channel.Channel channel: The channel object
 
         """
-        self._LOGGER.info('Channel opened')
-        self._channel = channel
-        self.add_on_channel_close_callback()
+        self._LOGGER.info('Channel opened for %r', state)
+        state.channel = channel
+        state.consumer_tag = None
+        self.add_on_channel_close_callback(state)
         if self.exchange_type:
-            self.setup_exchange(self.exchange)
+            self.setup_exchange(state, self.exchange)
         else:
             self._LOGGER.info(
                 'Skipped exchange setup assuming that exchange already exists')
-            self.setup_queue(self.queue)
+            self.setup_queue(state, state.queue)
 
-    def add_on_channel_close_callback(self):
+    def add_on_channel_close_callback(self, state):
         """Add a callback that will be invoked if RabbitMQ closes the channel
         for some reason.
 
@@ -208,44 +427,58 @@ class Consumer(object):
 
         """
         self._LOGGER.info('Adding channel close callback')
-        self._channel.add_on_close_callback(self.on_channel_closed)
+        state.channel.add_on_close_callback(partial(self.on_channel_closed, state))
 
-    def on_channel_closed(self, channel, reply_text):
+    def on_channel_closed(self, state, channel, reply_text):
         """Invoked by pika when RabbitMQ unexpectedly closes the channel.
 
         Channels are usually closed if we attempt to do something that
         violates the protocol, such as re-declare an exchange or queue with
-        different parameters. In this case, we'll close the connection
-        to shutdown the object.
+        different parameters, or acknowledge an unknown delivery tag. The
+        broker redelivers the unacknowledged messages of the channel, so a new
+        channel is opened in its place. When we are stopping, the connection
+        is closed once every channel is closed.
 
+        :param ConsumerChannel state: The channel that was closed
         :param pika.channel.Channel: The closed channel
-        :param int reply_code: The numeric reason the channel was closed
-        :param str reply_text: The text reason the channel was closed
+        :param Exception reply_text: The reason the channel was closed
 
         """
         self._LOGGER.info('Channel %s was closed: %s',
                              channel, reply_text)
+        if state.channel is channel:
+            state.channel = None
+        # the broker requeues what was unacknowledged on the channel
+        self._in_flight_bytes -= sum(self._in_flight.pop(channel, {}).values())
+        self._held.pop(channel, None)
+        state.paused = False
+        self._discard_batch(channel)
 
         if self._connection.is_closed:
-            self.reconnect()
-        else:
-            self._connection.close()
-
-    def setup_exchange(self, exchange_name):
+            if not (self._closing or self._draining):
+                self.reconnect()
+        elif self._closing:
+            if all(each.channel is None for each in self._channels):
+                self.close_connection()
+        elif not self._draining:
+            self.open_channel(state)
+
+    def setup_exchange(self, state, exchange_name):
         """Setup the exchange on RabbitMQ by invoking the Exchange.Declare RPC
         command.
 
         When it is complete, the on_exchange_declareok method will be invoked by pika.
 
+        :param ConsumerChannel state: The channel to declare the exchange on
         :param str|unicode exchange_name: The name of the exchange to declare
 
         """
         self._LOGGER.info('Declaring exchange %s', exchange_name)
-        self._channel.exchange_declare(self.on_exchange_declareok,
-                                       exchange_name,
-                                       self.exchange_type)
+        state.channel.exchange_declare(exchange=exchange_name,
+                                       exchange_type=self.exchange_type,
+                                       callback=partial(self.on_exchange_declareok, state))
 
-    def on_exchange_declareok(self, unused_frame):
+    def on_exchange_declareok(self, state, unused_frame):
         """Invoked by pika when RabbitMQ has finished the Exchange.Declare RPC
         command.
 
@@ -253,9 +486,9 @@ class Consumer(object):
 
         """
         self._LOGGER.info('Exchange declared')
-        self.setup_queue(self.queue)
+        self.setup_queue(state, state.queue)
 
-    def setup_queue(self, queue_name):
+    def setup_queue(self, state, queue_name):
         """Setup the queue on RabbitMQ by invoking the Queue.Declare RPC
         command.
 
@@ -267,6 +500,7 @@ class Consumer(object):
         work. It won't be any problem if queue parameters are also same along with 
         the name        
 
+        :param ConsumerChannel state: The channel to declare the queue on
         :param str|unicode queue_name: The name of the queue to declare.
 
         """
@@ -274,10 +508,11 @@ class Consumer(object):
             self._LOGGER.info('Declaring queue with server defined queue name')
         else:
             self._LOGGER.info('Declaring queue %s', queue_name)
-        self._channel.queue_declare(queue=queue_name,
-                                    durable=self.queue_durable, exclusive=self.queue_exclusive, callback=self.on_queue_declareok)
+        state.channel.queue_declare(queue=queue_name,
+                                    durable=self.queue_durable, exclusive=self.queue_exclusive,
+                                    callback=partial(self.on_queue_declareok, state))
 
-    def on_queue_declareok(self, method_frame):
+    def on_queue_declareok(self, state, method_frame):
         """Invoked by pika when the Queue.Declare RPC call made in
         setup_queue has completed.
 
@@ -285,57 +520,66 @@ class Consumer(object):
         routing key by issuing the Queue.Bind RPC command. When this command
         is complete, the on_bindok method will be invoked by pika.
 
+        :param ConsumerChannel state: The channel the queue was declared on
         :param pika.frame.Method method_frame: The Queue.DeclareOk frame
 
         """
 
-        if self.queue == '':
-            self._LOGGER.info('Binding %s to server defined queue with %s',
-                              self.exchange, ','.join(self.binding_keys))
+        if state.queue == '':
+            state.queue = method_frame.method.queue
+            self._LOGGER.info('Binding %s to server defined queue %s with %s',
+                              self.exchange, state.queue, ','.join(map(str, state.binding_keys)))
         else:
             self._LOGGER.info('Binding %s to %s with %s',
-                              self.exchange, self.queue, ','.join(self.binding_keys))
-        self.keys_bound_to_queue = 0
-        for binding_key in self.binding_keys:
-            self._channel.queue_bind(callback=self.on_bindok, queue=self.queue,
+                              self.exchange, state.queue, ','.join(map(str, state.binding_keys)))
+        state.keys_bound_to_queue = 0
+        for binding_key in state.binding_keys:
+            state.channel.queue_bind(callback=partial(self.on_bindok, state), queue=state.queue,
                                      exchange=self.exchange, routing_key=binding_key)
 
-    def on_bindok(self, unused_frame):
+    def on_bindok(self, state, unused_frame):
         """Invoked by pika when the Queue.Bind method has completed.
 
         At this point we will start consuming messages by calling start_consuming
         which will invoke the needed RPC commands to start the process.
 
+        :param ConsumerChannel state: The channel the queue was bound on
         :param pika.frame.Method unused_frame: The Queue.BindOk response frame
 
         """
-        self.keys_bound_to_queue += 1
-        if self.keys_bound_to_queue == len(self.binding_keys):
+        state.keys_bound_to_queue += 1
+        if state.keys_bound_to_queue == len(state.binding_keys):
             self._LOGGER.info('Queue bound')
-            self.set_qos()
+            self.set_qos(state)
 
-    def set_qos(self):
-        """This method sets up the consumer prefetch to only be delivered
-        one message at a time. The consumer must acknowledge this message
-        before RabbitMQ will deliver another one. You should experiment
-        with different prefetch values to achieve desired performance.
+    def set_qos(self, state):
+        """This method sets up the consumer prefetch of the channel. The broker
+        will not deliver more than prefetch_count unacknowledged messages on
+        it. You should experiment with different prefetch values to achieve
+        desired performance.
 
         """
-        self._channel.basic_qos(
-            prefetch_count=self._prefetch_count, callback=self.on_basic_qos_ok)
+        state.channel.basic_qos(
+            prefetch_count=state.prefetch_count, callback=partial(self.on_basic_qos_ok, state))
 
-    def on_basic_qos_ok(self, _unused_frame):
+    def on_basic_qos_ok(self, state, _unused_frame):
         """Invoked by pika when the Basic.QoS method has completed. At this
         point we will start consuming messages by calling start_consuming
         which will invoke the needed RPC commands to start the process.
 
+        :param ConsumerChannel state: The channel the prefetch was set on
         :param pika.frame.Method _unused_frame: The Basic.QosOk response frame
 
         """
-        self._LOGGER.info('QOS set to: %d', self._prefetch_count)
-        self.start_consuming()
-
-    def start_consuming(self):
+        self._LOGGER.info('QOS set to: %d', state.prefetch_count)
+        if self._paused:
+            # started by resume_consuming
+            self.add_on_cancel_callback(state)
+            state.paused = True
+            return
+        self.start_consuming(state)
+
+    def start_consuming(self, state):
         """Set up the consumer.
 
         Calls add_on_cancel_callback so that the object is notified if RabbitMQ
@@ -345,42 +589,49 @@ class Consumer(object):
         cancel consuming. The on_message method is passed in as a callback pika
         will invoke when a message is fully received.
 
+        :param ConsumerChannel state: The channel to consume on
+
         """
         self._LOGGER.info('Issuing consumer related RPC commands')
-        self.add_on_cancel_callback()
-        self._consumer_tag = self._channel.basic_consume(on_message_callback=self.on_message,
-                                                         queue=self.queue, auto_ack = self.no_ack)
+        self.add_on_cancel_callback(state)
+        self.basic_consume(state)
+
+    def basic_consume(self, state):
+        """Issue the Basic.Consume RPC command on the channel of state."""
+        state.consumer_tag = state.channel.basic_consume(on_message_callback=self.on_message,
+                                                         queue=state.queue, auto_ack = self.no_ack)
 
-    def add_on_cancel_callback(self):
+    def add_on_cancel_callback(self, state):
         """Add a callback that will be invoked if RabbitMQ cancels the consumer
         for some reason. If RabbitMQ does cancel the consumer,
         on_consumer_cancelled will be invoked by pika.
 
         """
         self._LOGGER.info('Adding consumer cancellation callback')
-        self._channel.add_on_cancel_callback(self.on_consumer_cancelled)
+        state.channel.add_on_cancel_callback(partial(self.on_consumer_cancelled, state))
 
-    def on_consumer_cancelled(self, method_frame):
+    def on_consumer_cancelled(self, state, method_frame):
         """Invoked by pika when RabbitMQ sends a Basic.Cancel for a consumer
         receiving messages.
 
+        :param ConsumerChannel state: The channel of the cancelled consumer
         :param pika.frame.Method method_frame: The Basic.Cancel frame
 
         """
         self._LOGGER.info('Consumer was cancelled remotely, shutting down: %r',
                           method_frame)
-        if self._channel:
-            self._channel.close()
+        if state.channel:
+            state.channel.close()
 
-    def on_message(self, unused_channel, basic_deliver, properties, body):
+    def on_message(self, channel, basic_deliver, properties, body):
         """Invoked by pika when a message is delivered from RabbitMQ. The
-        channel is passed just for convenience. The basic_deliver object that
-        is passed in carries the exchange, routing key, delivery tag and
-        a redelivered flag for the message. The properties passed in is an
-        instance of BasicProperties with the message properties and the body
-        is the message that was sent.
+        channel is passed so the message can be acknowledged on it. The
+        basic_deliver object that is passed in carries the exchange, routing
+        key, delivery tag and a redelivered flag for the message. The
+        properties passed in is an instance of BasicProperties with the message
+        properties and the body is the message that was sent.
 
-        :param pika.channel.Channel unused_channel: The channel object
+        :param pika.channel.Channel channel: The channel object
         :param pika.Spec.Basic.Deliver: basic_deliver method
         :param pika.Spec.BasicProperties: properties
         :param str|unicode body: The message body
@@ -389,50 +640,331 @@ class Consumer(object):
         self._LOGGER.debug('Received message # %s from %s',
                            basic_deliver.delivery_tag, properties.app_id)
         self._LOGGER.debug('Message Received: %s', body)
-        self.consumer_callback(unused_channel, basic_deliver, properties, body)
+        if self._draining:
+            # delivered before the broker processed our Basic.Cancel, hand it back
+            # right away so another consumer picks it up
+            if not self.no_ack:
+                channel.basic_nack(basic_deliver.delivery_tag, requeue=True)
+            return
+        if not self.no_ack:
+            self._in_flight.setdefault(channel, {})[basic_deliver.delivery_tag] = len(body)
+            self._in_flight_bytes += len(body)
+            if self.watermarks and not self._paused:
+                reason = self.watermarks.exceeded(self.in_flight_count(), self._in_flight_bytes, self._rss)
+                if reason:
+                    self.pause_consuming(reason)
+        if self.batch_consumer_callback:
+            self._add_to_batch(Delivery(channel, basic_deliver, properties, body))
+        else:
+            self.consumer_callback(channel, basic_deliver, properties, body)
+
+    def _add_to_batch(self, delivery):
+        batch = self._batches.setdefault(delivery.channel, [])
+        batch.append(delivery)
+        if len(batch) >= self.batch_max_size:
+            self._flush_batch(delivery.channel)
+        elif len(batch) == 1:
+            self._batch_timers[delivery.channel] = self._connection.ioloop.call_later(
+                self.batch_max_linger, partial(self._on_batch_linger, delivery.channel))
+
+    def _on_batch_linger(self, channel):
+        self._batch_timers.pop(channel, None)
+        self._flush_batch(channel)
+
+    def _flush_batch(self, channel):
+        timer = self._batch_timers.pop(channel, None)
+        if timer is not None:
+            self._connection.ioloop.remove_timeout(timer)
+        batch = self._batches.pop(channel, None)
+        if not batch:
+            return
+        if self._batch_executor is not None:
+            self._batch_executor.submit(self._run_batch, channel, batch)
+        else:
+            threading.Thread(target=self._run_batch, args=(channel, batch)).start()
+
+    def _discard_batch(self, channel):
+        # the broker requeues the messages of a closed channel
+        timer = self._batch_timers.pop(channel, None)
+        if timer is not None:
+            self._connection.ioloop.remove_timeout(timer)
+        self._batches.pop(channel, None)
+
+    def _run_batch(self, channel, batch):
+        try:
+            outcomes = list(self.batch_consumer_callback(batch))
+            if len(outcomes) != len(batch):
+                raise ValueError("{} outcomes returned for a batch of {}".format(len(outcomes), len(batch)))
+        except Exception:
+            self._LOGGER.exception('Batch callback failed, requeueing %d messages', len(batch))
+            outcomes = [REQUEUE] * len(batch)
+        delivery_tags = [delivery.method.delivery_tag for delivery in batch]
+        call_back = partial(self.settle_batch, channel, delivery_tags, outcomes, time.perf_counter())
+        self._transport.add_callback_threadsafe(self._connection, call_back)
+
+    def settle_batch(self, channel, delivery_tags, outcomes, requested_at=None):
+        """Acknowledge or reject the messages of a batch according to their outcomes.
+
+        :param pika.channel.Channel channel: The channel the batch was delivered on
+        :param list delivery_tags: Delivery tags of the batch
+        :param list outcomes: ACK, REJECT, REQUEUE or HOLD for each delivery tag
+        :param float requested_at: perf_counter() value taken when the batch finished
+
+        """
         if self.no_ack:
-            self.acknowledge_message(basic_deliver.delivery_tag)
+            return
+        if not channel.is_open:
+            self._LOGGER.warning('Dropping the outcomes of %d messages, their channel is closed', len(delivery_tags))
+            return
+        acks = []
+        for delivery_tag, outcome in zip(delivery_tags, outcomes):
+            if outcome is True or outcome == ACK:
+                acks.append(delivery_tag)
+            elif outcome is False or outcome == REJECT:
+                self.reject_message(delivery_tag, False, channel)
+            elif outcome == REQUEUE:
+                self.reject_message(delivery_tag, True, channel)
+            elif outcome == HOLD:
+                self.hold_message(delivery_tag, channel)
+        if acks:
+            self.acknowledge_many(acks, channel, requested_at)
+
+    def acknowledge_many(self, delivery_tags, channel, requested_at=None):
+        """Acknowledge several messages of a channel at once.
+
+        The longest run of the oldest unacknowledged delivery tags of the
+        channel that are all being acknowledged is covered by one Basic.Ack
+        with multiple set, the other tags are acknowledged one by one.
+
+        :param list delivery_tags: The delivery tags to acknowledge
+        :param pika.channel.Channel channel: The channel the messages were delivered on
+        :param float requested_at: perf_counter() value taken when the acks were requested
+
+        """
+        if not channel.is_open:
+            self._LOGGER.warning('Dropping acks of %d messages, their channel is closed', len(delivery_tags))
+            return
+        in_flight = self._in_flight.get(channel, {})
+        remaining = set(delivery_tags)
+        upto = None
+        # a multiple ack must stop short of the held messages too
+        for delivery_tag in sorted(set(in_flight).union(self._held.get(channel, ()))):
+            if delivery_tag not in remaining:
+                break
+            upto = delivery_tag
+        if upto is not None:
+            self._LOGGER.debug('Acknowledging messages up to %s', upto)
+            channel.basic_ack(upto, multiple=True)
+            covered = [delivery_tag for delivery_tag in in_flight if delivery_tag <= upto]
+            for delivery_tag in covered:
+                self._in_flight_bytes -= in_flight.pop(delivery_tag)
+            remaining.difference_update(covered)
+            self._maybe_resume()
+        for delivery_tag in sorted(remaining):
+            channel.basic_ack(delivery_tag)
+            self._settled(channel, delivery_tag)
+        if requested_at is not None:
+            STAGE_SECONDS.observe(time.perf_counter() - requested_at, stage="ack")
+
+    def _settled(self, channel, delivery_tag):
+        self._held.get(channel, {}).pop(delivery_tag, None)
+        tags = self._in_flight.get(channel)
+        if tags is not None and delivery_tag in tags:
+            self._in_flight_bytes -= tags.pop(delivery_tag)
+            self._maybe_resume()
+
+    def hold_message(self, delivery_tag, channel=None):
+        """Leave a message unacknowledged until its channel closes, when the
+        broker redelivers it, e.g. after a failed sink call.
+
+        A held message still takes a prefetch slot but no longer counts
+        against the watermarks, which would otherwise pause delivery for good
+        once enough messages are held, nor delays a drain.
+
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param pika.channel.Channel channel: The channel the message was delivered on
 
-    def acknowledge_message(self, delivery_tag):
+        """
+        channel = channel or self._channel
+        tags = self._in_flight.get(channel)
+        if tags is None or delivery_tag not in tags:
+            return
+        self._LOGGER.debug('Holding message %s', delivery_tag)
+        nbytes = tags.pop(delivery_tag)
+        self._in_flight_bytes -= nbytes
+        self._held.setdefault(channel, {})[delivery_tag] = nbytes
+        self._maybe_resume()
+
+    def _maybe_resume(self):
+        if self._paused and self.watermarks.relieved(self.in_flight_count(), self._in_flight_bytes, self._rss):
+            self.resume_consuming()
+
+    def _check_flow(self):
+        """Periodic ioloop timer sampling the RSS and pausing or resuming delivery."""
+        self._flow_timer = None
+        if self._closing or self._draining or not self._connection.is_open:
+            return
+        if self.watermarks.watches_rss:
+            self._rss = current_rss()
+        count, nbytes = self.in_flight_count(), self._in_flight_bytes
+        if not self._paused:
+            reason = self.watermarks.exceeded(count, nbytes, self._rss)
+            if reason:
+                self.pause_consuming(reason)
+        else:
+            self._maybe_resume()
+        self._flow_timer = self._connection.ioloop.call_later(self.FLOW_CHECK_INTERVAL, self._check_flow)
+
+    def _poll_queue_depth(self):
+        """Periodic ioloop timer sending a passive Queue.Declare per queue."""
+        self._depth_timer = None
+        if self._closing or self._draining or not self._connection.is_open:
+            return
+        channels = {}
+        for state in self._channels:
+            if state.queue and state.channel and state.channel.is_open:
+                channels.setdefault(state.queue, state.channel)
+        depths = {}
+        for queue, channel in channels.items():
+            channel.queue_declare(queue=queue, passive=True,
+                                  callback=partial(self.on_queue_depth_ok, depths, len(channels), queue))
+        self._depth_timer = self._connection.ioloop.call_later(self._depth_interval, self._poll_queue_depth)
+
+    def on_queue_depth_ok(self, depths, expected, queue, method_frame):
+        """Invoked by pika with the Queue.DeclareOk of a queue polled by
+        _poll_queue_depth, the callbacks run once every queue answered."""
+        depths[queue] = method_frame.method.message_count
+        if len(depths) < expected:
+            return
+        for call_back in self._depth_callbacks:
+            try:
+                call_back(dict(depths))
+            except Exception as e:
+                self._LOGGER.error('Queue depth callback failed: %s', e, exc_info=True)
+
+    def pause_consuming(self, reason=""):
+        """Stop deliveries by cancelling the consumer of every channel.
+
+        The channels stay open so in-flight messages can still be acknowledged,
+        and new messages wait in the broker. A prefetch of 0 would not do, it
+        means no limit in AMQP.
+
+        :param str reason: The watermark that was crossed, for logs and metrics
+
+        """
+        if self._paused or self._closing or self._draining:
+            return
+        self._paused = True
+        FLOW_PAUSES.inc(reason=reason or "manual")
+        self._LOGGER.warning('Pausing delivery, %s over its high watermark: %d messages, %d bytes in flight, rss %s',
+                             reason, self.in_flight_count(), self._in_flight_bytes, self._rss)
+        for state in self._channels:
+            if state.channel and state.channel.is_open and state.consumer_tag:
+                state.channel.basic_cancel(state.consumer_tag, partial(self.on_pause_cancelok, state))
+
+    def on_pause_cancelok(self, state, unused_frame):
+        """Invoked by pika when a consumer cancelled by pause_consuming is gone.
+        Delivery may have been resumed in the meantime."""
+        state.consumer_tag = None
+        if self._closing or self._draining or not (state.channel and state.channel.is_open):
+            return
+        if self._paused:
+            state.paused = True
+        else:
+            self.basic_consume(state)
+
+    def resume_consuming(self):
+        """Consume again on the channels paused by pause_consuming."""
+        if not self._paused:
+            return
+        self._paused = False
+        self._LOGGER.info('Resuming delivery: %d messages, %d bytes in flight, rss %s',
+                          self.in_flight_count(), self._in_flight_bytes, self._rss)
+        if self._closing or self._draining:
+            return
+        for state in self._channels:
+            if state.paused and state.channel and state.channel.is_open:
+                state.paused = False
+                self.basic_consume(state)
+
+    def acknowledge_message(self, delivery_tag, requested_at=None, channel=None):
         """Acknowledge the message delivery from RabbitMQ by sending a
         Basic.Ack RPC method for the delivery tag.
 
+        Delivery tags are scoped to a channel. If the channel that delivered
+        the message has been closed since, the broker has already requeued the
+        message and the ack is dropped.
+
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param float requested_at: perf_counter() value taken when a worker thread
+                asked for the ack, used to record how long the ack waited for the ioloop
+        :param pika.channel.Channel channel: The channel the message was delivered on
 
         """
+        channel = channel or self._channel
+        if channel is None or not channel.is_open:
+            self._LOGGER.warning('Dropping ack of message %s, its channel is closed', delivery_tag)
+            return
         self._LOGGER.debug('Acknowledging message %s', delivery_tag)
-        self._channel.basic_ack(delivery_tag)
+        channel.basic_ack(delivery_tag)
+        self._settled(channel, delivery_tag)
+        if requested_at is not None:
+            STAGE_SECONDS.observe(time.perf_counter() - requested_at, stage="ack")
+
+    def reject_message(self, delivery_tag, requeue=False, channel=None):
+        """Reject the message delivery by sending a Basic.Nack RPC method.
+
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param bool requeue: Put the message back on the queue instead of dead-lettering it
+        :param pika.channel.Channel channel: The channel the message was delivered on
+
+        """
+        channel = channel or self._channel
+        if channel is None or not channel.is_open:
+            self._LOGGER.warning('Dropping nack of message %s, its channel is closed', delivery_tag)
+            return
+        self._LOGGER.debug('Rejecting message %s, requeue %s', delivery_tag, requeue)
+        channel.basic_nack(delivery_tag, requeue=requeue)
+        self._settled(channel, delivery_tag)
 
     def stop_consuming(self):
         """Tell RabbitMQ that we would like to stop consuming by sending the
-        Basic.Cancel RPC command.
+        Basic.Cancel RPC command on every channel.
 
         """
-        if self._channel:
-            self._LOGGER.info('Sending a Basic.Cancel RPC command to RabbitMQ')
-            self._channel.basic_cancel(self.on_cancelok, self._consumer_tag)
-
-    def on_cancelok(self, unused_frame):
+        for state in self._channels:
+            if state.channel and state.channel.is_open and state.consumer_tag:
+                self._LOGGER.info('Sending a Basic.Cancel RPC command to RabbitMQ for %r', state)
+                state.channel.basic_cancel(state.consumer_tag, partial(self.on_cancelok, state))
+            elif state.channel and state.channel.is_open:
+                self.close_channel(state)
+        if self._connection.is_open and all(state.channel is None for state in self._channels):
+            self.close_connection()
+
+    def on_cancelok(self, state, unused_frame):
         """Invoked by pika when RabbitMQ acknowledges the cancellation of a consumer.
 
         At this point we will close the channel. This will invoke the
         on_channel_closed method once the channel has been closed, which will
-        in-turn close the connection.
+        in-turn close the connection once every channel is closed.
 
+        :param ConsumerChannel state: The channel of the cancelled consumer
         :param pika.frame.Method unused_frame: The Basic.CancelOk frame
 
         """
         self._LOGGER.info(
             'RabbitMQ acknowledged the cancellation of the consumer')
-        self.close_channel()
+        state.consumer_tag = None
+        self.close_channel(state)
 
-    def close_channel(self):
+    def close_channel(self, state):
         """Close the channel with RabbitMQ cleanly by issuing the
         Channel.Close RPC command.
 
         """
         self._LOGGER.info('Closing the channel')
-        self._channel.close()
+        if state.channel and state.channel.is_open:
+            state.channel.close()
 
     def run(self):
         """Run the example consumer by connecting to RabbitMQ and then
@@ -441,23 +973,104 @@ class Consumer(object):
         """
         if self.safe_stop:
             signal.signal(signal.SIGTERM, self.signal_term_handler)
-        self._connection = self.connect()
-        self._connection.ioloop.start()
+        while not self._closing:
+            self._endpoint, delay = self._endpoints.select()
+            if delay > 0:
+                self._LOGGER.info('Every broker node is in backoff, reconnecting to %s in %.2fs', self._endpoint.name, delay)
+                self._wake.wait(delay)
+            if self._drain_requested:
+                # stopped between two connections, nothing is in flight
+                self._closing = True
+                break
+            self._url = self._endpoint.url
+            self._reconnecting = False
+            previous, self._connection = self._connection, self.connect()
+            if previous is not None and hasattr(previous.ioloop, 'close'):
+                # late acks of its workers are dropped by _call_threadsafe
+                previous.ioloop.close()
+            if self._drain_requested:
+                # the signal came while switching connections, its drain went to the previous one
+                self._transport.add_callback_threadsafe(self._connection, self.drain)
+            self._connection.ioloop.start()
+            if not self._reconnecting:
+                break
+            self._reset_connection_state()
 
     def signal_term_handler(self, signal, frame):
         """Invoked when the signal mentioned in signal variable is 
-        raised. It stops the channel and connecection etc. when called on a signal.
+        raised. It starts draining the consumer on the ioloop, run() returns
+        once the in-flight messages are acknowledged or drain_timeout expires.
 
         :param signal signal: The signal number
         :param Frame frame: The Frame object
 
         """
+        self._LOGGER.info('Received signal %s, draining', signal)
+        self._drain_requested = True
+        if self._reconnecting:
+            # no connection to drain, stop waiting for the next one
+            self._wake.set()
+            return
         try:
-            self.stop()
+            self._transport.add_callback_threadsafe(self._connection, self.drain)
         except Exception as e:
             self._LOGGER.error(
                 "Could not gracefully stop connection on raised signal: " + str(e))
-        sys.exit(0)
+            sys.exit(0)
+
+    def drain(self, timeout=None):
+        """Stop taking new messages and close once the in-flight ones are done.
+
+        Sends Basic.Cancel on every channel but keeps the channels open so the
+        workers can still acknowledge what they are processing. Messages the
+        broker delivers before it processes the cancel are requeued at once.
+        The drain callbacks are started to flush buffered work, then the
+        channels and the connection are closed as soon as nothing is in flight
+        or when the timeout expires, whichever comes first. Whatever is still
+        unacknowledged at that point is redelivered by the broker.
+
+        Must be called on the ioloop thread.
+
+        :param float timeout: Seconds to wait for in-flight messages, drain_timeout by default
+
+        """
+        if self._draining or self._closing:
+            return
+        self._draining = True
+        deadline = time.monotonic() + (self.drain_timeout if timeout is None else timeout)
+        self._LOGGER.info('Draining, %d messages in flight', self.in_flight_count())
+        for state in self._channels:
+            if state.channel and state.channel.is_open and state.consumer_tag:
+                state.channel.basic_cancel(state.consumer_tag, partial(self.on_drain_cancelok, state))
+        for channel in list(self._batches):
+            self._flush_batch(channel)
+        for call_back in self._on_drain_callbacks:
+            threading.Thread(target=call_back, name='drain-callback', daemon=True).start()
+        self._check_drained(deadline)
+
+    def on_drain_cancelok(self, state, unused_frame):
+        """Invoked by pika when the broker confirmed the cancel sent by drain.
+        The channel stays open for the acknowledgements of in-flight messages."""
+        self._LOGGER.info('Consumer cancelled for %r', state)
+        state.consumer_tag = None
+
+    def _check_drained(self, deadline):
+        pending = self.in_flight_count()
+        if pending and time.monotonic() < deadline:
+            self._connection.ioloop.call_later(self.DRAIN_POLL_INTERVAL, partial(self._check_drained, deadline))
+            return
+        if pending:
+            self._LOGGER.warning('Drain timed out, %d messages will be redelivered', pending)
+        else:
+            self._LOGGER.info('Drained, closing')
+        # the consumers are already cancelled (or being cancelled), close the
+        # channels straight away, on_channel_closed then closes the connection
+        self._closing = True
+        open_channels = [state for state in self._channels if state.channel and state.channel.is_open]
+        for state in open_channels:
+            self.close_channel(state)
+        if not open_channels and self._connection.is_open:
+            self.close_connection()
 
     def stop(self):
         """Cleanly shutdown the connection to RabbitMQ by stopping the consumer
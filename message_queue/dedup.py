@@ -0,0 +1,176 @@
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger("consumer")
+
+DEDUP_MODES = ("off", "memory", "redis")
+
+# what claim returns: the message is now claimed, or another copy of it is being processed, or was
+CLAIMED = "claimed"
+PENDING = "pending"
+DONE = "done"
+
+
+def fingerprint(event_data, properties=None, body=None):
+    """Stable key of an event, identical for every delivery of the same message.
+
+    The AMQP message_id is used when the publisher set one. Otherwise the key
+    hashes the request url, the user (its token, or the user_id of the
+    response) and the timestamp of the message. Messages without a timestamp
+    are keyed on the hash of their raw body instead, as url and user alone
+    would merge distinct events of the same user.
+
+    :param dict event_data: The decoded message
+    :param pika.spec.BasicProperties properties: Properties of the delivery
+    :param bytes body: The raw message body
+    :rtype: str
+
+    """
+    message_id = getattr(properties, "message_id", None)
+    if message_id:
+        return "id:" + str(message_id)
+
+    timestamp = getattr(properties, "timestamp", None) or event_data.get("timestamp")
+    if not timestamp and body is not None:
+        return "body:" + hashlib.sha1(body).hexdigest()
+
+    request = event_data.get("request") or {}
+    headers = request.get("headers") or {}
+    user = headers.get("authorization") or headers.get("Authorization")
+    if not user:
+        response_data = (event_data.get("response") or {}).get("data") or {}
+        user = response_data.get("user_id", "") if isinstance(response_data, dict) else ""
+    key = "\x00".join((str(request.get("url", "")), str(user), str(timestamp)))
+    return "event:" + hashlib.sha1(key.encode("utf8")).hexdigest()
+
+
+class MemoryDedupStore(object):
+    """Bounded LRU of the fingerprints seen by this process.
+
+    :param int max_size: Fingerprints kept, the least recently used are evicted first
+    :param float ttl: Seconds a processed fingerprint is remembered
+
+    """
+
+    def __init__(self, max_size=100000, ttl=86400):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                return entry[0]
+            self._entries[key] = (PENDING, now + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return CLAIMED
+
+    def commit(self, key):
+        with self._lock:
+            self._entries[key] = (DONE, time.monotonic() + self.ttl)
+
+    def release(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RedisDedupStore(object):
+    """Fingerprints shared by every worker through Redis, so a message
+    redelivered to another process is recognised too.
+
+    A claim is a SET NX with a short expiry, which a worker that dies while
+    processing gives up on its own; commit extends it to the full ttl.
+
+    :param float ttl: Seconds a processed fingerprint is remembered
+    :param float pending_ttl: Seconds a claim is held while the message is processed
+
+    """
+
+    KEY_PREFIX = "event_collector:dedup:"
+
+    def __init__(self, host, port=6379, password=None, db=0, ttl=86400, pending_ttl=300):
+        if redis is None:
+            raise RuntimeError("DEDUP_MODE=redis requires the redis package")
+        self.ttl = int(ttl)
+        self.pending_ttl = int(pending_ttl)
+        self._client = redis.StrictRedis(host=host, port=int(port or 6379), password=password, db=int(db or 0))
+
+    def claim(self, key):
+        if self._client.set(self.KEY_PREFIX + key, PENDING, nx=True, ex=self.pending_ttl):
+            return CLAIMED
+        # a claim released or expired since the SET counts as pending, the copy comes back
+        return DONE if self._client.get(self.KEY_PREFIX + key) == DONE.encode() else PENDING
+
+    def commit(self, key):
+        self._client.set(self.KEY_PREFIX + key, DONE, ex=self.ttl)
+
+    def release(self, key):
+        self._client.delete(self.KEY_PREFIX + key)
+
+
+class Deduplicator(object):
+    """Drops messages whose fingerprint was already processed.
+
+    claim is called before a message goes to the sinks and returns CLAIMED,
+    or DONE for a duplicate of a processed message, which the caller
+    acknowledges without processing. A claimed message is either committed
+    once processed or released so a redelivery is processed again. A copy
+    arriving while the first one is still being processed gets PENDING and
+    is requeued rather than acknowledged: the first copy may fail, and its
+    own acknowledgement is dropped when its channel was lost, which is how
+    the copy got redelivered. When the store is unreachable messages are
+    processed rather than dropped.
+
+    :param store: MemoryDedupStore, RedisDedupStore or any object with claim, commit and release
+
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    @classmethod
+    def from_config(cls, config):
+        mode = (config.DEDUP_MODE or "off").lower()
+        if mode not in DEDUP_MODES:
+            raise ValueError("DEDUP_MODE must be one of {}".format(", ".join(DEDUP_MODES)))
+        if mode == "off":
+            return None
+        if mode == "redis":
+            store = RedisDedupStore(host=config.REDIS_HOST, port=config.REDIS_PORT, password=config.REDIS_PASSWORD,
+                                    db=config.REDIS_DB, ttl=float(config.DEDUP_TTL_SECONDS))
+        else:
+            store = MemoryDedupStore(max_size=int(config.DEDUP_CACHE_SIZE), ttl=float(config.DEDUP_TTL_SECONDS))
+        return cls(store)
+
+    def claim(self, key):
+        try:
+            return self.store.claim(key)
+        except Exception as e:
+            logger.warning("Dedup store unavailable, processing %s: %s", key, e)
+            return CLAIMED
+
+    def commit(self, key):
+        try:
+            self.store.commit(key)
+        except Exception as e:
+            logger.warning("Could not record %s as processed: %s", key, e)
+
+    def release(self, key):
+        try:
+            self.store.release(key)
+        except Exception as e:
+            logger.warning("Could not release %s: %s", key, e)
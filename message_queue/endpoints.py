@@ -0,0 +1,94 @@
+import time
+import random
+import logging
+from urllib.parse import urlsplit
+
+logger = logging.getLogger("consumer")
+
+
+def parse_urls(urls):
+    """Broker urls from a list or a comma separated string, like RABBITMQ_URI."""
+    if isinstance(urls, (list, tuple)):
+        return [url for url in urls if url]
+    return [url.strip() for url in (urls or "").split(",") if url.strip()]
+
+
+def describe(url):
+    """The host and port of a broker url, without its credentials, for logs and metrics."""
+    parts = urlsplit(url)
+    if not parts.hostname:
+        return parts.scheme or url
+    return "{}:{}".format(parts.hostname, parts.port) if parts.port else parts.hostname
+
+
+class BrokerEndpoint(object):
+
+    def __init__(self, url):
+        self.url = url
+        self.name = describe(url)
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def __repr__(self):
+        return '<BrokerEndpoint {} failures={}>'.format(self.name, self.failures)
+
+
+class BrokerEndpoints(object):
+    """The broker nodes a connection may be opened to, and their health.
+
+    An endpoint that could not be connected to, or whose connection was lost,
+    is not tried again before a backoff doubling with every failure in a row,
+    from backoff up to max_backoff, drawn between half and all of it so the
+    workers of a cluster do not reconnect in lockstep. select() prefers the
+    first endpoint in list order that is out of its backoff, so losing a node
+    moves the connection to the next one right away. A successful connection
+    resets the failures of its endpoint.
+
+    :param list urls: AMQP urls, in order of preference
+    :param float backoff: Seconds before the first retry of a failed endpoint
+    :param float max_backoff: Longest backoff
+
+    """
+
+    def __init__(self, urls, backoff=0.25, max_backoff=30.0):
+        if not urls:
+            raise ValueError("At least one broker url is needed")
+        self.endpoints = [BrokerEndpoint(url) for url in urls]
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def _find(self, url):
+        for endpoint in self.endpoints:
+            if endpoint.url == url:
+                return endpoint
+        return None
+
+    def select(self):
+        """The endpoint to connect to next and the seconds to wait before it.
+
+        :return: (BrokerEndpoint, delay), delay is 0 unless every endpoint is in its backoff
+
+        """
+        now = time.monotonic()
+        for endpoint in self.endpoints:
+            if endpoint.retry_at <= now:
+                return endpoint, 0.0
+        endpoint = min(self.endpoints, key=lambda each: each.retry_at)
+        return endpoint, endpoint.retry_at - now
+
+    def failed(self, url):
+        """Put an endpoint in backoff, returns the seconds it lasts."""
+        endpoint = self._find(url)
+        if endpoint is None:
+            return 0.0
+        endpoint.failures += 1
+        backoff = min(self.max_backoff, self.backoff * 2 ** (endpoint.failures - 1))
+        backoff = random.uniform(backoff / 2, backoff)
+        endpoint.retry_at = time.monotonic() + backoff
+        return backoff
+
+    def succeeded(self, url):
+        endpoint = self._find(url)
+        if endpoint is not None:
+            endpoint.failures = 0
+            endpoint.retry_at = 0.0
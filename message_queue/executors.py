@@ -0,0 +1,423 @@
+import os
+import time
+import queue
+import zlib
+import asyncio
+import logging
+import threading
+import itertools
+import multiprocessing
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from monitoring.metrics import PRIORITY_WAIT_SECONDS
+
+logger = logging.getLogger("consumer")
+
+EXECUTION_MODES = ("thread", "pool", "asyncio", "partitioned", "process", "priority")
+
+# priority classes from the most to the least urgent, with their weights
+DEFAULT_PRIORITY_WEIGHTS = OrderedDict((("realtime", 8), ("default", 3), ("bulk", 1)))
+
+
+def parse_priority_weights(value):
+    """Priority classes and their weights from a string like realtime:8,default:3,bulk:1,
+    listed from the most to the least urgent."""
+    weights = OrderedDict()
+    for item in (value or "").split(","):
+        if item.strip():
+            name, _, weight = item.partition(":")
+            weights[name.strip()] = max(1, int(weight or 1))
+    return weights or OrderedDict(DEFAULT_PRIORITY_WEIGHTS)
+
+
+class ThreadPerMessageExecutor(object):
+    """Runs every message on a fresh thread. This is the historical behaviour
+    of the worker, concurrency is bounded only by the consumer prefetch."""
+
+    def __init__(self, workers=None):
+        self.workers = workers
+
+    def submit(self, fn, *args):
+        t = threading.Thread(target=fn, args=args)
+        t.start()
+        return t
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class WorkerPoolExecutor(object):
+    """Runs messages on a fixed set of long lived threads."""
+
+    def __init__(self, workers=16):
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="event-worker")
+
+    def submit(self, fn, *args):
+        return self._pool.submit(fn, *args)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+class ElasticPoolExecutor(object):
+    """Runs messages on a pool of long lived threads whose size can change
+    while it runs, between workers and max_workers.
+
+    A shrinking pool records how many threads are in excess, and threads stop
+as they finish the message they are on until none are, so size is always
+the number of threads left running once they do. Growing first cancels
+stops that are still pending before starting new threads.
+    The pool counts the messages it completed and the seconds its threads
+    were busy with them, which an autoscaler turns into a rate and a time
+    per message.
+    """
+
+    _STOP = object()
+    _WAKE = object()
+
+    def __init__(self, workers=16, max_workers=None):
+        self.min_workers = workers
+        self.max_workers = max(workers, max_workers or workers)
+        self.size = 0
+        self._excess = 0
+        self._wakes = 0
+        self.completed = 0
+        self.busy_seconds = 0.0
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = set()
+        self._names = itertools.count()
+        self.resize(workers)
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._tasks.put((future, fn, args))
+        return future
+
+    def _retire(self):
+        with self._lock:
+            if not self._excess:
+                return False
+            self._excess -= 1
+            self._threads.discard(threading.current_thread())
+            return True
+
+    def _run(self):
+        while True:
+            if self._retire():
+                return
+            item = self._tasks.get()
+            if item is self._WAKE:
+                with self._lock:
+                    self._wakes -= 1
+                continue
+            if item is self._STOP:
+                with self._lock:
+                    self._threads.discard(threading.current_thread())
+                return
+            future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            started_at = time.perf_counter()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                logger.error("Message processing failed: %s", e, exc_info=True)
+                future.set_exception(e)
+            with self._lock:
+                self.completed += 1
+                self.busy_seconds += time.perf_counter() - started_at
+
+    def resize(self, size):
+        """Grow or shrink the pool to size threads, within its bounds, returns the new size."""
+        size = max(self.min_workers, min(self.max_workers, size))
+        with self._lock:
+            if size > self.size:
+                cancelled = min(self._excess, size - self.size)
+                self._excess -= cancelled
+                for _ in range(size - self.size - cancelled):
+                    thread = threading.Thread(target=self._run, name="event-worker-{}".format(next(self._names)), daemon=True)
+                    self._threads.add(thread)
+                    thread.start()
+            elif size < self.size:
+                self._excess += self.size - size
+                self._wakes += self.size - size
+                # wakes the idle threads, busy ones check after their message
+                for _ in range(self.size - size):
+                    self._tasks.put(self._WAKE)
+            self.size = size
+        return size
+
+    def live_threads(self):
+        """Threads still running, more than size while a shrink is in progress."""
+        with self._lock:
+            return len(self._threads)
+
+    def backlog(self):
+        """Messages waiting for a thread."""
+        with self._lock:
+            return max(0, self._tasks.qsize() - self._wakes)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            threads = list(self._threads)
+            for _ in threads:
+                self._tasks.put(self._STOP)
+            self.size = 0
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+class AsyncioExecutor(object):
+    """Admits messages through an asyncio event loop running on its own thread.
+
+    The sinks use blocking HTTP clients, so each message still runs on a
+    thread of the loop's executor. The loop bounds concurrency with a
+    semaphore, which lets the scheduling overhead be compared with the thread
+    based modes and gives asyncio native sinks a place to plug in.
+    """
+
+    def __init__(self, workers=64):
+        self.workers = workers
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="event-async")
+        self._loop.set_default_executor(self._executor)
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name="event-loop", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.workers)
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _run(self, fn, args):
+        async with self._semaphore:
+            try:
+                return await self._loop.run_in_executor(None, fn, *args)
+            except Exception as e:
+                logger.error("Message processing failed: %s", e, exc_info=True)
+
+    def submit(self, fn, *args):
+        return asyncio.run_coroutine_threadsafe(self._run(fn, args), self._loop)
+
+    def shutdown(self, wait=True):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._executor.shutdown(wait=wait)
+
+
+class PartitionedExecutor(object):
+    """Runs messages on a fixed number of serial lanes.
+
+    submit_keyed sends every message with the same key to the same lane, where
+    messages run one after the other in arrival order, so the events of one
+    account can not overtake each other while the lanes run in parallel.
+    Messages without a key are spread over the lanes round robin.
+    """
+
+    _STOP = object()
+
+    def __init__(self, workers=16):
+        self.workers = workers
+        self._lanes = [queue.Queue() for _ in range(workers)]
+        self._next_lane = itertools.count()
+        self._threads = []
+        for index, lane in enumerate(self._lanes):
+            thread = threading.Thread(target=self._run_lane, args=(lane,), name="event-lane-{}".format(index), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run_lane(self, lane):
+        while True:
+            item = lane.get()
+            if item is self._STOP:
+                return
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error("Message processing failed: %s", e, exc_info=True)
+
+    def lane_of(self, key):
+        """Index of the lane the messages of key run on."""
+        if key is None:
+            return next(self._next_lane) % self.workers
+        return zlib.crc32(str(key).encode("utf8")) % self.workers
+
+    def submit_keyed(self, key, fn, *args):
+        self._lanes[self.lane_of(key)].put((fn, args))
+
+    def submit(self, fn, *args):
+        self.submit_keyed(None, fn, *args)
+
+    def backlog(self):
+        """Messages waiting in each lane."""
+        return [lane.qsize() for lane in self._lanes]
+
+    def shutdown(self, wait=True):
+        for lane in self._lanes:
+            lane.put(self._STOP)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class PriorityPoolExecutor(object):
+    """Runs messages on a fixed set of threads, from one queue per priority class.
+
+    submit_prioritized queues a message in its class. A free thread picks the
+    class it serves next by smooth weighted round robin over the classes with
+    messages waiting, so under load each class gets a share of the threads in
+    proportion to its weight and none starves, while a class alone may use
+    every thread. The last, least urgent class never runs on more than
+    workers - reserved threads at once, which keeps threads free for urgent
+    messages arriving behind long bulk jobs.
+    """
+
+    def __init__(self, workers=16, weights=None, reserved=0):
+        self.workers = workers
+        self.weights = OrderedDict(weights or DEFAULT_PRIORITY_WEIGHTS)
+        self.classes = list(self.weights)
+        self.default = "default" if "default" in self.weights else self.classes[-1]
+        self.lowest = self.classes[-1]
+        self.lowest_limit = max(1, workers - reserved)
+        self._queues = dict((name, deque()) for name in self.classes)
+        self._credit = dict.fromkeys(self.classes, 0)
+        self._running = dict.fromkeys(self.classes, 0)
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._threads = []
+        for index in range(workers):
+            thread = threading.Thread(target=self._run, name="event-worker-{}".format(index), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit_prioritized(self, priority, fn, *args):
+        """Queue a message in a priority class, the default class when priority is None or unknown."""
+        if priority not in self._queues:
+            priority = self.default
+        with self._condition:
+            self._queues[priority].append((fn, args, time.perf_counter()))
+            self._condition.notify()
+
+    def submit(self, fn, *args):
+        self.submit_prioritized(None, fn, *args)
+
+    def _next_class(self):
+        # smooth weighted round robin, called with the condition held
+        eligible = [name for name in self.classes if self._queues[name]
+                    and (name != self.lowest or self._running[name] < self.lowest_limit)]
+        if not eligible:
+            return None
+        best = None
+        for name in eligible:
+            self._credit[name] += self.weights[name]
+            if best is None or self._credit[name] > self._credit[best]:
+                best = name
+        self._credit[best] -= sum(self.weights[name] for name in eligible)
+        return best
+
+    def _run(self):
+        while True:
+            with self._condition:
+                name = self._next_class()
+                while name is None:
+                    if self._stopping:
+                        return
+                    self._condition.wait()
+                    name = self._next_class()
+                fn, args, queued_at = self._queues[name].popleft()
+                self._running[name] += 1
+            PRIORITY_WAIT_SECONDS.observe(time.perf_counter() - queued_at, priority=name)
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error("Message processing failed: %s", e, exc_info=True)
+            finally:
+                with self._condition:
+                    self._running[name] -= 1
+                    if name == self.lowest:
+                        self._condition.notify()
+
+    def backlog(self):
+        """Messages waiting in each priority class."""
+        with self._condition:
+            return dict((name, len(waiting)) for name, waiting in self._queues.items())
+
+    def shutdown(self, wait=True):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class ProcessOffloadExecutor(object):
+    """Runs messages on a fixed set of threads like WorkerPoolExecutor, and
+    gives them a pool of processes to offload their CPU bound stage to.
+
+    A message thread calls offload with the decode and transform step and
+    waits for its result, which leaves the GIL to the threads doing sink I/O.
+    Work items and results should be compact bytes, they are pickled across
+    the process boundary. The processes are spawned, not forked from the
+    threaded consumer, and run initializer first.
+
+    :param int workers: Message threads
+    :param int processes: Transform processes, one per CPU by default
+    :param callable initializer: Run once in every transform process
+
+    """
+
+    def __init__(self, workers=16, processes=None, initializer=None):
+        self.workers = workers
+        self.processes = processes or os.cpu_count()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="event-worker")
+        self._processes = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"),
+                                              initializer=initializer)
+
+    def submit(self, fn, *args):
+        return self._pool.submit(fn, *args)
+
+    def offload(self, fn, *args):
+        """Run fn(*args) in a transform process, returns a Future of its result."""
+        return self._processes.submit(fn, *args)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+        # always waited for, a transform takes milliseconds and processes left
+        # behind by a worker exiting right after would never stop
+        self._processes.shutdown(wait=True, cancel_futures=True)
+
+
+def create_executor(mode="thread", workers=None, processes=None, initializer=None, max_workers=None, weights=None, reserved=0):
+    """Build the executor running _process_message for an execution mode.
+
+    :param str mode: One of EXECUTION_MODES
+    :param int workers: Pool size for the pool, asyncio, process and priority modes, lane count for the partitioned mode
+    :param int max_workers: Size the pool mode may grow to, its pool is then resizable
+    :param dict weights: Priority classes of the priority mode and their weights, see parse_priority_weights
+    :param int reserved: Threads of the priority mode the least urgent class may not use
+    :param int processes: Transform processes of the process mode
+    :param callable initializer: Run in every transform process of the process mode
+
+    """
+    if mode == "thread":
+        return ThreadPerMessageExecutor()
+    if mode == "pool":
+        if max_workers:
+            return ElasticPoolExecutor(workers or 16, max_workers)
+        return WorkerPoolExecutor(workers or 16)
+    if mode == "asyncio":
+        return AsyncioExecutor(workers or 64)
+    if mode == "partitioned":
+        return PartitionedExecutor(workers or 16)
+    if mode == "process":
+        return ProcessOffloadExecutor(workers or 16, processes, initializer)
+    if mode == "priority":
+        return PriorityPoolExecutor(workers or 16, weights, reserved)
+    raise ValueError("Unknown execution mode {}".format(mode))
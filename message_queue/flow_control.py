@@ -0,0 +1,71 @@
+import os
+import logging
+
+logger = logging.getLogger("consumer")
+
+try:
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+
+def current_rss():
+    """Resident set size of this process in bytes, None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Watermarks(object):
+    """High and low watermarks on the resources held by in-flight messages.
+
+    Delivery pauses as soon as any measure reaches its high watermark and
+    resumes once every measure is back under its low watermark. A high
+    watermark of 0 disables its measure, a missing low watermark defaults to
+    half of the high one.
+
+    :param int high_count: Unacknowledged messages
+    :param int high_bytes: Body bytes of the unacknowledged messages
+    :param int high_rss: Resident set size of the process in bytes
+
+    """
+
+    def __init__(self, high_count=0, low_count=None, high_bytes=0, low_bytes=None, high_rss=0, low_rss=None):
+        self.limits = {}
+        for name, high, low in (("count", high_count, low_count), ("bytes", high_bytes, low_bytes), ("rss", high_rss, low_rss)):
+            if high:
+                self.limits[name] = (high, high // 2 if low is None else low)
+
+    @classmethod
+    def from_config(cls, config):
+        """Build the watermarks from the FLOW_* settings, None when none is set."""
+        def setting(name, scale=1):
+            value = getattr(config, name, None)
+            return int(float(value) * scale) if value else None
+
+        mb = 1024 * 1024
+        watermarks = cls(
+            high_count=setting("FLOW_HIGH_IN_FLIGHT") or 0, low_count=setting("FLOW_LOW_IN_FLIGHT"),
+            high_bytes=setting("FLOW_HIGH_IN_FLIGHT_MB", mb) or 0, low_bytes=setting("FLOW_LOW_IN_FLIGHT_MB", mb),
+            high_rss=setting("FLOW_HIGH_RSS_MB", mb) or 0, low_rss=setting("FLOW_LOW_RSS_MB", mb)
+        )
+        return watermarks if watermarks.limits else None
+
+    @property
+    def watches_rss(self):
+        return "rss" in self.limits
+
+    def exceeded(self, count, nbytes, rss=None):
+        """Name of the first measure at or above its high watermark, or None."""
+        values = {"count": count, "bytes": nbytes, "rss": rss}
+        for name, (high, _) in self.limits.items():
+            if values[name] is not None and values[name] >= high:
+                return name
+        return None
+
+    def relieved(self, count, nbytes, rss=None):
+        """Whether every measure is under its low watermark."""
+        values = {"count": count, "bytes": nbytes, "rss": rss}
+        return all(values[name] is None or values[name] < low for name, (_, low) in self.limits.items())
@@ -0,0 +1,627 @@
+"""In-process AMQP broker implementing the subset of pika's asynchronous API
+used by Consumer and Publisher.
+
+It keeps RabbitMQ's semantics where the worker depends on them: exchanges
+(direct, topic, fanout and the default exchange), bindings, per channel
+prefetch, delivery tags scoped to a channel, acks and nacks (multiple and
+requeue), redelivery of unacked messages when a channel or connection closes,
+dead-lettering through the x-dead-letter-exchange queue argument, and closing
+the channel with PRECONDITION_FAILED on an unknown delivery tag.
+
+    broker = InMemoryBroker()
+    consumer = Consumer(amqp_url="memory://", exchange="events", queue="q",
+                        binding_keys=["q"], transport=InMemoryTransport(broker))
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import Counter, deque, namedtuple
+
+import pika
+from pika import exceptions, frame, spec
+
+logger = logging.getLogger("consumer")
+
+PRECONDITION_FAILED = 406
+NOT_FOUND = 404
+
+_Message = namedtuple("_Message", ("body", "properties", "exchange", "routing_key", "redelivered"))
+
+
+class InMemoryIOLoop(object):
+    """Minimal callback and timer loop with the interface of pika's ioloop."""
+
+    def __init__(self):
+        self._callbacks = deque()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+
+    def add_callback_threadsafe(self, callback):
+        with self._condition:
+            self._callbacks.append(callback)
+            self._condition.notify()
+
+    add_callback = add_callback_threadsafe
+
+    def call_later(self, delay, callback):
+        handle = [time.monotonic() + delay, next(self._sequence), callback]
+        with self._condition:
+            heapq.heappush(self._timers, handle)
+            self._condition.notify()
+        return handle
+
+    def remove_timeout(self, handle):
+        with self._condition:
+            handle[2] = None
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+    def start(self):
+        self._stopping = False
+        while True:
+            with self._condition:
+                while not self._stopping and not self._callbacks and not self._due_timer():
+                    timeout = self._timers[0][0] - time.monotonic() if self._timers else None
+                    self._condition.wait(timeout)
+                if self._stopping:
+                    return
+                if self._callbacks:
+                    callback = self._callbacks.popleft()
+                else:
+                    callback = heapq.heappop(self._timers)[2]
+            if callback is not None:
+                callback()
+
+    def _due_timer(self):
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+        return bool(self._timers) and self._timers[0][0] <= time.monotonic()
+
+
+class _Queue(object):
+
+    def __init__(self, name, durable, exclusive, arguments):
+        self.name = name
+        self.durable = durable
+        self.exclusive = exclusive
+        self.arguments = arguments or {}
+        self.messages = deque()
+        self.consumers = deque()
+
+
+class _Consumer(object):
+
+    def __init__(self, channel, queue, tag, callback, auto_ack):
+        self.channel = channel
+        self.queue = queue
+        self.tag = tag
+        self.callback = callback
+        self.auto_ack = auto_ack
+
+
+class InMemoryBroker(object):
+    """Thread safe broker state shared by every InMemoryConnection.
+
+    The counters in stats make lost and duplicated acknowledgements visible to
+    stress tests: published, delivered, redelivered, acked, nacked,
+    dead_lettered, unroutable, dropped and unknown_ack. With track_messages,
+    the deliveries, acks and rejects without requeue of every message are also
+    counted in settlements, by the message_id property of the message.
+
+    :param bool track_messages: Count the settlements of every message
+    """
+
+    def __init__(self, track_messages=False):
+        self._lock = threading.RLock()
+        self._exchanges = {"": "direct"}
+        self._bindings = {}
+        self._queues = {}
+        self._connections = []
+        self._queue_names = itertools.count(1)
+        self._consumer_tags = itertools.count(1)
+        self.available = True
+        self.stats = dict.fromkeys(("published", "delivered", "redelivered", "acked", "nacked",
+                                    "dead_lettered", "unroutable", "dropped", "unknown_ack"), 0)
+        self.settlements = dict((kind, Counter()) for kind in ("delivered", "acked", "rejected")) if track_messages else None
+
+    # management helpers, used by benchmarks and fault injection
+
+    def declare_queue(self, name, durable=True, arguments=None):
+        with self._lock:
+            return self._declare_queue(name, durable, False, arguments).name
+
+    def declare_exchange(self, name, exchange_type="direct"):
+        with self._lock:
+            self._exchanges.setdefault(name, exchange_type)
+
+    def bind(self, queue, exchange, routing_key):
+        with self._lock:
+            self._bindings.setdefault(exchange, []).append((queue, routing_key))
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        """Route a message from outside any connection, returns the number of queues it reached."""
+        with self._lock:
+            return self._route(exchange, routing_key, body, properties or pika.BasicProperties())
+
+    def message_count(self, queue):
+        with self._lock:
+            return len(self._queues[queue].messages)
+
+    def unacked_count(self, queue=None):
+        with self._lock:
+            return sum(1 for connection in self._connections for channel in connection._channels.values()
+                       for message in channel._unacked.values()
+                       if queue is None or message[0] == queue)
+
+    def close_channels(self, reply_code=320, reply_text="CONNECTION_FORCED - fault injected"):
+        """Close every open channel as the broker would, requeueing unacked messages."""
+        with self._lock:
+            channels = [channel for connection in self._connections for channel in connection._channels.values()]
+        for channel in channels:
+            channel._closed_by_broker(reply_code, reply_text)
+
+    def close_connections(self, reply_code=320, reply_text="CONNECTION_FORCED - fault injected"):
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection._closed_by_broker(reply_code, reply_text)
+
+    # internals
+
+    def _track(self, kind, messages):
+        if self.settlements is not None:
+            self.settlements[kind].update(message.properties.message_id for message in messages)
+
+    def _declare_queue(self, name, durable, exclusive, arguments):
+        if not name:
+            name = "amq.gen-{}".format(next(self._queue_names))
+        queue = self._queues.get(name)
+        if queue is None:
+            queue = self._queues[name] = _Queue(name, durable, exclusive, arguments)
+        return queue
+
+    def _matches(self, exchange_type, binding_key, routing_key):
+        if exchange_type == "fanout":
+            return True
+        if exchange_type != "topic":
+            return binding_key == routing_key
+        return self._topic_match(binding_key.split("."), routing_key.split("."))
+
+    def _topic_match(self, pattern, words):
+        if not pattern:
+            return not words
+        if pattern[0] == "#":
+            return any(self._topic_match(pattern[1:], words[index:]) for index in range(len(words) + 1))
+        if not words:
+            return False
+        return (pattern[0] == "*" or pattern[0] == words[0]) and self._topic_match(pattern[1:], words[1:])
+
+    def _route(self, exchange, routing_key, body, properties):
+        self.stats["published"] += 1
+        if exchange == "":
+            targets = [routing_key] if routing_key in self._queues else []
+        else:
+            exchange_type = self._exchanges.get(exchange)
+            if exchange_type is None:
+                self.stats["unroutable"] += 1
+                return 0
+            targets = []
+            for queue, binding_key in self._bindings.get(exchange, []):
+                if queue not in targets and self._matches(exchange_type, binding_key or "", routing_key or ""):
+                    targets.append(queue)
+        if not targets:
+            self.stats["unroutable"] += 1
+            return 0
+        for name in targets:
+            self._queues[name].messages.append(_Message(body, properties, exchange, routing_key, False))
+            self._dispatch(self._queues[name])
+        return len(targets)
+
+    def _dispatch(self, queue):
+        while queue.messages and queue.consumers:
+            for _ in range(len(queue.consumers)):
+                consumer = queue.consumers[0]
+                queue.consumers.rotate(-1)
+                if consumer.channel._has_capacity():
+                    break
+            else:
+                return
+            message = queue.messages.popleft()
+            consumer.channel._deliver(consumer, queue, message)
+
+    def _requeue(self, queue_name, messages):
+        queue = self._queues.get(queue_name)
+        if queue is None:
+            self.stats["dropped"] += len(messages)
+            return
+        for message in reversed(messages):
+            queue.messages.appendleft(message._replace(redelivered=True))
+        self._dispatch(queue)
+
+    def _dead_letter(self, queue_name, message):
+        queue = self._queues.get(queue_name)
+        exchange = queue.arguments.get("x-dead-letter-exchange") if queue else None
+        if exchange is None:
+            self.stats["dropped"] += 1
+            return
+        routing_key = queue.arguments.get("x-dead-letter-routing-key", message.routing_key)
+        properties = message.properties
+        headers = dict(properties.headers or {})
+        headers["x-death"] = [{"queue": queue_name, "reason": "rejected", "exchange": message.exchange,
+                               "routing-keys": [message.routing_key], "count": 1}]
+        properties = pika.BasicProperties(app_id=properties.app_id, content_type=properties.content_type,
+                                          delivery_mode=properties.delivery_mode, priority=properties.priority,
+                                          message_id=properties.message_id, headers=headers)
+        self.stats["dead_lettered"] += 1
+        self._route(exchange, routing_key, message.body, properties)
+
+    def _cancel_consumers(self, channel):
+        for queue in self._queues.values():
+            for consumer in list(queue.consumers):
+                if consumer.channel is channel:
+                    queue.consumers.remove(consumer)
+
+
+class InMemoryChannel(object):
+
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.channel_number = channel_number
+        self._broker = connection._broker
+        self._prefetch_count = 0
+        self._delivery_tags = itertools.count(1)
+        self._unacked = {}
+        self._consumers = {}
+        self._on_close_callbacks = []
+        self._on_cancel_callbacks = []
+        # closed at the broker, and as seen by the client once the close reached its ioloop
+        self._closed = False
+        self._client_closed = False
+
+    def __repr__(self):
+        return "<InMemoryChannel number={} open={}>".format(self.channel_number, self.is_open)
+
+    @property
+    def is_open(self):
+        return not self._client_closed
+
+    @property
+    def is_closed(self):
+        return self._client_closed
+
+    def _reply(self, callback, method):
+        if callback:
+            self.connection.ioloop.add_callback_threadsafe(lambda: callback(frame.Method(self.channel_number, method)))
+
+    def _ensure_open(self):
+        """Raise like pika on a channel the client knows is closed. Returns False
+        when the broker closed it but the client was not told yet, the frames
+        sent meanwhile are discarded like RabbitMQ does."""
+        if self._client_closed:
+            raise exceptions.ChannelWrongStateError("Channel is closed.")
+        return not self._closed
+
+    def add_on_close_callback(self, callback):
+        self._on_close_callbacks.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        self._on_cancel_callbacks.append(callback)
+
+    def exchange_declare(self, exchange, exchange_type="direct", passive=False, durable=False,
+                         auto_delete=False, internal=False, arguments=None, callback=None):
+        if not self._ensure_open():
+            return
+        with self._broker._lock:
+            if passive and exchange not in self._broker._exchanges:
+                self._closed_by_broker(NOT_FOUND, "NOT_FOUND - no exchange '{}'".format(exchange))
+                return
+            self._broker._exchanges.setdefault(exchange, exchange_type)
+        self._reply(callback, spec.Exchange.DeclareOk())
+
+    def queue_declare(self, queue, passive=False, durable=False, exclusive=False, auto_delete=False,
+                      arguments=None, callback=None):
+        if not self._ensure_open():
+            return
+        with self._broker._lock:
+            if passive:
+                declared = self._broker._queues.get(queue)
+                if declared is None:
+                    self._closed_by_broker(NOT_FOUND, "NOT_FOUND - no queue '{}'".format(queue))
+                    return
+            else:
+                declared = self._broker._declare_queue(queue, durable, exclusive, arguments)
+            method = spec.Queue.DeclareOk(declared.name, len(declared.messages), len(declared.consumers))
+        self._reply(callback, method)
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None, callback=None):
+        if not self._ensure_open():
+            return
+        with self._broker._lock:
+            if queue not in self._broker._queues or exchange not in self._broker._exchanges:
+                self._closed_by_broker(NOT_FOUND, "NOT_FOUND - no queue '{}' or exchange '{}'".format(queue, exchange))
+                return
+            bindings = self._broker._bindings.setdefault(exchange, [])
+            if (queue, routing_key) not in bindings:
+                bindings.append((queue, routing_key))
+        self._reply(callback, spec.Queue.BindOk())
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False, callback=None):
+        if not self._ensure_open():
+            return
+        with self._broker._lock:
+            self._prefetch_count = prefetch_count
+            for consumer in self._consumers.values():
+                self._broker._dispatch(consumer.queue)
+        self._reply(callback, spec.Basic.QosOk())
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, exclusive=False,
+                      consumer_tag=None, arguments=None, callback=None):
+        if not self._ensure_open():
+            return
+        with self._broker._lock:
+            declared = self._broker._queues.get(queue)
+            if declared is None:
+                self._closed_by_broker(NOT_FOUND, "NOT_FOUND - no queue '{}'".format(queue))
+                return None
+            consumer_tag = consumer_tag or "ctag{}.{}".format(self.channel_number, next(self._broker._consumer_tags))
+            consumer = _Consumer(self, declared, consumer_tag, on_message_callback, auto_ack)
+            self._consumers[consumer_tag] = consumer
+            declared.consumers.append(consumer)
+            self._reply(callback, spec.Basic.ConsumeOk(consumer_tag))
+            self._broker._dispatch(declared)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag="", callback=None):
+        if not self._ensure_open():
+            return
+        with self._broker._lock:
+            consumer = self._consumers.pop(consumer_tag, None)
+            if consumer is not None and consumer in consumer.queue.consumers:
+                consumer.queue.consumers.remove(consumer)
+        self._reply(callback, spec.Basic.CancelOk(consumer_tag))
+
+    def _has_capacity(self):
+        return not self._closed and (not self._prefetch_count or len(self._unacked) < self._prefetch_count)
+
+    def _deliver(self, consumer, queue, message):
+        """Hand message to consumer, called with the broker lock held."""
+        tag = next(self._delivery_tags)
+        self._broker.stats["delivered"] += 1
+        self._broker._track("delivered", [message])
+        if message.redelivered:
+            self._broker.stats["redelivered"] += 1
+        if consumer.auto_ack:
+            self._broker.stats["acked"] += 1
+            self._broker._track("acked", [message])
+        else:
+            self._unacked[tag] = (queue.name, message)
+        method = spec.Basic.Deliver(consumer.tag, tag, message.redelivered, message.exchange, message.routing_key)
+        self.connection.ioloop.add_callback_threadsafe(
+            lambda: consumer.callback(self, method, message.properties, message.body))
+
+    def _settle(self, delivery_tag, multiple):
+        if multiple:
+            tags = sorted(tag for tag in self._unacked if delivery_tag == 0 or tag <= delivery_tag)
+        elif delivery_tag in self._unacked:
+            tags = [delivery_tag]
+        else:
+            tags = []
+        if not tags and not (multiple and delivery_tag == 0):
+            self._broker.stats["unknown_ack"] += 1
+            self._closed_by_broker(PRECONDITION_FAILED,
+                                   "PRECONDITION_FAILED - unknown delivery tag {}".format(delivery_tag))
+            return []
+        return [self._unacked.pop(tag) for tag in tags]
+
+    def _redispatch(self, settled):
+        for name in set(queue_name for queue_name, _ in settled):
+            queue = self._broker._queues.get(name)
+            if queue is not None:
+                self._broker._dispatch(queue)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        if not self._ensure_open():
+            return
+        with self._broker._lock:
+            settled = self._settle(delivery_tag, multiple)
+            self._broker.stats["acked"] += len(settled)
+            self._broker._track("acked", [message for _, message in settled])
+            self._redispatch(settled)
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        if not self._ensure_open():
+            return
+        with self._broker._lock:
+            settled = self._settle(delivery_tag or 0, multiple)
+            self._broker.stats["nacked"] += len(settled)
+            for queue_name, message in settled:
+                if requeue:
+                    self._broker._requeue(queue_name, [message])
+                else:
+                    self._broker._track("rejected", [message])
+                    self._broker._dead_letter(queue_name, message)
+            self._redispatch(settled)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.basic_nack(delivery_tag, multiple=False, requeue=requeue)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        if not self._ensure_open():
+            return
+        with self._broker._lock:
+            routed = self._broker._route(exchange, routing_key, body, properties or pika.BasicProperties())
+        if mandatory and not routed:
+            raise exceptions.UnroutableError([])
+
+    def close(self, reply_code=0, reply_text="Normal shutdown"):
+        if self._client_closed:
+            raise exceptions.ChannelWrongStateError("Channel is already closed.")
+        self._client_closed = True
+        self._close(exceptions.ChannelClosedByClient(reply_code, reply_text))
+
+    def _closed_by_broker(self, reply_code, reply_text):
+        if not self._closed:
+            self._close(exceptions.ChannelClosedByBroker(reply_code, reply_text))
+
+    def _close(self, reason):
+        with self._broker._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._broker._cancel_consumers(self)
+            self._consumers.clear()
+            unacked = sorted(self._unacked.items())
+            self._unacked.clear()
+            by_queue = {}
+            for _, (queue_name, message) in unacked:
+                by_queue.setdefault(queue_name, []).append(message)
+            for queue_name, messages in by_queue.items():
+                self._broker._requeue(queue_name, messages)
+            self.connection._channels.pop(self.channel_number, None)
+        self.connection._notify(lambda: self._notify_closed(reason))
+
+    def _notify_closed(self, reason):
+        self._client_closed = True
+        for callback in self._on_close_callbacks:
+            callback(self, reason)
+
+
+class InMemoryConnection(object):
+    """Stand-in for pika.SelectConnection, every callback runs on its ioloop."""
+
+    def __init__(self, broker, on_open_callback=None, on_open_error_callback=None, on_close_callback=None):
+        self._broker = broker
+        self.ioloop = InMemoryIOLoop()
+        self._channels = {}
+        self._channel_numbers = itertools.count(1)
+        self._on_close_callbacks = [on_close_callback] if on_close_callback else []
+        self._closed = False
+        self._client_closed = False
+        self._blocking = False
+        with broker._lock:
+            available = broker.available
+            if available:
+                broker._connections.append(self)
+        if available:
+            if on_open_callback:
+                self.ioloop.add_callback_threadsafe(lambda: on_open_callback(self))
+        else:
+            self._closed = self._client_closed = True
+            if on_open_error_callback:
+                error = exceptions.AMQPConnectionError("in-memory broker is unavailable")
+                self.ioloop.add_callback_threadsafe(lambda: on_open_error_callback(self, error))
+
+    @property
+    def is_open(self):
+        return not self._client_closed
+
+    @property
+    def is_closed(self):
+        return self._client_closed
+
+    @property
+    def is_closing(self):
+        return False
+
+    def add_on_close_callback(self, callback):
+        self._on_close_callbacks.append(callback)
+
+    def add_callback_threadsafe(self, callback):
+        self.ioloop.add_callback_threadsafe(callback)
+
+    _adapter_add_callback_threadsafe = add_callback_threadsafe
+
+    def channel(self, channel_number=None, on_open_callback=None):
+        if self._client_closed:
+            raise exceptions.ConnectionWrongStateError("Connection is closed.")
+        channel = InMemoryChannel(self, channel_number or next(self._channel_numbers))
+        with self._broker._lock:
+            if self._closed:
+                # the close of the connection is on its way, the channel never opens
+                channel._closed = True
+                return channel
+            self._channels[channel.channel_number] = channel
+        if on_open_callback:
+            # like pika, a channel closed before it opened does not report its opening
+            self.ioloop.add_callback_threadsafe(lambda: channel._closed or on_open_callback(channel))
+        return channel
+
+    def close(self, reply_code=200, reply_text="Normal shutdown"):
+        if self._client_closed:
+            raise exceptions.ConnectionWrongStateError("Connection is already closed.")
+        self._client_closed = True
+        self._close(exceptions.ConnectionClosedByClient(reply_code, reply_text))
+
+    def _closed_by_broker(self, reply_code, reply_text):
+        if not self._closed:
+            self._close(exceptions.ConnectionClosedByBroker(reply_code, reply_text))
+
+    def _close(self, reason):
+        with self._broker._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for channel in list(self._channels.values()):
+            channel._close(exceptions.ChannelClosedByClient(reply_code=200, reply_text="Connection closed"))
+        with self._broker._lock:
+            if self in self._broker._connections:
+                self._broker._connections.remove(self)
+        self._notify(lambda: self._notify_closed(reason))
+
+    def _notify(self, callback):
+        if self._blocking:
+            # a BlockingConnection has no ioloop running, it learns of a close on its next call
+            callback()
+        else:
+            self.ioloop.add_callback_threadsafe(callback)
+
+    def _notify_closed(self, reason):
+        self._client_closed = True
+        for callback in self._on_close_callbacks:
+            callback(self, reason)
+
+
+class InMemoryBlockingConnection(object):
+    """Stand-in for pika.BlockingConnection, used by Publisher."""
+
+    def __init__(self, broker):
+        if not broker.available:
+            raise exceptions.AMQPConnectionError("in-memory broker is unavailable")
+        self._connection = InMemoryConnection(broker)
+        self._connection._blocking = True
+        self.is_open = True
+
+    def channel(self, channel_number=None):
+        return self._connection.channel(channel_number)
+
+    def close(self, reply_code=200, reply_text="Normal shutdown"):
+        self.is_open = False
+        self._connection.close(reply_code, reply_text)
+
+
+class InMemoryTransport(object):
+    """Transport connecting Consumer and Publisher to an InMemoryBroker, see message_queue.transport.
+
+    brokers maps urls to brokers of their own, to stand in for the nodes of a
+    cluster, the other urls connect to broker.
+    """
+
+    def __init__(self, broker=None, brokers=None):
+        self.broker = broker or InMemoryBroker()
+        self.brokers = brokers or {}
+
+    def connect(self, amqp_url, on_open_callback, on_open_error_callback, on_close_callback=None):
+        return InMemoryConnection(self.brokers.get(amqp_url, self.broker), on_open_callback, on_open_error_callback, on_close_callback)
+
+    def blocking_connection(self, amqp_url):
+        return InMemoryBlockingConnection(self.brokers.get(amqp_url, self.broker))
+
+    def add_callback_threadsafe(self, connection, callback):
+        connection.ioloop.add_callback_threadsafe(callback)
@@ -2,6 +2,8 @@ import pika
 import umsgpack
 import logging
 import time
+from .transport import PikaTransport
+from .endpoints import parse_urls, describe
 
 logger = logging.getLogger("publisher")
 
@@ -11,9 +13,10 @@ class Publisher:
     DEFAULT_DELIVERY = 2
     CONTENT_TYPE="application/json"
 
-    def __init__(self, amqp_url='amqp://localhost', exchange=''):
+    def __init__(self, amqp_url='amqp://localhost', exchange='', transport=None):
         self.amqp_url = amqp_url
         self.exchange = exchange
+        self._transport = transport or PikaTransport()
 
     def send_message(self, queue, message={}):
         """
@@ -23,11 +26,21 @@ class Publisher:
         self._publish(routing_key=queue, payload=message)
         
 
+    def _connect(self):
+        """Blocking connection to the first broker node of amqp_url that accepts one."""
+        urls = parse_urls(self.amqp_url)
+        for url in urls[:-1]:
+            try:
+                return self._transport.blocking_connection(url)
+            except pika.exceptions.AMQPConnectionError as e:
+                logger.warning("Could not connect to %s, trying the next node: %s", describe(url), e)
+        return self._transport.blocking_connection(urls[-1])
+
     def _publish(self, routing_key, payload):
         
         serialized_message = umsgpack.packb(payload)
         
-        connection = pika.BlockingConnection()
+        connection = self._connect()
         
         channel = connection.channel()
 
@@ -0,0 +1,285 @@
+import os
+import mmap
+import time
+import zlib
+import struct
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger("consumer")
+
+# length and crc32 of the payload that follows
+RECORD_HEADER = struct.Struct("<II")
+
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT_FILE = "checkpoint"
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Segment(object):
+
+    def __init__(self, directory, number):
+        self.number = number
+        self.path = os.path.join(directory, "{:020d}{}".format(number, SEGMENT_SUFFIX))
+        self.size = 0
+        self._map = None
+
+    def view(self, size):
+        """Read only map of the first size bytes, remapped when the segment grew."""
+        if self._map is None or len(self._map) < size:
+            self.unmap()
+            with open(self.path, "rb") as segment_file:
+                self._map = mmap.mmap(segment_file.fileno(), size, access=mmap.ACCESS_READ)
+        return self._map
+
+    def unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class SegmentedLog(object):
+    """Append only log of records spread over segment files in a directory.
+
+    Records are appended by a writer thread which writes everything queued
+    since its last pass and then calls fsync once, so concurrent appends share
+    the cost of a sync. The Future returned by append resolves once the record
+    is on disk. Readers only see synced records and map the segments read only.
+
+    A position is a (segment, offset) tuple. The checkpoint is the position
+    up to which records were consumed, segments before it are deleted. A torn
+    record at the end of the last segment, left by a crash in the middle of a
+    write, is truncated when the log is opened.
+
+    :param str directory: Where the segments and the checkpoint are kept
+    :param int segment_bytes: Size after which a new segment is started
+    :param float sync_interval: Seconds the writer waits for more records before a sync
+
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, sync_interval=0.002):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.sync_interval = sync_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._condition = threading.Condition()
+        self._pending = []
+        self._closed = False
+        self._segments = []
+        self._checkpoint = self._read_checkpoint()
+        self._recover()
+        self._file = open(self._segments[-1].path, "ab")
+
+        self._writer = threading.Thread(target=self._write_loop, name="spool-writer", daemon=True)
+        self._writer.start()
+
+    def _segment_numbers(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as checkpoint_file:
+                segment, offset = checkpoint_file.read().split()
+                return int(segment), int(offset)
+        except (OSError, ValueError):
+            return None
+
+    def _recover(self):
+        numbers = self._segment_numbers()
+        if self._checkpoint is None:
+            self._checkpoint = (numbers[0] if numbers else 0, 0)
+        for number in numbers:
+            segment = _Segment(self.directory, number)
+            segment.size = os.path.getsize(segment.path)
+            self._segments.append(segment)
+        if not self._segments:
+            self._segments.append(_Segment(self.directory, self._checkpoint[0]))
+            open(self._segments[0].path, "ab").close()
+            _fsync_directory(self.directory)
+            return
+
+        last = self._segments[-1]
+        valid = self._scan(last)
+        if valid < last.size:
+            logger.warning("Truncating %s torn bytes at the end of %s", last.size - valid, last.path)
+            with open(last.path, "r+b") as segment_file:
+                segment_file.truncate(valid)
+                os.fsync(segment_file.fileno())
+            last.size = valid
+
+    def _scan(self, segment):
+        """Offset of the end of the last complete record of a segment."""
+        offset = 0
+        if not segment.size:
+            return 0
+        data = segment.view(segment.size)
+        while offset + RECORD_HEADER.size <= segment.size:
+            length, crc = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + length
+            if end > segment.size or zlib.crc32(data[offset + RECORD_HEADER.size:end]) != crc:
+                break
+            offset = end
+        segment.unmap()
+        return offset
+
+    def append(self, record):
+        """Queue a record for the writer, returns a Future resolved with True
+        once it is synced to disk.
+
+        :param bytes record: The record
+
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The spool in {} is closed".format(self.directory))
+            self._pending.append((record, future))
+            self._condition.notify_all()
+        return future
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending and self._closed:
+                    return
+            if self.sync_interval:
+                # let concurrent appends join this sync
+                time.sleep(self.sync_interval)
+            with self._condition:
+                batch, self._pending = self._pending, []
+            try:
+                for record, _ in batch:
+                    self._write(record)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except Exception as e:
+                logger.error("Could not write %s records to the spool in %s: %s", len(batch), self.directory, e, exc_info=True)
+                self._discard_unsynced()
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self._condition:
+                self._segments[-1].size = self._file.tell()
+                self._condition.notify_all()
+            for _, future in batch:
+                future.set_result(True)
+
+    def _write(self, record):
+        if self._file.tell() and self._file.tell() + RECORD_HEADER.size + len(record) > self.segment_bytes:
+            self._roll()
+        self._file.write(RECORD_HEADER.pack(len(record), zlib.crc32(record)))
+        self._file.write(record)
+
+    def _discard_unsynced(self):
+        # a partial record would hide the records appended after it on recovery
+        segment = self._segments[-1]
+        try:
+            self._file.close()
+        except Exception:
+            pass
+        try:
+            os.truncate(segment.path, segment.size)
+            self._file = open(segment.path, "ab")
+        except Exception as e:
+            logger.error("Could not reopen %s: %s", segment.path, e)
+
+    def _roll(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        with self._condition:
+            self._segments[-1].size = os.path.getsize(self._segments[-1].path)
+            segment = _Segment(self.directory, self._segments[-1].number + 1)
+            self._file = open(segment.path, "ab")
+            self._segments.append(segment)
+        _fsync_directory(self.directory)
+
+    def checkpoint(self):
+        return self._checkpoint
+
+    def read(self, position, max_records=100):
+        """Synced records after position.
+
+        :param tuple position: A (segment, offset) position, e.g. the checkpoint
+        :param int max_records: Records returned at most
+        :return: A list of (record, position after the record) tuples
+
+        """
+        records = []
+        segment_number, offset = position
+        while len(records) < max_records:
+            with self._condition:
+                segments = [segment for segment in self._segments if segment.number >= segment_number]
+                if not segments:
+                    break
+                segment = segments[0]
+                size = segment.size
+                is_last = segment is self._segments[-1]
+            if segment.number > segment_number:
+                segment_number, offset = segment.number, 0
+            if offset >= size:
+                if is_last:
+                    break
+                segment_number, offset = segment_number + 1, 0
+                continue
+            data = segment.view(size)
+            while offset < size and len(records) < max_records:
+                length, _ = RECORD_HEADER.unpack_from(data, offset)
+                start = offset + RECORD_HEADER.size
+                offset = start + length
+                records.append((data[start:offset], (segment_number, offset)))
+        return records
+
+    def wait(self, position, timeout=None):
+        """Block until a record after position is synced or timeout seconds passed."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._closed or self._end() > tuple(position), timeout)
+
+    def _end(self):
+        return self._segments[-1].number, self._segments[-1].size
+
+    def backlog_bytes(self, position):
+        """Bytes synced after position."""
+        with self._condition:
+            return sum(segment.size - (position[1] if segment.number == position[0] else 0)
+                       for segment in self._segments if segment.number >= position[0])
+
+    def commit(self, position):
+        """Record position as the checkpoint and delete the segments before it."""
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + ".tmp", "w") as checkpoint_file:
+            checkpoint_file.write("{} {}".format(*position))
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(path + ".tmp", path)
+        self._checkpoint = tuple(position)
+        with self._condition:
+            consumed = [segment for segment in self._segments[:-1] if segment.number < position[0]]
+            self._segments = [segment for segment in self._segments if segment not in consumed]
+        for segment in consumed:
+            segment.unmap()
+            os.remove(segment.path)
+        _fsync_directory(self.directory)
+
+    def close(self, timeout=None):
+        """Write what is queued, then stop the writer."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join(timeout)
+        if not self._writer.is_alive():
+            self._file.close()
+            for segment in self._segments:
+                segment.unmap()
@@ -0,0 +1,33 @@
+import pika
+
+
+class PikaTransport(object):
+    """Opens connections to a real RabbitMQ broker with pika.
+
+    Consumer and Publisher only talk to the broker through a transport, which
+    lets message_queue.memory_broker.InMemoryTransport stand in for RabbitMQ in
+    benchmarks and stress tests.
+    """
+
+    def connect(self, amqp_url, on_open_callback, on_open_error_callback, on_close_callback=None):
+        """Open an asynchronous connection driven by its ioloop.
+
+        :rtype: pika.SelectConnection
+
+        """
+        return pika.SelectConnection(pika.URLParameters(amqp_url),
+                                     on_open_callback=on_open_callback,
+                                     on_open_error_callback=on_open_error_callback,
+                                     on_close_callback=on_close_callback)
+
+    def blocking_connection(self, amqp_url):
+        """Open a synchronous connection, used for publishing.
+
+        :rtype: pika.BlockingConnection
+
+        """
+        return pika.BlockingConnection(pika.URLParameters(amqp_url))
+
+    def add_callback_threadsafe(self, connection, callback):
+        """Schedule callback on the ioloop of connection from any thread."""
+        connection.ioloop.add_callback_threadsafe(callback)
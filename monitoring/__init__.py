@@ -0,0 +1 @@
+from .metrics import REGISTRY, MetricsServer, STAGE_SECONDS, SINK_SECONDS, SINK_ERRORS, SINK_HEDGES, MESSAGES_TOTAL, IN_FLIGHT, STARTUP_SECONDS, FLOW_PAUSES, PRIORITY_WAIT_SECONDS, MEMORY_TRACED_BYTES, MEMORY_RETAINED_PER_MESSAGE, THREADS, BROKER_RECONNECTS, OUTBOX_BACKLOG_BYTES, OUTBOX_RETRIES, OUTBOX_DEAD_LETTERS, QUEUE_DEPTH, WORKER_POOL_SIZE
\ No newline at end of file
@@ -0,0 +1,149 @@
+import os
+import time
+import signal
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from .metrics import REGISTRY, MESSAGES_TOTAL, MEMORY_TRACED_BYTES, MEMORY_RETAINED_PER_MESSAGE, THREADS
+
+logger = logging.getLogger("monitoring")
+
+# allocations of the diagnostics themselves and of the import machinery
+_IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def _messages_processed():
+    return sum(MESSAGES_TOTAL.snapshot()["values"].values())
+
+
+def _format_stat(stat):
+    # the frames of a traceback run from the oldest to the allocating one
+    frame = stat.traceback[-1]
+    return "{:+.1f} KiB ({:+d} blocks) now {:.1f} KiB  {}:{}".format(
+        stat.size_diff / 1024.0, stat.count_diff, stat.size / 1024.0, frame.filename, frame.lineno)
+
+
+class MemoryDiagnostics(object):
+    """Opt-in tracemalloc diagnostics for finding slow memory growth.
+
+    Every interval seconds a snapshot is taken and compared with the previous
+    one and with the first, and a report is written to output_dir: the
+    allocation sites that grew the most since the last report and since the
+    start, the live threads and the memory retained per message processed
+    since the start. The traced size, the thread count and the retained size
+    per message are also exported as gauges. SIGUSR2 writes a report at once.
+
+    tracemalloc slows allocations down and keeps a traceback of every live
+    block, so this is meant for investigations, not for every worker.
+
+    :param float interval: Seconds between two reports
+    :param str output_dir: Directory receiving the reports
+    :param int top: Allocation sites listed per comparison
+    :param int frames: Frames kept per allocation, the sites are grouped by their
+            full traceback when above 1
+    :param int max_files: Reports kept on disk, the oldest are removed
+
+    """
+
+    def __init__(self, interval=300, output_dir="/tmp/event_collector_memory", top=20, frames=1, max_files=100):
+        self.interval = interval
+        self.output_dir = output_dir
+        self.top = top
+        self.frames = frames
+        self.max_files = max_files
+        self._key = "traceback" if frames > 1 else "lineno"
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._baseline = None
+        self._previous = None
+        self._baseline_messages = 0
+        self._reports = []
+
+    @classmethod
+    def from_config(cls, config):
+        if not float(config.MEMORY_DIAGNOSTICS_SECONDS):
+            return None
+        return cls(
+            interval=float(config.MEMORY_DIAGNOSTICS_SECONDS),
+            output_dir=config.MEMORY_DIAGNOSTICS_DIR,
+            top=int(config.MEMORY_DIAGNOSTICS_TOP),
+            frames=int(config.MEMORY_DIAGNOSTICS_FRAMES)
+        )
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self._baseline = self._previous = self._snapshot()
+        self._baseline_messages = _messages_processed()
+        threading.Thread(target=self._run, name="memory-diagnostics", daemon=True).start()
+        REGISTRY.add_collector(lambda: THREADS.set(threading.active_count()))
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, "SIGUSR2"):
+            signal.signal(signal.SIGUSR2, self._on_signal)
+        logger.info("Memory diagnostics enabled, reporting every %ss to %s", self.interval, self.output_dir)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(_IGNORED)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                logger.error("Could not write the memory report: %s", e)
+
+    def report(self, reason="periodic"):
+        """Compare a new snapshot with the previous and the first ones, update
+        the gauges and write the report, returns its path."""
+        with self._lock:
+            snapshot = self._snapshot()
+            since_previous = snapshot.compare_to(self._previous, self._key)[:self.top]
+            since_start = snapshot.compare_to(self._baseline, self._key)
+            self._previous = snapshot
+
+        traced, peak = tracemalloc.get_traced_memory()
+        growth = sum(stat.size_diff for stat in since_start)
+        messages = _messages_processed() - self._baseline_messages
+        per_message = growth / messages if messages else 0.0
+        threads = threading.enumerate()
+        MEMORY_TRACED_BYTES.set(traced)
+        MEMORY_RETAINED_PER_MESSAGE.set(per_message)
+        THREADS.set(len(threads))
+
+        path = os.path.join(self.output_dir, "memory-{}-{}-{}.txt".format(time.strftime("%Y%m%dT%H%M%S"), os.getpid(), reason))
+        with open(path, "w") as out:
+            out.write("traced {:.1f} KiB, peak {:.1f} KiB, grown {:+.1f} KiB since the start\n".format(
+                traced / 1024.0, peak / 1024.0, growth / 1024.0))
+            out.write("{:.0f} messages since the start, {:.1f} bytes retained per message\n".format(messages, per_message))
+            # numbered names are grouped, a growing group is a thread leak
+            groups = Counter(thread.name.rstrip("0123456789-_") or thread.name for thread in threads)
+            out.write("{} threads: {}\n".format(len(threads), ", ".join(
+                "{} x{}".format(name, count) for name, count in groups.most_common())))
+            for title, stats in (("since the last report", since_previous), ("since the start", since_start[:self.top])):
+                out.write("\ntop {} allocation sites by growth {}\n".format(len(stats), title))
+                for stat in stats:
+                    out.write(_format_stat(stat) + "\n")
+                    for frame in list(stat.traceback)[-2::-1]:
+                        out.write("        {}:{}\n".format(frame.filename, frame.lineno))
+        self._reports.append(path)
+        while len(self._reports) > self.max_files:
+            try:
+                os.remove(self._reports.pop(0))
+            except OSError:
+                pass
+        logger.info("Memory report written to %s: %.1f KiB traced, %d threads, %.1f bytes retained per message",
+                    path, traced / 1024.0, len(threads), per_message)
+        return path
+
+    def _on_signal(self, signum, frame):
+        threading.Thread(target=self.report, args=("signal",), daemon=True).start()
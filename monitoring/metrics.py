@@ -0,0 +1,522 @@
+import time
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+logger = logging.getLogger("monitoring")
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                          for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric(object):
+    """Base class of a labelled metric family.
+
+    Children are created on first use for every distinct label combination and
+    are kept for the lifetime of the process, so label values must come from a
+    bounded set (stage names, registered routes, zoho modules).
+    """
+
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *labelvalues, **labelkwargs):
+        if labelkwargs:
+            labelvalues = tuple(labelkwargs.get(name, "") for name in self.labelnames)
+        else:
+            labelvalues = tuple(labelvalues)
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._lock:
+                child = self._children.get(labelvalues)
+                if child is None:
+                    child = self._new_child()
+                    self._children[labelvalues] = child
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _reset(self):
+        # the lock is replaced too, another thread of the parent may have held it at the fork
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def samples(self):
+        raise NotImplementedError
+
+    def snapshot(self):
+        """Plain, picklable copy of the family used to ship it to another process."""
+        return {
+            "type": self.metric_type,
+            "documentation": self.documentation,
+            "labelnames": self.labelnames,
+            "buckets": getattr(self, "buckets", None),
+            "values": dict((labelvalues, child.value) for labelvalues, child in list(self._children.items()))
+        }
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.metric_type)
+        ]
+        for sample_name, labels, value in self.samples():
+            lines.append("{}{} {}".format(sample_name, labels, _format_value(value)))
+        return "\n".join(lines)
+
+
+class _CounterChild(object):
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def _restore(self, value):
+        self._value = value
+
+
+class Counter(_Metric):
+
+    metric_type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1, **labels):
+        self.labels(**labels).inc(amount)
+
+    def samples(self):
+        for labelvalues, child in list(self._children.items()):
+            yield self.name, _format_labels(self.labelnames, labelvalues), child.value
+
+
+class _GaugeChild(object):
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def _restore(self, value):
+        self._value = value
+
+
+class Gauge(_Metric):
+
+    metric_type = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value, **labels):
+        self.labels(**labels).set(value)
+
+    def samples(self):
+        for labelvalues, child in list(self._children.items()):
+            yield self.name, _format_labels(self.labelnames, labelvalues), child.value
+
+
+class _Timer(object):
+
+    __slots__ = ("_child", "_start")
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._child.observe(time.perf_counter() - self._start)
+        return False
+
+
+class _HistogramChild(object):
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+    @property
+    def value(self):
+        return self.snapshot()
+
+    def _restore(self, value):
+        self._counts, self._sum = list(value[0]), value[1]
+
+
+class Histogram(_Metric):
+
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+    def time(self, **labels):
+        """Context manager observing the wall time of the wrapped block.
+
+            with STAGE_SECONDS.time(stage="decode"):
+                ...
+        """
+        return self.labels(**labels).time()
+
+    def samples(self):
+        for labelvalues, child in list(self._children.items()):
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield (self.name + "_bucket",
+                       _format_labels(self.labelnames, labelvalues, ("le", _format_value(bound))),
+                       cumulative)
+            yield self.name + "_count", _format_labels(self.labelnames, labelvalues), cumulative
+            yield self.name + "_sum", _format_labels(self.labelnames, labelvalues), total
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """Register a callable invoked right before every scrape, used to
+        refresh gauges whose value is cheaper to read on demand than to track.
+        """
+        self._collectors.append(collector)
+
+    def collect(self):
+        for collector in list(self._collectors):
+            try:
+                collector()
+            except Exception as e:
+                logger.error("Metrics collector %s failed: %s", collector, e)
+
+    def reset(self):
+        """Drop every recorded value, keeping the metrics and collectors. Called
+        in a forked worker, which would otherwise report the values of its parent
+        as its own."""
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric._reset()
+
+    def snapshot(self):
+        self.collect()
+        return dict((name, metric.snapshot()) for name, metric in list(self._metrics.items()))
+
+    def render(self):
+        self.collect()
+        return "\n".join(metric.render() for metric in list(self._metrics.values())) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "event_collector_stage_seconds",
+    "Time spent in each processing stage of an event",
+    ("stage",)
+)
+
+SINK_SECONDS = REGISTRY.histogram(
+    "event_collector_sink_seconds",
+    "Latency of calls to external sinks per route and zoho module",
+    ("sink", "route", "module")
+)
+
+SINK_HEDGES = REGISTRY.counter(
+    "event_collector_sink_hedges_total",
+    "Sink calls sent a second time after the hedge delay, skipped over the hedge budget, or whose second call was used",
+    ("sink", "outcome")
+)
+
+SINK_ERRORS = REGISTRY.counter(
+    "event_collector_sink_errors_total",
+    "Sink calls that raised or returned an unsuccessful response",
+    ("sink", "route", "module")
+)
+
+MESSAGES_TOTAL = REGISTRY.counter(
+    "event_collector_messages_total",
+    "Messages handled by the worker by outcome",
+    ("outcome",)
+)
+
+IN_FLIGHT = REGISTRY.gauge(
+    "event_collector_in_flight_messages",
+    "Messages delivered by the broker and not yet acknowledged"
+)
+
+STARTUP_SECONDS = REGISTRY.gauge(
+    "event_collector_startup_seconds",
+    "Time spent in each startup phase of the worker",
+    ("phase",)
+)
+
+FLOW_PAUSES = REGISTRY.counter(
+    "event_collector_flow_pauses_total",
+    "Times delivery was paused by a high watermark",
+    ("reason",)
+)
+
+PRIORITY_WAIT_SECONDS = REGISTRY.histogram(
+    "event_collector_priority_wait_seconds",
+    "Time messages of the priority execution mode waited for a thread, per priority class",
+    ("priority",)
+)
+
+MEMORY_TRACED_BYTES = REGISTRY.gauge(
+    "event_collector_memory_traced_bytes",
+    "Memory allocated by Python and traced by the memory diagnostics"
+)
+
+MEMORY_RETAINED_PER_MESSAGE = REGISTRY.gauge(
+    "event_collector_memory_retained_bytes_per_message",
+    "Traced memory grown since the memory diagnostics started, per message processed since"
+)
+
+THREADS = REGISTRY.gauge(
+    "event_collector_threads",
+    "Live Python threads, updated while the memory diagnostics run"
+)
+
+BROKER_RECONNECTS = REGISTRY.counter(
+    "event_collector_broker_reconnects_total",
+    "Broker connections that failed to open or were lost, per endpoint",
+    ("endpoint",)
+)
+
+OUTBOX_BACKLOG_BYTES = REGISTRY.gauge(
+    "event_collector_outbox_backlog_bytes",
+    "Bytes spooled in the outbox and not yet sent"
+)
+
+OUTBOX_RETRIES = REGISTRY.counter(
+    "event_collector_outbox_retries_total",
+    "Spooled sink calls that failed and are retried",
+    ("sink",)
+)
+
+OUTBOX_DEAD_LETTERS = REGISTRY.counter(
+    "event_collector_outbox_dead_letters_total",
+    "Spooled sink calls moved to the dead-letter log after OUTBOX_MAX_ATTEMPTS",
+    ("sink",)
+)
+
+QUEUE_DEPTH = REGISTRY.gauge(
+    "event_collector_queue_depth",
+    "Ready messages of a consumed queue, polled with a passive declare",
+    ("queue",)
+)
+
+WORKER_POOL_SIZE = REGISTRY.gauge(
+    "event_collector_worker_pool_size",
+    "Threads of the autoscaled worker pool"
+)
+
+
+def _merge_value(metric_type, current, value):
+    if metric_type == "histogram":
+        if current is None:
+            return list(value[0]), value[1]
+        return [a + b for a, b in zip(current[0], value[0])], current[1] + value[1]
+    return (current or 0) + value
+
+
+def _merge_into(target, snapshot, skip_gauges=False):
+    for name, family in snapshot.items():
+        if skip_gauges and family["type"] == "gauge":
+            continue
+        merged = target.get(name)
+        if merged is None:
+            merged = target[name] = dict(family, values={})
+        for labelvalues, value in family["values"].items():
+            merged["values"][labelvalues] = _merge_value(family["type"], merged["values"].get(labelvalues), value)
+
+
+def _family_from_snapshot(name, family):
+    if family["type"] == "histogram":
+        metric = Histogram(name, family["documentation"], family["labelnames"], family["buckets"])
+    elif family["type"] == "gauge":
+        metric = Gauge(name, family["documentation"], family["labelnames"])
+    else:
+        metric = Counter(name, family["documentation"], family["labelnames"])
+    for labelvalues, value in family["values"].items():
+        metric.labels(*labelvalues)._restore(value)
+    return metric
+
+
+class MetricsAggregator(object):
+    """Sums the registry snapshots of several worker processes into one exposition.
+
+    Counters and histograms of workers that exited are folded into a retired
+    total so the aggregate stays monotonic when a worker is restarted, their
+    gauges are dropped. The registry of the current process is included too.
+    """
+
+    def __init__(self, registry=REGISTRY):
+        self._registry = registry
+        self._live = {}
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def update(self, worker_id, snapshot):
+        with self._lock:
+            self._live[worker_id] = snapshot
+
+    def retire(self, worker_id):
+        with self._lock:
+            snapshot = self._live.pop(worker_id, None)
+            if snapshot:
+                _merge_into(self._retired, snapshot, skip_gauges=True)
+
+    def snapshot(self):
+        merged = {}
+        with self._lock:
+            _merge_into(merged, self._retired)
+            for snapshot in self._live.values():
+                _merge_into(merged, snapshot)
+        if self._registry is not None:
+            _merge_into(merged, self._registry.snapshot())
+        return merged
+
+    def render(self):
+        return "\n".join(_family_from_snapshot(name, family).render()
+                         for name, family in sorted(self.snapshot().items())) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        output = self.registry.render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer(object):
+    """Serves the registry in the Prometheus text format from a daemon thread."""
+
+    def __init__(self, port, host="0.0.0.0", registry=REGISTRY):
+        self.port = int(port)
+        self.host = host
+        self.registry = registry
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        handler = type("MetricsRequestHandler", (_MetricsRequestHandler,), {"registry": self.registry})
+        self._server = _ThreadingHTTPServer((self.host, self.port), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+        logger.info("Metrics endpoint listening on %s:%s", self.host, self.port)
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
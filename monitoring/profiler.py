@@ -0,0 +1,234 @@
+import os
+import sys
+import time
+import signal
+import cProfile
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger("monitoring")
+
+PROFILE_MODES = ("off", "sample", "cprofile")
+
+
+def _collapse(frame):
+    """Render a frame stack in the collapsed format understood by flamegraph.pl
+    and speedscope, root first: "module:function;module:function".
+    """
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append("{}:{}:{}".format(os.path.basename(code.co_filename), code.co_name, code.co_firstlineno))
+        frame = frame.f_back
+    parts.reverse()
+    return ";".join(parts)
+
+
+def _write_collapsed(path, stacks):
+    with open(path, "w") as out:
+        for stack, count in stacks.most_common():
+            out.write("{} {}\n".format(stack, count))
+
+
+class StackSampler(object):
+    """Background thread sampling Python stacks at a fixed interval.
+
+    Threads registered with watch() get their own sample counter, which is how
+    a single slow message is profiled without touching other workers. When
+    process_wide is set, every thread is also sampled into a shared counter
+    that is drained periodically or on demand.
+    """
+
+    def __init__(self, interval=0.01, process_wide=False):
+        self.interval = interval
+        self.process_wide = process_wide
+        self._watched = {}
+        self._process_stacks = Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def watch(self, thread_id):
+        stacks = Counter()
+        with self._lock:
+            self._watched[thread_id] = stacks
+        return stacks
+
+    def unwatch(self, thread_id):
+        with self._lock:
+            return self._watched.pop(thread_id, Counter())
+
+    def drain_process_stacks(self):
+        with self._lock:
+            stacks, self._process_stacks = self._process_stacks, Counter()
+        return stacks
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, frame in frames.items():
+                    if thread_id == own_id:
+                        continue
+                    watched = self._watched.get(thread_id)
+                    if watched is None and not self.process_wide:
+                        continue
+                    stack = _collapse(frame)
+                    if watched is not None:
+                        watched[stack] += 1
+                    if self.process_wide:
+                        self._process_stacks[stack] += 1
+            del frames
+
+
+class MessageProfiler(object):
+    """Opt-in profiler for QueueHandler._process_message.
+
+    In "sample" mode the calling thread is sampled by a shared StackSampler and
+    the collapsed stacks are written when the call is slower than the threshold.
+    In "cprofile" mode every call runs under cProfile and the pstats file is
+    kept only for slow calls. This is considerably more expensive and is meant
+    for short investigations. Only one cProfile can be active per process, so
+    calls made while another one is profiled run unprofiled.
+
+    When periodic_interval is set the whole process is sampled continuously and
+    a collapsed profile is written every periodic_interval seconds. SIGUSR1
+    writes the whole-process profile collected so far immediately.
+
+    :param str mode: One of PROFILE_MODES
+    :param float threshold: Duration in seconds above which a call is dumped
+    :param str output_dir: Directory receiving the profile files
+    :param float sample_interval: Seconds between two stack samples
+    :param float periodic_interval: Seconds between whole-process dumps, 0 disables
+    :param int max_files: Slow-call profiles kept on disk before new ones are skipped
+
+    """
+
+    def __init__(self, mode="sample", threshold=1.0, output_dir="/tmp/event_collector_profiles",
+                 sample_interval=0.01, periodic_interval=0, max_files=200):
+        if mode not in PROFILE_MODES:
+            raise ValueError("Unknown profile mode {}".format(mode))
+        self.mode = mode
+        self.threshold = threshold
+        self.output_dir = output_dir
+        self.periodic_interval = periodic_interval
+        self.max_files = max_files
+        self._written = 0
+        self._count_lock = threading.Lock()
+        self._cprofile_lock = threading.Lock()
+        self._sampler = None
+        self._periodic_thread = None
+        if mode == "sample" or periodic_interval:
+            self._sampler = StackSampler(interval=sample_interval, process_wide=bool(periodic_interval))
+
+    @classmethod
+    def from_config(cls, config):
+        mode = config.PROFILE_MODE
+        if not mode or mode == "off":
+            return None
+        return cls(
+            mode=mode,
+            threshold=float(config.PROFILE_SLOW_THRESHOLD_MS) / 1000.0,
+            output_dir=config.PROFILE_OUTPUT_DIR,
+            sample_interval=float(config.PROFILE_SAMPLE_INTERVAL_MS) / 1000.0,
+            periodic_interval=float(config.PROFILE_PERIODIC_SECONDS)
+        )
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self._sampler:
+            self._sampler.start()
+        if self.periodic_interval:
+            self._periodic_thread = threading.Thread(target=self._periodic_dump, name="periodic-profiler", daemon=True)
+            self._periodic_thread.start()
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self._on_signal)
+        logger.info("Profiling enabled in %s mode, slow threshold %.3fs, writing to %s",
+                    self.mode, self.threshold, self.output_dir)
+        return self
+
+    def stop(self):
+        if self._sampler:
+            self._sampler.stop()
+
+    def _reserve_file(self):
+        with self._count_lock:
+            if self._written >= self.max_files:
+                return False
+            self._written += 1
+            return True
+
+    def _path(self, prefix, label, extension):
+        return os.path.join(self.output_dir, "{}-{}-{}-{}.{}".format(
+            prefix, time.strftime("%Y%m%dT%H%M%S"), os.getpid(), label, extension))
+
+    def run(self, label, func, *args, **kwargs):
+        """Call func(*args, **kwargs), keeping a profile of it when it is slow."""
+        if self.mode == "cprofile":
+            if not self._cprofile_lock.acquire(blocking=False):
+                return func(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:
+                # another profiling tool, e.g. a debugger, holds the interpreter profiler
+                self._cprofile_lock.release()
+                logger.debug("Could not profile message %s: %s", label, e)
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                self._cprofile_lock.release()
+                elapsed = time.perf_counter() - started
+                if elapsed >= self.threshold and self._reserve_file():
+                    path = self._path("slow", label, "pstats")
+                    profile.dump_stats(path)
+                    logger.warning("Slow message %s took %.3fs, profile written to %s", label, elapsed, path)
+
+        thread_id = threading.get_ident()
+        self._sampler.watch(thread_id)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            stacks = self._sampler.unwatch(thread_id)
+            if elapsed >= self.threshold and stacks and self._reserve_file():
+                path = self._path("slow", label, "collapsed")
+                _write_collapsed(path, stacks)
+                logger.warning("Slow message %s took %.3fs, profile written to %s", label, elapsed, path)
+
+    def dump_process_profile(self, reason="periodic"):
+        if not (self._sampler and self._sampler.process_wide):
+            logger.info("Whole-process profiling is disabled, set PROFILE_PERIODIC_SECONDS to enable it")
+            return None
+        stacks = self._sampler.drain_process_stacks()
+        if not stacks:
+            return None
+        path = self._path("process", reason, "collapsed")
+        _write_collapsed(path, stacks)
+        logger.info("Whole-process profile written to %s", path)
+        return path
+
+    def _periodic_dump(self):
+        while True:
+            time.sleep(self.periodic_interval)
+            try:
+                self.dump_process_profile()
+            except Exception as e:
+                logger.error("Could not write periodic profile: %s", e)
+
+    def _on_signal(self, signum, frame):
+        threading.Thread(target=self.dump_process_profile, args=("signal",), daemon=True).start()
@@ -0,0 +1,316 @@
+"""Replay archived events through the router and the sinks, without AMQP.
+
+Events are read from JSONL or msgpack files, or directories of them, and
+processed like the consumer does by a pool of workers. The position reached
+in every file is saved to --offsets, so an interrupted replay resumes where it
+stopped:
+
+    python replay.py archive/2024-05/ --workers 32 --offsets replay.offsets
+    python replay.py archive/2024-05/events.jsonl --dry_run
+"""
+import os
+import json
+import time
+import signal
+import logging
+import argparse
+import threading
+
+import umsgpack
+
+from config import Config
+from run import setup_logging, connect_database
+from message_queue.codec import decode_body
+from message_queue.executors import EXECUTION_MODES, create_executor
+from marketing_automation.serializer import loads
+
+logger = logging.getLogger("marketing_automation")
+
+JSONL_SUFFIXES = (".jsonl", ".json")
+MSGPACK_SUFFIXES = (".msgpack", ".mpk")
+
+OUTCOMES = ("sent", "failed", "unrouted", "undecodable")
+
+
+def list_files(paths):
+    """The replayable files of paths, directories are walked in name order."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in sorted(os.walk(path)):
+                files.extend(os.path.join(directory, name) for name in sorted(names)
+                             if name.endswith(JSONL_SUFFIXES + MSGPACK_SUFFIXES))
+        else:
+            files.append(path)
+    return files
+
+
+def read_events(path, start=0):
+    """Yield (index, event) for the events of a file from the start-th on.
+
+    A JSONL file holds one event per line, a msgpack file a sequence of events
+    or of raw message bodies. An event that can not be decoded is False and
+    a blank line None.
+
+    """
+    if path.endswith(MSGPACK_SUFFIXES):
+        with open(path, "rb") as events_file:
+            index = 0
+            while True:
+                try:
+                    item = umsgpack.unpack(events_file)
+                except umsgpack.InsufficientDataException:
+                    return
+                except umsgpack.UnpackException as e:
+                    logger.error("Stopped reading %s at event %s: %s", path, index, e)
+                    return
+                if index >= start:
+                    yield index, decode_body(item) if isinstance(item, bytes) else item
+                index += 1
+    else:
+        with open(path, "rb") as events_file:
+            for index, line in enumerate(events_file):
+                if index < start:
+                    continue
+                if not line.strip():
+                    yield index, None
+                    continue
+                try:
+                    yield index, loads(line)
+                except ValueError:
+                    yield index, False
+
+
+class Offsets(object):
+    """Position reached in every file of a replay, kept in a JSON file.
+
+    Events complete out of order, so the position of a file only moves past
+    an event once every event before it completed too.
+
+    :param str path: The offsets file, None keeps them in memory only
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._positions = {}
+        self._completed = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as offsets_file:
+                self._positions = json.load(offsets_file)
+
+    def start(self, file_path):
+        return self._positions.get(file_path, 0)
+
+    def complete(self, file_path, index):
+        with self._lock:
+            completed = self._completed.setdefault(file_path, set())
+            completed.add(index)
+            position = self._positions.get(file_path, 0)
+            while position in completed:
+                completed.discard(position)
+                position += 1
+            self._positions[file_path] = position
+
+    def save(self):
+        if not self.path:
+            return
+        # one save at a time, both write the same temporary file and a later
+        # save must not be replaced by the older positions of an earlier one
+        with self._save_lock:
+            with self._lock:
+                positions = dict(self._positions)
+            with open(self.path + ".tmp", "w") as offsets_file:
+                json.dump(positions, offsets_file, indent=4)
+            os.replace(self.path + ".tmp", self.path)
+
+
+class Replay(object):
+    """Feeds the events of files to the router through an executor.
+
+    Events are read batch_size at a time and the spec of every distinct url of
+    a batch is looked up once. At most max_in_flight events are queued or
+    being processed at once, so a large archive is never held in memory.
+
+    :param executor: One of message_queue.executors, a partitioned one keeps
+            the events of a PARTITION_KEY in order
+    :param Offsets offsets: Receives the completed events
+    :param bool dry_run: Build the sink payloads without sending them
+    :param file failed_output: Receives the events that failed, one JSON per line
+
+    """
+
+    def __init__(self, executor, offsets, batch_size=100, max_in_flight=1000, dry_run=False, failed_output=None):
+        from marketing_automation import marketing_auto_router
+
+        self.router = marketing_auto_router
+        self.executor = executor
+        self.offsets = offsets
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.failed_output = failed_output
+        self.counts = dict.fromkeys(OUTCOMES, 0)
+        self.stopping = threading.Event()
+        self._window = threading.BoundedSemaphore(max_in_flight)
+        self._in_flight = [0]
+        self._idle = threading.Condition()
+        self._lock = threading.Lock()
+
+    def run(self, files):
+        for file_path in files:
+            if self.stopping.is_set():
+                break
+            start = self.offsets.start(file_path)
+            logger.info("Replaying %s from event %s", file_path, start)
+            batch = []
+            for index, event_data in read_events(file_path, start):
+                if event_data is None:
+                    self.offsets.complete(file_path, index)
+                    continue
+                batch.append((index, event_data))
+                if len(batch) >= self.batch_size:
+                    self._submit(file_path, batch)
+                    batch = []
+                if self.stopping.is_set():
+                    break
+            if batch and not self.stopping.is_set():
+                self._submit(file_path, batch)
+        self.wait()
+
+    def _url(self, event_data):
+        if isinstance(event_data, dict) and "type" not in event_data:
+            return (event_data.get("request") or {}).get("url")
+        return None
+
+    def _submit(self, file_path, batch):
+        specs = {}
+        for index, event_data in batch:
+            url = self._url(event_data)
+            if url is not None and url not in specs:
+                specs[url] = self.router.get_spec_from_db(url)
+
+        for index, event_data in batch:
+            self._window.acquire()
+            with self._idle:
+                self._in_flight[0] += 1
+            spec = specs.get(self._url(event_data))
+            if hasattr(self.executor, "submit_keyed"):
+                key = self.router.partition_key(event_data, Config.PARTITION_KEY) if event_data else None
+                self.executor.submit_keyed(key, self._process, file_path, index, event_data, spec)
+            else:
+                self.executor.submit(self._process, file_path, index, event_data, spec)
+
+    def _process(self, file_path, index, event_data, spec):
+        outcome = "failed"
+        try:
+            if not event_data:
+                outcome = "undecodable"
+            elif self._url(event_data) is not None and spec is not None and not spec[0]:
+                # a None spec is a failed lookup, the router tries again
+                outcome = "unrouted"
+            else:
+                result = self.router.router(event_data, spec, dry_run=self.dry_run)
+                if hasattr(result, "add_done_callback"):
+                    result.add_done_callback(
+                        lambda done: self._finish(file_path, index, event_data,
+                                                  "sent" if not done.exception() and done.result() else "failed"))
+                    return
+                outcome = "sent" if result else "failed"
+        except Exception as e:
+            logger.error("Could not replay event %s of %s: %s", index, file_path, e)
+        self._finish(file_path, index, event_data, outcome)
+
+    def _finish(self, file_path, index, event_data, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+            if outcome == "failed" and self.failed_output:
+                self.failed_output.write(json.dumps(event_data, default=str) + "\n")
+        self.offsets.complete(file_path, index)
+        self._window.release()
+        with self._idle:
+            self._in_flight[0] -= 1
+            self._idle.notify_all()
+
+    def wait(self):
+        """Block until every submitted event completed."""
+        with self._idle:
+            self._idle.wait_for(lambda: self._in_flight[0] == 0)
+
+    def processed(self):
+        with self._lock:
+            return sum(self.counts.values())
+
+
+def _report(replay, offsets, interval, started_at):
+    previous, previous_at = 0, started_at
+    while not replay.stopping.wait(interval):
+        processed, now = replay.processed(), time.perf_counter()
+        logger.info("Replayed %s events, %.1f/s now, %.1f/s overall: %s", processed,
+                    (processed - previous) / (now - previous_at), processed / (now - started_at), json.dumps(replay.counts))
+        previous, previous_at = processed, now
+        offsets.save()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay archived events through the router and the sinks")
+    parser.add_argument("paths", nargs="+", help="JSONL or msgpack files, or directories of them")
+    parser.add_argument("--execution_mode", default="pool", choices=EXECUTION_MODES, help="How events are scheduled on worker threads, partitioned keeps the events of a PARTITION_KEY in order")
+    parser.add_argument("--workers", type=int, default=16, help="Worker threads")
+    parser.add_argument("--batch_size", type=int, default=100, help="Events read, and whose specs are looked up, at once")
+    parser.add_argument("--max_in_flight", type=int, default=1000, help="Events queued or being processed at once")
+    parser.add_argument("--coalesce_ms", type=float, default=None, help="Override ZOHO_COALESCE_WINDOW_MS, batching the Zoho upserts of the replay")
+    parser.add_argument("--offsets", default=None, help="File keeping the position reached in every file, a replay resumes from it")
+    parser.add_argument("--failed", dest="failed_path", default=None, help="Append the events that failed to this JSONL file")
+    parser.add_argument("--dry_run", action="store_true", help="Look up the routes and build the sink payloads without sending them")
+    parser.add_argument("--report_interval", type=float, default=10, help="Seconds between progress lines")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging()
+    connect_database()
+    if args.coalesce_ms is not None:
+        Config.ZOHO_COALESCE_WINDOW_MS = str(args.coalesce_ms)
+
+    from marketing_automation.zoho.zoho_crm import ZohoCRM
+
+    files = list_files(args.paths)
+    offsets = Offsets(args.offsets)
+    failed_output = open(args.failed_path, "a") if args.failed_path else None
+    replay = Replay(create_executor(args.execution_mode, args.workers), offsets, batch_size=args.batch_size,
+                    max_in_flight=args.max_in_flight, dry_run=args.dry_run, failed_output=failed_output)
+
+    def stop(signum, frame):
+        logger.info("Stopping the replay after the events in flight")
+        replay.stopping.set()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    started_at = time.perf_counter()
+    reporter = threading.Thread(target=_report, args=(replay, offsets, args.report_interval, started_at), daemon=True)
+    reporter.start()
+    try:
+        replay.run(files)
+        ZohoCRM().flush_upserts()
+        replay.wait()
+    finally:
+        replay.stopping.set()
+        replay.executor.shutdown(wait=True)
+        reporter.join()
+        offsets.save()
+        if failed_output:
+            failed_output.close()
+
+    seconds = time.perf_counter() - started_at
+    processed = replay.processed()
+    report = dict(replay.counts, files=len(files), events=processed, seconds=round(seconds, 3),
+                  events_per_second=round(processed / seconds, 1) if seconds else 0.0, dry_run=args.dry_run)
+    print(json.dumps(report, indent=4))
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import time
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from config import Config
+from monitoring.metrics import STARTUP_SECONDS
+
+logger = logging.getLogger("marketing_automation")
+
+
+class StartupReport(object):
+    """Times the startup phases of a worker and logs them in one line.
+
+    Every phase is also exported on the event_collector_startup_seconds gauge.
+
+    :param float started_at: time.perf_counter() value the total is measured from
+
+    """
+
+    def __init__(self, started_at=None):
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self.phases = OrderedDict()
+
+    def record(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+        STARTUP_SECONDS.set(self.phases[name], phase=name)
+
+    @contextmanager
+    def phase(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started_at)
+
+    def total(self):
+        return time.perf_counter() - self.started_at
+
+    def log(self):
+        total = self.total()
+        STARTUP_SECONDS.set(total, phase="total")
+        logger.info("Started in %.0fms (%s)", total * 1000,
+                    ", ".join("{} {:.0f}ms".format(name, seconds * 1000) for name, seconds in self.phases.items()))
+
+
+def warm_up(report):
+    """Do the work the first messages would otherwise pay for: load the route
+    specs, fetch the Zoho access token and open the sink connection pools.
+
+    A failing step is logged and skipped, the worker then falls back to doing
+    it lazily on the first message.
+
+    :param StartupReport report: Receives the time of each step
+
+    """
+    from marketing_automation import marketing_auto_router
+    from marketing_automation.http_client import open_pools
+    from marketing_automation.zoho.zoho_crm import ZohoCRM
+
+    steps = [
+        ("route_specs", marketing_auto_router.preload_routes),
+        ("http_pools", lambda: open_pools([Config.UPSHOT_API_URL, Config.ZOHO_API_URL, Config.ZOHO_ACCOUNTS_URL])),
+    ]
+    if Config.ZOHO_REFRESH_TOKEN:
+        steps.append(("zoho_token", ZohoCRM().ensure_access_token))
+
+    for name, step in steps:
+        with report.phase(name):
+            try:
+                result = step()
+                logger.info("Warm up %s done: %s", name, result if name != "zoho_token" else bool(result))
+            except Exception as e:
+                logger.warning("Warm up %s failed: %s", name, e)
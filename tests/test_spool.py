@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from message_queue.spool import SegmentedLog, RECORD_HEADER, SEGMENT_SUFFIX
+
+
+class SegmentedLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="spool-test-")
+        self.logs = []
+
+    def tearDown(self):
+        for log in self.logs:
+            log.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def open_log(self, **kwargs):
+        kwargs.setdefault("sync_interval", 0)
+        log = SegmentedLog(self.directory, **kwargs)
+        self.logs.append(log)
+        return log
+
+    def reopen(self, log, **kwargs):
+        log.close()
+        self.logs.remove(log)
+        return self.open_log(**kwargs)
+
+    def append_all(self, log, records):
+        for future in [log.append(record) for record in records]:
+            self.assertTrue(future.result(timeout=5))
+
+    def read_all(self, log, position=None):
+        return [record for record, _ in log.read(position or log.checkpoint(), max_records=1000)]
+
+    def segment_files(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+    def test_records_are_read_back_in_order(self):
+        log = self.open_log()
+        self.append_all(log, [b"first", b"second", b"third"])
+        self.assertEqual(self.read_all(log), [b"first", b"second", b"third"])
+
+    def test_torn_tail_is_truncated_on_open(self):
+        log = self.open_log()
+        self.append_all(log, [b"one", b"two"])
+        log.close()
+        segment = os.path.join(self.directory, self.segment_files()[-1])
+        complete = os.path.getsize(segment)
+        with open(segment, "ab") as segment_file:
+            # a header announcing more bytes than were written before the crash
+            segment_file.write(RECORD_HEADER.pack(100, 0) + b"partial")
+
+        log = self.reopen(log)
+        self.assertEqual(os.path.getsize(segment), complete)
+        self.assertEqual(self.read_all(log), [b"one", b"two"])
+        self.append_all(log, [b"three"])
+        self.assertEqual(self.read_all(log), [b"one", b"two", b"three"])
+
+    def test_corrupted_tail_record_is_truncated_on_open(self):
+        log = self.open_log()
+        self.append_all(log, [b"kept", b"corrupted"])
+        log.close()
+        segment = os.path.join(self.directory, self.segment_files()[-1])
+        with open(segment, "r+b") as segment_file:
+            segment_file.seek(-1, os.SEEK_END)
+            segment_file.write(b"X")
+
+        log = self.reopen(log)
+        self.assertEqual(self.read_all(log), [b"kept"])
+
+    def test_segments_roll_over(self):
+        log = self.open_log(segment_bytes=64)
+        records = [bytes([index]) * 40 for index in range(5)]
+        self.append_all(log, records)
+        self.assertEqual(len(self.segment_files()), 5)
+        self.assertEqual(self.read_all(log), records)
+
+        log = self.reopen(log, segment_bytes=64)
+        self.assertEqual(self.read_all(log), records)
+
+    def test_read_is_bounded_and_resumes_from_a_position(self):
+        log = self.open_log(segment_bytes=64)
+        records = [bytes([index]) * 40 for index in range(4)]
+        self.append_all(log, records)
+        first = log.read(log.checkpoint(), max_records=3)
+        self.assertEqual([record for record, _ in first], records[:3])
+        self.assertEqual(self.read_all(log, first[-1][1]), records[3:])
+
+    def test_commit_deletes_consumed_segments(self):
+        log = self.open_log(segment_bytes=64)
+        records = [bytes([index]) * 40 for index in range(4)]
+        self.append_all(log, records)
+        position = log.read(log.checkpoint(), max_records=2)[-1][1]
+        log.commit(position)
+
+        self.assertEqual(log.checkpoint(), position)
+        self.assertEqual(len(self.segment_files()), 3)
+        self.assertEqual(self.read_all(log), records[2:])
+        self.assertEqual(log.backlog_bytes(position), 2 * (RECORD_HEADER.size + 40))
+
+    def test_checkpoint_survives_a_restart(self):
+        log = self.open_log(segment_bytes=64)
+        records = [bytes([index]) * 40 for index in range(3)]
+        self.append_all(log, records)
+        position = log.read(log.checkpoint(), max_records=3)[-1][1]
+        log.commit(position)
+
+        log = self.reopen(log, segment_bytes=64)
+        self.assertEqual(log.checkpoint(), position)
+        self.assertEqual(self.read_all(log), [])
+        self.append_all(log, [b"after"])
+        self.assertEqual(self.read_all(log), [b"after"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+
+from monitoring.metrics import REGISTRY, MetricsAggregator, MetricsServer
+
+logger = logging.getLogger("marketing_automation")
+
+WORKER_RESTARTS = REGISTRY.counter(
+    "event_collector_worker_restarts_total",
+    "Worker processes restarted by the supervisor after they exited",
+    ("queue",)
+)
+
+
+def _report_stats(stats_conn, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            stats_conn.send(REGISTRY.snapshot())
+        except (EOFError, OSError, BrokenPipeError):
+            return
+
+
+def _child_main(target, after_fork, slot, queue_name, stats_conn, stats_interval):
+    # the parent's handlers would otherwise run in the child until the worker installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # the supervisor aggregates its own values with those of the workers
+    REGISTRY.reset()
+    if after_fork:
+        after_fork()
+    reporter = threading.Thread(target=_report_stats, args=(stats_conn, stats_interval), name="stats-reporter", daemon=True)
+    reporter.start()
+    logger.info("Worker %s (pid %s) consuming %s", slot, os.getpid(), queue_name)
+    target(queue_name)
+
+
+class _Slot(object):
+
+    def __init__(self, slot, queue_name):
+        self.slot = slot
+        self.queue_name = queue_name
+        self.process = None
+        self.stats_conn = None
+        self.started_at = 0
+        self.restarts = 0
+        self.backoff = 0
+        self.restart_at = None
+
+
+class WorkerSupervisor(object):
+    """Forks one worker process per slot and keeps them running.
+
+    Slots are assigned to the queues round robin, so processes=4 with two
+    queues gives every queue two workers. Each child builds its own broker
+    and database connections after the fork (after_fork runs first in the
+    child), reports a snapshot of its metrics registry over a pipe every
+    stats_interval seconds, and is restarted with exponential backoff when it
+    dies. The supervisor serves the sum of all workers' metrics on
+    metrics_port.
+
+    :param callable target: Called with the queue name in the child, runs the worker
+    :param list queues: Queue names to consume
+    :param int processes: Number of worker processes, at least len(queues)
+    :param callable after_fork: Called first in every child to rebuild fork unsafe state
+    :param int metrics_port: Port of the aggregated metrics endpoint, None disables it
+
+    """
+
+    MIN_BACKOFF = 1.0
+    MAX_BACKOFF = 60.0
+    STABLE_AFTER = 30.0
+
+    def __init__(self, target, queues, processes=None, after_fork=None, metrics_port=None, stats_interval=5.0):
+        if not queues:
+            raise ValueError("At least one queue is required")
+        processes = max(processes or len(queues), len(queues))
+        self.target = target
+        self.after_fork = after_fork
+        self.metrics_port = metrics_port
+        self.stats_interval = stats_interval
+        self.aggregator = MetricsAggregator()
+        self._slots = [_Slot(index, queues[index % len(queues)]) for index in range(processes)]
+        self._context = multiprocessing.get_context("fork")
+        self._stopping = False
+
+    def _spawn(self, slot):
+        parent_conn, child_conn = self._context.Pipe(duplex=False)
+        slot.process = self._context.Process(
+            target=_child_main,
+            args=(self.target, self.after_fork, slot.slot, slot.queue_name, child_conn, self.stats_interval),
+            name="event-worker-{}".format(slot.slot)
+        )
+        slot.process.start()
+        child_conn.close()
+        slot.stats_conn = parent_conn
+        slot.started_at = time.monotonic()
+        slot.restart_at = None
+        logger.info("Started worker %s for queue %s with pid %s", slot.slot, slot.queue_name, slot.process.pid)
+
+    def _on_exit(self, slot):
+        exitcode = slot.process.exitcode
+        self.aggregator.retire(slot.slot)
+        slot.stats_conn.close()
+        slot.stats_conn = None
+        slot.process = None
+        if self._stopping:
+            return
+        if time.monotonic() - slot.started_at > self.STABLE_AFTER:
+            slot.backoff = self.MIN_BACKOFF
+        else:
+            slot.backoff = min(max(slot.backoff * 2, self.MIN_BACKOFF), self.MAX_BACKOFF)
+        slot.restarts += 1
+        WORKER_RESTARTS.inc(queue=slot.queue_name)
+        slot.restart_at = time.monotonic() + slot.backoff
+        logger.error("Worker %s for queue %s exited with code %s, restarting in %.1fs",
+                     slot.slot, slot.queue_name, exitcode, slot.backoff)
+
+    def _handle_signal(self, signum, frame):
+        logger.info("Supervisor received signal %s, stopping workers", signum)
+        self._stopping = True
+
+    def stats(self):
+        return [{"slot": slot.slot, "queue": slot.queue_name, "restarts": slot.restarts,
+                 "pid": slot.process.pid if slot.process else None} for slot in self._slots]
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        for slot in self._slots:
+            self._spawn(slot)
+        if self.metrics_port:
+            MetricsServer(port=self.metrics_port, registry=self.aggregator).start()
+
+        while not self._stopping:
+            now = time.monotonic()
+            for slot in self._slots:
+                if slot.process is None and slot.restart_at is not None and slot.restart_at <= now:
+                    self._spawn(slot)
+            waitables = {}
+            for slot in self._slots:
+                if slot.process is not None:
+                    waitables[slot.process.sentinel] = (slot, "exit")
+                    waitables[slot.stats_conn] = (slot, "stats")
+            for ready in wait(list(waitables), timeout=1.0):
+                slot, kind = waitables[ready]
+                if kind == "stats":
+                    if slot.stats_conn is None:
+                        continue
+                    try:
+                        self.aggregator.update(slot.slot, slot.stats_conn.recv())
+                    except (EOFError, OSError):
+                        pass
+                elif slot.process is not None:
+                    slot.process.join()
+                    self._on_exit(slot)
+        self.shutdown()
+
+    def shutdown(self, timeout=30.0):
+        """Send SIGTERM to every worker and wait for them to exit, killing stragglers."""
+        self._stopping = True
+        running = [slot for slot in self._slots if slot.process is not None]
+        for slot in running:
+            slot.process.terminate()
+        deadline = time.monotonic() + timeout
+        for slot in running:
+            slot.process.join(max(0, deadline - time.monotonic()))
+            if slot.process.is_alive():
+                logger.warning("Worker %s did not stop in time, killing it", slot.slot)
+                slot.process.kill()
+                slot.process.join()
+            self._on_exit(slot)